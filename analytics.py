@@ -0,0 +1,319 @@
+# columnar copy of the sales history for big reports
+#
+# Year-over-year numbers, hourly heatmaps or pizza x postal code tables over
+# years of orders are too heavy to run as joins on the live MySQL tables while
+# orders come in. Instead `flask export-analytics` copies new orders (by
+# order_id watermark) into column files on local disk, one NumPy array per
+# column, and AnalyticsStore answers the reports from those arrays with
+# vectorized NumPy code - no queries on the main database at all.
+#
+# Layout of the store directory:
+#   meta.json                 watermark, postal code + pizza dictionaries
+#   seg-000001/orders.*.npy   one file per column, per EXPORT_CHUNK orders exported
+#   seg-000001/items.*.npy
+#
+# Orders are only exported once they are `settle_hours` old, so their
+# delivery status (delivered/cancelled) no longer changes after the copy.
+# Segments are never rewritten; a full re-export is deleting the directory.
+import json
+import os
+from datetime import datetime, timedelta, date
+
+import click
+import numpy as np
+from flask import current_app
+from sqlalchemy import select, func
+
+from models import db, Order, OrderItem, Customer, User, Pizza
+from rollups import age_range
+
+DEFAULT_SETTLE_HOURS = 24
+EXPORT_CHUNK = 50000
+
+# small integer codes for the text columns
+STATUS_CODES = ['Pending', 'In Progress', 'Out for Delivery', 'Delivered', 'Cancelled']
+GENDER_CODES = ['Male', 'Female', 'Other']
+ITEM_TYPE_CODES = ['Pizza', 'Drink', 'Dessert']
+AGE_RANGES = ['Under 20', '20-29', '30-39', '40-49', '50+', 'Unknown']
+CANCELLED = STATUS_CODES.index('Cancelled')
+
+ORDER_COLUMNS = {
+    'order_id': np.int64,
+    'created_at': 'datetime64[s]',
+    'final_total': np.float64,
+    'status': np.int8,
+    'customer_id': np.int64,
+    'gender': np.int8,
+    'age_range': np.int8,       # age on the order day
+    'postal_code': np.int32,    # index into meta['postal_codes']
+}
+ITEM_COLUMNS = {
+    'order_id': np.int64,
+    'item_type': np.int8,
+    'pizza_id': np.int64,       # -1 for drinks and desserts
+    'quantity': np.int32,
+    'total_price': np.float64,
+}
+
+def store_path(app=None):
+    app = app or current_app
+    return app.config.get('ANALYTICS_STORE') or os.path.join(app.instance_path, 'analytics')
+
+# --- export ---------------------------------------------------------------
+
+def _read_meta(path):
+    meta_file = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_file):
+        return {'watermark': 0, 'segments': [], 'postal_codes': [], 'pizzas': {}}
+    with open(meta_file) as f:
+        return json.load(f)
+
+def _write_meta(path, meta):
+    # write to a temp file and rename, so readers never see half a file
+    tmp_file = os.path.join(path, 'meta.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_file, os.path.join(path, 'meta.json'))
+
+def _write_segment(segment_dir, table, columns, values):
+    for name, dtype in columns.items():
+        np.save(os.path.join(segment_dir, f'{table}.{name}.npy'), np.asarray(values[name], dtype=dtype))
+
+def _export_chunk(meta, postal_index, order_filter, after_id):
+    # the next EXPORT_CHUNK orders after after_id with their items, as columns
+    orders = {name: [] for name in ORDER_COLUMNS}
+    rows = db.session.execute(
+        select(Order.order_id, Order.created_at, Order.final_total, Order.delivery_status,
+               Order.customer_id, User.gender, User.date_of_birth, User.postal_code)
+        .join(Customer, Customer.customer_id == Order.customer_id)
+        .join(User, User.user_id == Customer.user_id)
+        .where(*order_filter, Order.order_id > after_id)
+        .order_by(Order.order_id)
+        .limit(EXPORT_CHUNK)
+    )
+    for order_id, created_at, final_total, status, customer_id, gender, date_of_birth, postal_code in rows:
+        postal_code = postal_code or ''
+        if postal_code not in postal_index:
+            postal_index[postal_code] = len(meta['postal_codes'])
+            meta['postal_codes'].append(postal_code)
+        orders['order_id'].append(order_id)
+        orders['created_at'].append(created_at)
+        orders['final_total'].append(float(final_total or 0))
+        orders['status'].append(STATUS_CODES.index(status or 'Pending'))
+        orders['customer_id'].append(customer_id)
+        orders['gender'].append(GENDER_CODES.index(gender or 'Other'))
+        orders['age_range'].append(AGE_RANGES.index(age_range(date_of_birth, created_at.date())))
+        orders['postal_code'].append(postal_index[postal_code])
+
+    items = {name: [] for name in ITEM_COLUMNS}
+    if not orders['order_id']:
+        return orders, items
+    rows = db.session.execute(
+        select(OrderItem.order_id, OrderItem.item_type, OrderItem.pizza_id,
+               OrderItem.quantity, OrderItem.total_price)
+        .where(OrderItem.order_id >= orders['order_id'][0], OrderItem.order_id <= orders['order_id'][-1])
+        .order_by(OrderItem.order_id)
+        .execution_options(yield_per=EXPORT_CHUNK)
+    )
+    for order_id, item_type, pizza_id, quantity, total_price in rows:
+        items['order_id'].append(order_id)
+        items['item_type'].append(ITEM_TYPE_CODES.index(item_type))
+        items['pizza_id'].append(pizza_id if pizza_id is not None else -1)
+        items['quantity'].append(quantity)
+        items['total_price'].append(float(total_price))
+    return orders, items
+
+def export_orders(path, settle_hours=DEFAULT_SETTLE_HOURS, now=None):
+    """Copy orders newer than the watermark into new segments.
+
+    Writes a segment (and moves the watermark) every EXPORT_CHUNK orders, so
+    memory stays flat however many orders there are and an interrupted
+    export goes on from the last segment. Returns the number of orders
+    exported. Meant to run from cron; only reads the database in order_id
+    ranges so it can point at a replica.
+    """
+    os.makedirs(path, exist_ok=True)
+    meta = _read_meta(path)
+    cutoff = (now or datetime.now()) - timedelta(hours=settle_hours)
+    postal_index = {code: i for i, code in enumerate(meta['postal_codes'])}
+
+    # stop before the first order that is still too new, so no order below
+    # the watermark is ever left behind
+    order_filter = []
+    first_unsettled = db.session.execute(
+        select(func.min(Order.order_id)).where(Order.order_id > meta['watermark'], Order.created_at > cutoff)
+    ).scalar()
+    if first_unsettled is not None:
+        order_filter.append(Order.order_id < first_unsettled)
+
+    # the pizza names are small, just copy all of them every time
+    meta['pizzas'] = {str(pizza_id): name for pizza_id, name in
+                      db.session.execute(select(Pizza.pizza_id, Pizza.name))}
+    exported = 0
+    while True:
+        orders, items = _export_chunk(meta, postal_index, order_filter, meta['watermark'])
+        if not orders['order_id']:
+            break
+        segment = f'seg-{len(meta["segments"]) + 1:06d}'
+        segment_dir = os.path.join(path, segment)
+        os.makedirs(segment_dir, exist_ok=True)
+        _write_segment(segment_dir, 'orders', ORDER_COLUMNS, orders)
+        _write_segment(segment_dir, 'items', ITEM_COLUMNS, items)
+        meta['segments'].append(segment)
+        meta['watermark'] = orders['order_id'][-1]
+        _write_meta(path, meta)
+        exported += len(orders['order_id'])
+    return exported
+
+# --- queries --------------------------------------------------------------
+
+class AnalyticsStore:
+    """Read-only view of the exported columns with the report queries"""
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = _read_meta(path)
+        self.orders = self._load('orders', ORDER_COLUMNS)
+        self.items = self._load('items', ITEM_COLUMNS)
+        self.pizza_names = {int(pizza_id): name for pizza_id, name in self.meta['pizzas'].items()}
+        # created_at of every item, looked up from its order (both are sorted by order_id)
+        positions = np.searchsorted(self.orders['order_id'], self.items['order_id'])
+        self.items['created_at'] = self.orders['created_at'][positions] if len(positions) else \
+            np.array([], dtype='datetime64[s]')
+        self.items['status'] = self.orders['status'][positions] if len(positions) else np.array([], dtype=np.int8)
+        self.items['postal_code'] = self.orders['postal_code'][positions] if len(positions) else \
+            np.array([], dtype=np.int32)
+
+    def _load(self, table, columns):
+        data = {}
+        for name, dtype in columns.items():
+            parts = [np.load(os.path.join(self.path, segment, f'{table}.{name}.npy'), mmap_mode='r')
+                     for segment in self.meta['segments']]
+            data[name] = np.concatenate(parts) if parts else np.array([], dtype=dtype)
+        return data
+
+    def __len__(self):
+        return len(self.orders['order_id'])
+
+    def _order_mask(self, start=None, end=None):
+        # orders in [start, end) that were not cancelled
+        mask = self.orders['status'] != CANCELLED
+        if start is not None:
+            mask &= self.orders['created_at'] >= np.datetime64(start, 's')
+        if end is not None:
+            mask &= self.orders['created_at'] < np.datetime64(end, 's')
+        return mask
+
+    def _pizza_mask(self, start=None, end=None):
+        mask = (self.items['item_type'] == ITEM_TYPE_CODES.index('Pizza')) & (self.items['status'] != CANCELLED)
+        if start is not None:
+            mask &= self.items['created_at'] >= np.datetime64(start, 's')
+        if end is not None:
+            mask &= self.items['created_at'] < np.datetime64(end, 's')
+        return mask
+
+    def _earnings_by(self, codes, labels, start, end):
+        mask = self._order_mask(start, end)
+        orders = np.bincount(codes[mask], minlength=len(labels))
+        revenue = np.bincount(codes[mask], weights=self.orders['final_total'][mask], minlength=len(labels))
+        return [{'label': labels[i], 'orders': int(orders[i]), 'revenue': round(float(revenue[i]), 2)}
+                for i in range(len(labels)) if orders[i]]
+
+    # the same numbers as the /reports page, for any date range
+
+    def revenue(self, start=None, end=None):
+        return round(float(self.orders['final_total'][self._order_mask(start, end)].sum()), 2)
+
+    def earnings_by_gender(self, start=None, end=None):
+        return self._earnings_by(self.orders['gender'], GENDER_CODES, start, end)
+
+    def earnings_by_age_group(self, start=None, end=None):
+        return self._earnings_by(self.orders['age_range'], AGE_RANGES, start, end)
+
+    def earnings_by_postal_code(self, start=None, end=None, top=10):
+        rows = self._earnings_by(self.orders['postal_code'], self.meta['postal_codes'], start, end)
+        return sorted(rows, key=lambda row: row['revenue'], reverse=True)[:top]
+
+    def top_pizzas(self, start=None, end=None, top=3):
+        mask = self._pizza_mask(start, end)
+        pizza_ids = self.items['pizza_id'][mask]
+        if not len(pizza_ids):
+            return []
+        size = int(pizza_ids.max()) + 1
+        quantity = np.bincount(pizza_ids, weights=self.items['quantity'][mask], minlength=size)
+        revenue = np.bincount(pizza_ids, weights=self.items['total_price'][mask], minlength=size)
+        best = [pizza_id for pizza_id in np.argsort(-quantity, kind='stable') if quantity[pizza_id] > 0][:top]
+        return [{'name': self.pizza_names.get(int(pizza_id), f'Pizza {pizza_id}'),
+                 'orders': int(quantity[pizza_id]), 'revenue': round(float(revenue[pizza_id]), 2)}
+                for pizza_id in best]
+
+    # reports the live database can't afford
+
+    def year_over_year(self):
+        """Revenue per month, one row per year: {year: [jan, ..., dec]}"""
+        mask = self._order_mask()
+        months = self.orders['created_at'][mask].astype('datetime64[M]').astype(np.int64)  # months since 1970
+        if not len(months):
+            return {}
+        first_year = int(months.min() // 12)
+        index = months - first_year * 12
+        revenue = np.bincount(index, weights=self.orders['final_total'][mask],
+                              minlength=(int(months.max() // 12) - first_year + 1) * 12)
+        table = revenue.reshape(-1, 12)
+        return {1970 + first_year + i: [round(float(v), 2) for v in row] for i, row in enumerate(table)}
+
+    def hourly_heatmap(self, start=None, end=None):
+        """Orders per weekday (0 = Monday) and hour of the day, as a 7 x 24 array"""
+        created_at = self.orders['created_at'][self._order_mask(start, end)]
+        days = created_at.astype('datetime64[D]')
+        hours = ((created_at - days).astype(np.int64) // 3600).astype(np.int64)
+        weekdays = (days.astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday
+        return np.bincount(weekdays * 24 + hours, minlength=7 * 24).reshape(7, 24)
+
+    def pizza_postal_crosstab(self, start=None, end=None):
+        """Pizzas sold per pizza and postal code.
+
+        Returns (pizza names, postal codes, quantity matrix) with one row per
+        pizza and one column per postal code.
+        """
+        mask = self._pizza_mask(start, end)
+        pizza_ids = self.items['pizza_id'][mask]
+        postal_codes = self.items['postal_code'][mask]
+        n_pizzas = int(pizza_ids.max()) + 1 if len(pizza_ids) else 0
+        n_codes = len(self.meta['postal_codes'])
+        matrix = np.bincount(pizza_ids * n_codes + postal_codes, weights=self.items['quantity'][mask],
+                             minlength=n_pizzas * n_codes).reshape(n_pizzas, n_codes)
+        rows = [pizza_id for pizza_id in range(n_pizzas) if matrix[pizza_id].any()]
+        return ([self.pizza_names.get(pizza_id, f'Pizza {pizza_id}') for pizza_id in rows],
+                list(self.meta['postal_codes']),
+                matrix[rows].astype(np.int64))
+
+# --- command line ---------------------------------------------------------
+
+@click.command('export-analytics')
+@click.option('--settle-hours', type=float, default=DEFAULT_SETTLE_HOURS,
+              help='Only export orders at least this old (their status is final).')
+def export_analytics_command(settle_hours):
+    """Copy new orders into the columnar analytics store."""
+    path = store_path()
+    count = export_orders(path, settle_hours)
+    click.echo(f'Exported {count} orders to {path}')
+
+@click.command('analytics-report')
+@click.option('--days', type=int, default=365, help='How many days back to report on.')
+def analytics_report_command(days):
+    """Print the sales reports from the analytics store."""
+    store = AnalyticsStore(store_path())
+    start = date.today() - timedelta(days=days)
+    click.echo(f'{len(store)} orders in store, last {days} days:')
+    click.echo(f'  revenue: {store.revenue(start):.2f}')
+    for title, rows in (('top pizzas', store.top_pizzas(start)),
+                        ('by gender', store.earnings_by_gender(start)),
+                        ('by age group', store.earnings_by_age_group(start)),
+                        ('by postal code', store.earnings_by_postal_code(start))):
+        click.echo(f'  {title}:')
+        for row in rows:
+            click.echo(f"    {row.get('name', row.get('label'))}: {row['orders']} orders, {row['revenue']:.2f}")
+    click.echo('  revenue per month:')
+    for year, months in store.year_over_year().items():
+        click.echo(f"    {year}: " + ' '.join(f'{v:.0f}' for v in months))
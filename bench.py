@@ -0,0 +1,229 @@
+# benchmark of the main pages on generated data
+#
+# Builds a database with datagen (a fresh SQLite file unless --database-url
+# says otherwise), then requests every page many times through the Flask
+# test client and records latency percentiles and how many SQL statements
+# each request sent. Results can be saved as a baseline and later runs
+# compared against it, so a change that adds queries or slows a page down
+# shows up as a number:
+#
+#   python bench.py --scale small --save bench_baseline.json
+#   python bench.py --scale small --compare bench_baseline.json
+#
+# Statement counts are exact and compared strictly. Latencies depend on the
+# machine, so they only count as a regression past --tolerance times the
+# baseline. A route with failed requests fails the run, and no baseline is
+# saved with one (its numbers would be those of the error page).
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import click
+from sqlalchemy import event, select, update
+
+from models import db, Customer, Order, Staff, get_menu_catalog
+from datagen import SCALES, generate
+
+# the pages measured, by view function name
+ROUTES = ['create_order', 'show_orders', 'order_detail', 'show_reports',
+          'delivery_status', 'show_drivers', 'show_menu']
+
+DEFAULT_ITERATIONS = 50
+DEFAULT_TOLERANCE = 1.5
+
+class StatementCounter:
+    """Counts the statements sent through an engine (from any thread)"""
+
+    def __init__(self, engine):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        with self._lock:
+            self.count += 1
+
+def percentile(values, q):
+    # nearest rank, values sorted
+    if not values:
+        return None
+    rank = max(1, int(round(q / 100 * len(values) + 0.5)))
+    return values[min(rank, len(values)) - 1]
+
+class Bench:
+    """Requests the pages with realistic arguments and measures them"""
+
+    def __init__(self, app, seed=1):
+        self.app = app
+        self.rng = random.Random(seed)
+        self.client = app.test_client()
+        self.counter = StatementCounter(db.engine)
+        self.customer_ids = db.session.execute(select(Customer.customer_id)).scalars().all()
+        self.max_order_id = db.session.execute(select(Order.order_id).order_by(Order.order_id.desc())).scalar()
+        catalog = get_menu_catalog()
+        self.pizza_ids = [pizza.pizza_id for pizza in catalog.pizzas]
+        self.drink_ids = [drink.drink_id for drink in catalog.drinks]
+        db.session.remove()
+
+    def _request(self, route):
+        # (method, url, form data, ok(response))
+        if route == 'create_order':
+            form = {'customer_id': self.rng.choice(self.customer_ids)}
+            for pizza_id in self.rng.sample(self.pizza_ids, self.rng.randint(1, 2)):
+                form[f'pizza_{pizza_id}'] = self.rng.randint(1, 2)
+            if self.drink_ids and self.rng.random() < 0.5:
+                form[f'drink_{self.rng.choice(self.drink_ids)}'] = 1
+            return 'POST', '/orders/create', form, lambda r: '/orders/' in r.headers.get('Location', '')
+        if route == 'show_orders':
+            url = self.rng.choice(['/orders', '/orders?status=Delivered', '/orders?limit=100'])
+            return 'GET', url, None, lambda r: r.status_code == 200
+        if route == 'order_detail':
+            return 'GET', f'/orders/{self.rng.randint(1, self.max_order_id)}', None, lambda r: r.status_code == 200
+        url = {'show_reports': '/reports', 'delivery_status': '/delivery-status',
+               'show_drivers': '/drivers', 'show_menu': '/products'}[route]
+        return 'GET', url, None, lambda r: r.status_code == 200
+
+    def _release_drivers(self):
+        # put claimed drivers back, like finished deliveries would (not timed)
+        with self.app.app_context():
+            db.session.execute(update(Staff).where(Staff.is_available == False)
+                               .values(is_available=True, last_delivery_time=None))
+            db.session.commit()
+
+    def run_route(self, route, iterations, warmup=3):
+        timings, statements, errors = [], [], 0
+        for n in range(warmup + iterations):
+            method, url, form, ok = self._request(route)
+            before = self.counter.count
+            started = time.perf_counter()
+            response = self.client.open(url, method=method, data=form)
+            took = time.perf_counter() - started
+            sent = self.counter.count - before
+            if route == 'create_order':
+                self._release_drivers()
+            if n < warmup:
+                continue
+            timings.append(took * 1000)
+            statements.append(sent)
+            if not ok(response):
+                errors += 1
+        timings.sort()
+        return {
+            'requests': iterations,
+            'errors': errors,
+            'mean_ms': round(sum(timings) / len(timings), 2),
+            'p50_ms': round(percentile(timings, 50), 2),
+            'p90_ms': round(percentile(timings, 90), 2),
+            'p99_ms': round(percentile(timings, 99), 2),
+            'max_ms': round(timings[-1], 2),
+            'statements_mean': round(sum(statements) / len(statements), 2),
+            'statements_max': max(statements),
+        }
+
+    def run(self, routes=ROUTES, iterations=DEFAULT_ITERATIONS):
+        return {route: self.run_route(route, iterations) for route in routes}
+
+@contextmanager
+def bench_app(scale, database_url=None, seed=42, config=None):
+    """An app on generated data, for benchmarks and load tests.
+
+    Without a database_url the data goes into a throwaway SQLite file that is
+    removed afterwards; with one, the database is used as it is.
+    """
+    from app import create_app
+
+    workdir = None
+    if not database_url:
+        workdir = tempfile.mkdtemp(prefix='mamma-mia-bench-')
+        database_url = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    # harness requests are slow on purpose (many at once, or timed with
+    # profiling on), so they aren't logged one by one unless config asks for it
+    config = dict({'PROFILE_SLOW_REQUEST_MS': float('inf')}, **(config or {}))
+    app = create_app(dict(config, SQLALCHEMY_DATABASE_URI=database_url, DELIVERY_SCHEDULER_ENABLED=False,
+                          ORDER_INTAKE_WORKERS=0))
+    try:
+        if workdir:
+            click.echo(f'generating {scale} data')
+            with app.app_context():
+                generate(seed=seed, **SCALES[scale])
+        yield app
+    finally:
+        if workdir:
+            with app.app_context():
+                db.engine.dispose()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Regressions against a saved baseline, as readable lines (failed requests: failing_routes)"""
+    regressions = []
+    for route, now in results.items():
+        before = baseline.get('routes', {}).get(route)
+        if before is None:
+            continue
+        if now['statements_mean'] > before['statements_mean'] + 0.5:
+            regressions.append(f"{route}: {now['statements_mean']} statements per request "
+                               f"(baseline {before['statements_mean']})")
+        if now['p90_ms'] > before['p90_ms'] * tolerance:
+            regressions.append(f"{route}: p90 {now['p90_ms']} ms (baseline {before['p90_ms']} ms)")
+    return regressions
+
+def failing_routes(results):
+    # a route that fails was never measured, its numbers mean nothing
+    return [f"{route}: {r['errors']} of {r['requests']} requests failed"
+            for route, r in results.items() if r['errors']]
+
+def _print_results(results):
+    click.echo(f"{'route':<17}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'stmts':>8}{'errors':>8}")
+    for route, r in results.items():
+        click.echo(f"{route:<17}{r['p50_ms']:>9.2f}{r['p90_ms']:>9.2f}{r['p99_ms']:>9.2f}"
+                   f"{r['max_ms']:>9.2f}{r['statements_mean']:>8.1f}{r['errors']:>8}")
+
+@click.command()
+@click.option('--scale', type=click.Choice(list(SCALES)), default='tiny', help='How much data to generate.')
+@click.option('--database-url', help='Benchmark this database as it is (no data is generated).')
+@click.option('--iterations', type=int, default=DEFAULT_ITERATIONS, help='Requests per route.')
+@click.option('--route', 'routes', multiple=True, type=click.Choice(ROUTES), help='Only these routes.')
+@click.option('--cache/--no-cache', default=False, help='Keep the dashboard result caches on.')
+@click.option('--save', type=click.Path(), help='Write the results to this baseline file.')
+@click.option('--compare', 'compare_with', type=click.Path(exists=True), help='Fail on regressions against this baseline.')
+@click.option('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Allowed p90 slowdown factor.')
+@click.option('--seed', type=int, default=42)
+def main(scale, database_url, iterations, routes, cache, save, compare_with, tolerance, seed):
+    """Benchmark the order pipeline pages."""
+    config = {}
+    if not cache:
+        config['RESULT_CACHE_DISABLED'] = ('reports', 'driver_board', 'delivery_overview')
+    with bench_app(scale, database_url, seed, config) as app:
+        with app.app_context():
+            bench = Bench(app, seed)
+        results = bench.run(list(routes) or ROUTES, iterations)
+    _print_results(results)
+    failing = failing_routes(results)
+    for line in failing:
+        click.echo(f'FAILING {line}')
+
+    if save:
+        if failing:
+            raise click.ClickException(f'not saving a baseline with {len(failing)} failing routes')
+        with open(save, 'w') as f:
+            json.dump({'scale': scale if not database_url else database_url.split(':')[0], 'iterations': iterations,
+                       'routes': results}, f, indent=2, sort_keys=True)
+        click.echo(f'baseline written to {save}')
+    if compare_with:
+        with open(compare_with) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        for line in regressions:
+            click.echo(f'REGRESSION {line}')
+        if regressions:
+            raise click.ClickException(f'{len(regressions)} regressions against {compare_with}')
+        click.echo(f'no regressions against {compare_with}')
+    if failing:
+        raise click.ClickException(f'{len(failing)} routes failed')
+
+if __name__ == '__main__':
+    main()
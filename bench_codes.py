@@ -0,0 +1,123 @@
+# benchmark of discount code campaigns (campaigns.py) at full size
+#
+# Issues a campaign of a million codes into a throwaway SQLite database (or
+# --database-url) and measures each step: the time it takes and the peak
+# Python memory it needs, traced with tracemalloc. The campaign steps must stay
+# under --memory-budget-mb however many codes there are, since codes are made
+# and inserted chunk by chunk and resets and expiries are single UPDATEs:
+#
+#   python bench_codes.py --count 1000000 --memory-budget-mb 64
+#
+# tracemalloc slows Python down a lot (three times or more), so the codes/s
+# here are well below what a real run does.
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import click
+from sqlalchemy import select, update, func
+
+from models import db, DiscountCode
+from bench import bench_app
+from campaigns import BATCH_SIZE, create_campaign, issue_codes, reset_codes, expire_codes
+from discounts import code_index, redeem_code
+
+DEFAULT_COUNT = 1_000_000
+DEFAULT_BUDGET_MB = 64
+
+def measure(work):
+    """Run work() and return (result, seconds, peak MB)"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = work()
+    finally:
+        seconds = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, seconds, peak / 1024 / 1024
+
+@click.command()
+@click.option('--count', type=int, default=DEFAULT_COUNT, help='Codes in the campaign.')
+@click.option('--batch-size', type=int, default=BATCH_SIZE, help='Rows per insert and commit.')
+@click.option('--memory-budget-mb', type=float, default=DEFAULT_BUDGET_MB,
+              help='Most Python memory a campaign step may need.')
+@click.option('--database-url', help='Use this database instead of a throwaway SQLite file.')
+def main(count, batch_size, memory_budget_mb, database_url):
+    """Benchmark issuing, resetting and expiring a large code campaign."""
+    results = []
+
+    def report(step, seconds, peak_mb, rows, budgeted=True):
+        rate = f'{rows / seconds:>12,.0f}/s' if seconds else ''
+        click.echo(f'{step:<22}{seconds:>9.2f} s{peak_mb:>9.1f} MB{rows:>12,} rows{rate}')
+        results.append((step, peak_mb, budgeted))
+
+    with bench_app('tiny', database_url) as app, app.app_context():
+        prefix = f'BENCH{int(time.time()) % 100000}'
+        campaign = create_campaign('benchmark', prefix, count, 5, date.today() + timedelta(days=30))
+        db.session.commit()
+
+        click.echo(f'issuing {count:,} codes in chunks of {batch_size:,}')
+        click.echo(f"{'step':<22}{'time':>11}{'peak':>12}{'':>17}")
+        last = [time.perf_counter()]
+
+        def progress(issued, total):
+            # a line every 10%
+            if issued * 10 // total != (issued - batch_size) * 10 // total or issued == total:
+                now = time.perf_counter()
+                click.echo(f'  {issued:>12,} / {total:,}  ({now - last[0]:.1f} s)')
+                last[0] = now
+
+        added, seconds, peak = measure(lambda: issue_codes(campaign, batch_size, progress))
+        report('issue', seconds, peak, added)
+
+        stored = db.session.execute(
+            select(func.count(DiscountCode.code_id), func.count(func.distinct(DiscountCode.code_name)))
+            .where(DiscountCode.code_name.like(f'{prefix}-%'))
+        ).one()
+        if stored[0] != count or stored[1] != count:
+            raise click.ClickException(f'expected {count} distinct codes, found {stored[1]} of {stored[0]}')
+
+        # the redemption filter has to take in all of them (in the background
+        # in the app, here in this thread to time it)
+        _, seconds, peak = measure(code_index.rebuild)
+        report('filter rebuild', seconds, peak, code_index.stats()['codes'], budgeted=False)
+        sample = db.session.execute(
+            select(DiscountCode.code_name).where(DiscountCode.code_name.like(f'{prefix}-%')).limit(1)
+        ).scalar()
+        claimed, seconds, peak = measure(lambda: redeem_code(sample))
+        db.session.commit()
+        if claimed is None:
+            raise click.ClickException(f'could not redeem {sample}')
+        report('redeem', seconds, peak, 1)
+
+        # use every code so the reset has something to do
+        db.session.execute(
+            update(DiscountCode).where(DiscountCode.code_name.like(f'{prefix}-%'))
+            .values(is_used=True).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+        def reset():
+            changed = reset_codes(prefix)
+            db.session.commit()
+            return changed
+
+        def expire():
+            changed = expire_codes(prefix)
+            db.session.commit()
+            return changed
+
+        for step, work in (('reset', reset), ('expire', expire)):
+            changed, seconds, peak = measure(work)
+            report(step, seconds, peak, changed)
+
+    over = [(step, peak) for step, peak, budgeted in results if budgeted and peak > memory_budget_mb]
+    for step, peak in over:
+        click.echo(f'OVER BUDGET {step}: {peak:.1f} MB (budget {memory_budget_mb} MB)')
+    if over:
+        raise click.ClickException(f'{len(over)} steps over the memory budget')
+    click.echo(f'all campaign steps within {memory_budget_mb} MB')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# simulated peak evening: delivery runs (delivery_runs.py) against one order per run
+#
+# Runs the real order pipeline and delivery scheduler on generated data, once
+# per policy, with a ManualClock instead of the wall clock, so two hours of
+# Friday evening take a few seconds:
+#
+#   - orders arrive at random (Poisson) over --hours, from random customers
+#   - place_order() and DeliveryScheduler.run_due() do what they do in the
+#     app, at the simulated time
+#   - every policy starts from the same data, the same arrivals and all
+#     drivers free
+#
+# and prints, per policy, the orders delivered per driver-hour (a driver who
+# delivered anything counts for the whole evening), how many emergency
+# drivers had to come in and how long orders took from checkout to the door.
+#
+#   python bench_runs.py --orders 600 --hours 2 --capacity 4 --window 120
+import random
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import select, update, func
+
+from models import db, Customer, User, Order, Staff, get_menu_catalog
+from bench import bench_app, percentile
+from delivery_scheduler import DeliveryScheduler, ManualClock, DELIVERED_AFTER
+from dispatch import DRIVER_COOLDOWN
+from order_service import place_order, price_line, sort_lines
+
+EVENING = datetime(2026, 1, 9, 19, 0)  # a Friday
+DRAIN_HOURS = 3                        # stop looking for drivers this long after the last order
+
+def arrivals(orders, hours, seed):
+    """Times of the orders, a Poisson process over the evening"""
+    rng = random.Random(seed)
+    rate = orders / (hours * 3600)  # per second
+    times, at = [], 0.0
+    while len(times) < orders:
+        at += rng.expovariate(rate)
+        times.append(EVENING + timedelta(seconds=at))
+    return times
+
+def random_lines(rng, catalog):
+    pizzas = rng.sample(catalog.pizzas, min(len(catalog.pizzas), rng.randint(1, 3)))
+    lines = [price_line(catalog, 'Pizza', pizza.pizza_id, rng.randint(1, 2)) for pizza in pizzas]
+    if catalog.drinks and rng.random() < 0.5:
+        lines.append(price_line(catalog, 'Drink', rng.choice(catalog.drinks).drink_id, 1))
+    return sort_lines([line for line in lines if line])
+
+def simulate(app, times, seed):
+    """Place the orders at their times and let the scheduler deliver them"""
+    scheduler = DeliveryScheduler(clock=ManualClock(EVENING))
+    scheduler.init_app(app)
+    rng = random.Random(seed)
+
+    def run_until(at):
+        # every step that falls due before `at`, at its own time
+        while scheduler.next_due() is not None and scheduler.next_due() <= at:
+            scheduler.clock.current = max(scheduler.clock.current, scheduler.next_due())
+            scheduler.run_due()
+        scheduler.clock.current = max(scheduler.clock.current, at)
+
+    with app.app_context():
+        # everybody starts the evening free and rested
+        db.session.execute(
+            update(Staff).values(is_available=True, is_retired=False, last_delivery_time=EVENING - DRIVER_COOLDOWN)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+        first_order = db.session.execute(select(func.max(Order.order_id))).scalar() or 0
+        customers = db.session.execute(select(Customer.customer_id, Customer.user_id)).all()
+        catalog = get_menu_catalog()
+
+    for at in times:
+        run_until(at)
+        customer_id, user_id = rng.choice(customers)
+        with app.app_context():
+            customer, user = db.session.get(Customer, customer_id), db.session.get(User, user_id)
+            placed = place_order(customer, user, random_lines(rng, catalog), now=at)
+            db.session.commit()
+            order = placed.order
+            scheduler.order_placed(order.order_id, order.created_at, order.staff_id)
+            db.session.remove()
+    run_until(times[-1] + timedelta(hours=DRAIN_HOURS))
+
+    with app.app_context():
+        rows = db.session.execute(
+            select(Order.created_at, Order.dispatched_at, Order.delivery_status, Order.staff_id, Staff.is_emergency)
+            .outerjoin(Staff, Staff.staff_id == Order.staff_id)
+            .where(Order.order_id > first_order)
+        ).all()
+    return rows
+
+def summarize(rows):
+    delivered = [row for row in rows if row.delivery_status == 'Delivered']
+    drivers = {row.staff_id for row in delivered}
+    emergency = {row.staff_id for row in delivered if row.is_emergency}
+    # the evening runs from the first order to the last delivery
+    start = min(row.created_at for row in rows)
+    end = max((row.dispatched_at for row in delivered), default=start) + timedelta(seconds=DELIVERED_AFTER)
+    driver_hours = len(drivers) * (end - start).total_seconds() / 3600
+    minutes = sorted((row.dispatched_at - row.created_at).total_seconds() / 60 + DELIVERED_AFTER / 60
+                     for row in delivered)
+    return {
+        'orders': len(rows),
+        'delivered': len(delivered),
+        'drivers': len(drivers),
+        'emergency': len(emergency),
+        'per_driver_hour': len(delivered) / driver_hours if driver_hours else 0.0,
+        'p50': percentile(minutes, 50),
+        'p90': percentile(minutes, 90),
+    }
+
+@click.command()
+@click.option('--orders', type=int, default=600, help='Orders over the evening.')
+@click.option('--hours', type=float, default=2.0, help='How long the evening rush lasts.')
+@click.option('--capacity', type=int, default=4, help='Orders per delivery run.')
+@click.option('--window', type=int, default=120, help='Seconds an order waits for its run at most.')
+@click.option('--scale', default='tiny', help='Generated data to start from (see datagen.SCALES).')
+@click.option('--seed', type=int, default=42, help='Same seed, same data and arrivals.')
+def main(orders, hours, capacity, window, scale, seed):
+    """Compare delivery runs with one order per run on a simulated evening."""
+    times = arrivals(orders, hours, seed)
+    policies = [
+        ('one order per run', {'DELIVERY_BATCHING': False}),
+        (f'runs of {capacity}, {window}s window',
+         {'DELIVERY_BATCHING': True, 'DELIVERY_RUN_CAPACITY': capacity, 'DELIVERY_BATCH_WINDOW': window}),
+    ]
+    results = []
+    for name, config in policies:
+        with bench_app(scale, seed=seed, config=config) as app:
+            results.append((name, summarize(simulate(app, times, seed))))
+
+    click.echo(f'{orders} orders over {hours:g} hours')
+    click.echo(f"{'policy':<28}{'delivered':>10}{'drivers':>9}{'emergency':>11}"
+               f"{'per drv-h':>11}{'p50 min':>9}{'p90 min':>9}")
+    for name, stats in results:
+        click.echo(f"{name:<28}{stats['delivered']:>10}{stats['drivers']:>9}{stats['emergency']:>11}"
+                   f"{stats['per_driver_hour']:>11.2f}{stats['p50'] or 0:>9.1f}{stats['p90'] or 0:>9.1f}")
+    before, after = results[0][1], results[1][1]
+    if before['per_driver_hour']:
+        click.echo(f"orders per driver-hour: x{after['per_driver_hour'] / before['per_driver_hour']:.2f}")
+
+if __name__ == '__main__':
+    main()
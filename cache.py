@@ -0,0 +1,149 @@
+# small in-process result caches for the dashboard pages
+#
+# /reports, /delivery-status and /drivers are polled all the time by several
+# screens, and between two changes every poll computes the same thing. Each
+# cache keeps a bounded number of results (least recently used ones are
+# dropped first) for a limited time, and is emptied straight away when one
+# of the events it listens to happens (an order is placed, a delivery moves
+# on, a driver is added, ...).
+#
+# The caches live in this process only; other web workers keep their own.
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request, make_response, session
+from werkzeug.http import is_resource_modified
+
+# events that change what the dashboards show
+ORDER_CREATED = 'order_created'
+ORDER_CANCELLED = 'order_cancelled'
+DELIVERY_STATUS_CHANGED = 'delivery_status_changed'
+DELIVERY_COMPLETED = 'delivery_completed'
+DRIVER_CREATED = 'driver_created'
+
+class ResultCache:
+    """Keyed results with a time to live and a maximum number of entries"""
+
+    def __init__(self, name, ttl, max_entries, events=()):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.events = set(events)
+        self._entries = OrderedDict()  # key -> (expires_at, value), oldest first
+        self._generation = 0           # bumped on every invalidate
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_or_compute(self, key, compute, keep=None):
+        # keep(value) can say a result should not be cached (e.g. had errors)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        value = compute()
+
+        with self._lock:
+            # don't keep a result that was computed before an invalidation
+            if generation == self._generation and (keep is None or keep(value)):
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+# name -> ResultCache
+_caches = {}
+
+def register_cache(name, ttl, max_entries=32, events=()):
+    cache = ResultCache(name, ttl, max_entries, events)
+    _caches[name] = cache
+    return cache
+
+def cached(name, key, compute, keep=None):
+    """Result of compute() for key, from the named cache if it is switched on.
+
+    Caching can be switched off with the RESULT_CACHE_DISABLED config setting,
+    a list of cache names and/or endpoints (e.g. 'orders.show_drivers'); then
+    compute() runs every time.
+    """
+    disabled = current_app.config.get('RESULT_CACHE_DISABLED', ())
+    if name in disabled or request.endpoint in disabled:
+        return compute()
+    return _caches[name].get_or_compute(key, compute, keep)
+
+def invalidate(event):
+    # empty every cache that listens to this event
+    for cache in _caches.values():
+        if event in cache.events:
+            cache.invalidate()
+
+def conditional(etag, last_modified, render, private=False):
+    """A page that can answer 304 Not Modified.
+
+    render() only runs when the client doesn't have this version (etag,
+    last_modified) of the page yet. Browsers still ask every time
+    (no-cache), so a change shows up on the next visit.
+
+    While a flash message is waiting the page is always rendered (a 304
+    would never show it) and not validated, so the browser doesn't keep the
+    version with the message in it.
+    """
+    if session.get('_flashes'):
+        response = make_response(render())
+        response.cache_control.no_store = True
+        return response
+    if not is_resource_modified(request.environ, etag=f'"{etag}"', last_modified=last_modified):
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    return response
+
+def cache_stats():
+    return {name: cache.stats() for name, cache in _caches.items()}
+
+# the dashboard caches
+register_cache('reports', ttl=60, max_entries=4,
+               events=[ORDER_CREATED, ORDER_CANCELLED, DELIVERY_STATUS_CHANGED, DELIVERY_COMPLETED])
+register_cache('driver_board', ttl=15, max_entries=8,
+               events=[ORDER_CREATED, ORDER_CANCELLED, DELIVERY_STATUS_CHANGED, DELIVERY_COMPLETED, DRIVER_CREATED])
+register_cache('delivery_overview', ttl=15, max_entries=2,
+               events=[ORDER_CREATED, ORDER_CANCELLED, DELIVERY_STATUS_CHANGED, DELIVERY_COMPLETED])
+# rendered menu sections, keyed by the menu version so a menu change never
+# shows an old one (old versions just fall out)
+register_cache('menu_fragments', ttl=24 * 3600, max_entries=16)
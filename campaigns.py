@@ -0,0 +1,220 @@
+# discount code campaigns: many codes at once, and bulk resets and expiries
+#
+# A flyer drop needs hundreds of thousands of codes. Campaign codes are named
+# <PREFIX>-XXXXXXXX where XXXXXXXX is the code's number 0, 1, 2, ... encrypted
+# with the campaign's secret key and written in 8 base32 letters (40 bits).
+# The encryption is a 4-round Feistel network over the two 20-bit halves,
+# with keyed BLAKE2s (a MAC, so unpredictable without the key), truncated to
+# 20 bits, as the round function. It's a few times faster than HMAC-SHA256,
+# which matters at 4 rounds per code.
+#
+# A Feistel network is a permutation whatever its round function, so the
+# codes of a campaign can never collide (no need to keep the ones made so far
+# in memory or to look them up), and the prefix keeps them apart from every
+# other code. Without the key, the codes seen so far don't help to guess
+# another one.
+#
+# Campaigns made before there was a key (code_key is NULL) keep their old
+# scramble, (number * multiplier + offset) mod 2**40, so they can still be
+# finished without clashing with the codes they already have. That one is
+# linear: two codes of such a campaign give away all the others.
+#
+# Codes are inserted in chunks of BATCH_SIZE rows (one executemany each) and
+# committed per chunk together with the campaign's `issued` counter, so memory
+# stays flat however big the campaign is, and an interrupted run continues
+# where it stopped when it is started again.
+#
+# Resets and expiries are one UPDATE each, for a campaign or for all codes. A
+# reset also counts up the codes' Data_Version, which tells the redemption
+# filter of every web worker to rebuild (see discounts.py).
+#
+#   flask --app app issue-codes "Spring flyers" --prefix SPRING --count 500000 --value 5 --expires 2026-06-30
+#   flask --app app expire-codes --prefix SPRING
+import hashlib
+import re
+import secrets
+from datetime import date, datetime, timedelta
+
+import click
+from sqlalchemy import select, update
+
+from models import db, DiscountCode, DiscountCampaign, bump_data_version
+from discounts import code_index, CODES_VERSION
+
+BATCH_SIZE = 10000
+MAX_CODES = 10_000_000
+
+CODE_BITS = 40
+CODE_SPACE = 1 << CODE_BITS
+HALF_BITS = CODE_BITS // 2
+HALF_MASK = (1 << HALF_BITS) - 1
+ROUNDS = 4
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'  # Crockford base32, no I/L/O/U
+PREFIX_PATTERN = re.compile(r'^[A-Z0-9]{2,20}$')
+
+class CampaignError(ValueError):
+    """The campaign can't be issued as asked"""
+
+def encode(number):
+    # 40 bits -> 8 base32 letters, most significant first
+    return ''.join(ALPHABET[(number >> shift) & 31] for shift in range(CODE_BITS - 5, -1, -5))
+
+def encrypt(key, number):
+    # Feistel network over 40 bits, keyed BLAKE2s rounds (key: up to 32 bytes)
+    left, right = number >> HALF_BITS, number & HALF_MASK
+    for round_number in range(ROUNDS):
+        digest = hashlib.blake2s(bytes((round_number,)) + right.to_bytes(3, 'big'), key=key, digest_size=3).digest()
+        left, right = right, left ^ (int.from_bytes(digest, 'big') & HALF_MASK)
+    return (left << HALF_BITS) | right
+
+def code_names(campaign, start, stop):
+    """Names of the campaign's codes number start up to stop"""
+    prefix = campaign.prefix + '-'
+    if campaign.code_key is None:
+        multiplier, offset = campaign.code_multiplier, campaign.code_offset
+        for number in range(start, stop):
+            yield prefix + encode((number * multiplier + offset) % CODE_SPACE)
+        return
+    key = bytes.fromhex(campaign.code_key)
+    for number in range(start, stop):
+        yield prefix + encode(encrypt(key, number))
+
+def _prefix_filter(prefix):
+    # the prefix is letters and digits only, nothing to escape
+    return DiscountCode.code_name.like(f'{prefix}-%')
+
+def create_campaign(name, prefix, count, discount_value, expiry_date):
+    """A new campaign row (no codes yet). The caller commits."""
+    prefix = prefix.upper()
+    if not PREFIX_PATTERN.match(prefix):
+        raise CampaignError('prefix must be 2-20 letters or digits')
+    if not 0 < count <= MAX_CODES:
+        raise CampaignError(f'count must be between 1 and {MAX_CODES}')
+    if db.session.execute(select(DiscountCampaign.campaign_id).where(DiscountCampaign.prefix == prefix)).first():
+        raise CampaignError(f'there is already a campaign with prefix {prefix}')
+    if db.session.execute(select(DiscountCode.code_id).where(_prefix_filter(prefix)).limit(1)).first():
+        raise CampaignError(f'there are already codes starting with {prefix}-')
+    campaign = DiscountCampaign(name=name, prefix=prefix, code_count=count, discount_value=discount_value,
+                                expiry_date=expiry_date, issued=0, code_key=secrets.token_hex(32),
+                                code_multiplier=1, code_offset=0,  # only used by campaigns without a key
+                                created_at=datetime.now())
+    db.session.add(campaign)
+    db.session.flush()
+    return campaign
+
+def issue_codes(campaign, batch_size=BATCH_SIZE, progress=None):
+    """Insert the campaign's codes that aren't there yet, committing per chunk.
+
+    progress(issued, total) is called after every chunk. Returns how many
+    codes were inserted by this call.
+    """
+    table = DiscountCode.__table__
+    campaign_id, total = campaign.campaign_id, campaign.code_count
+    value, expiry = campaign.discount_value, campaign.expiry_date
+    start = issued = campaign.issued
+    while issued < total:
+        end = min(issued + batch_size, total)
+        rows = [{'code_name': name, 'discount_value': value, 'is_used': False, 'expiry_date': expiry}
+                for name in code_names(campaign, issued, end)]
+        db.session.connection().execute(table.insert(), rows)
+        db.session.execute(
+            update(DiscountCampaign).where(DiscountCampaign.campaign_id == campaign_id)
+            .values(issued=end).execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        del rows
+        issued = end
+        if progress:
+            progress(issued, total)
+    if issued > start:
+        code_index.invalidate()
+    return issued - start
+
+def reset_codes(prefix=None, expiry_date=None):
+    """Make used codes usable again (and move their expiry) in one UPDATE.
+
+    Only the campaign's codes with a prefix, otherwise all of them. Returns
+    how many codes changed. Counts up the codes' Data_Version, so every
+    process rebuilds its redemption filter. The caller commits, then calls
+    code_index.invalidate() (this process at once).
+    """
+    values = {'is_used': False}
+    if expiry_date is not None:
+        values['expiry_date'] = expiry_date
+    query = update(DiscountCode).values(**values).execution_options(synchronize_session=False)
+    if prefix:
+        query = query.where(_prefix_filter(prefix.upper()))
+    if expiry_date is None:
+        query = query.where(DiscountCode.is_used == True)
+    changed = db.session.execute(query).rowcount
+    if changed:
+        bump_data_version(CODES_VERSION)
+    return changed
+
+def expire_codes(prefix=None, today=None):
+    """End the codes that are still valid today, in one UPDATE. The caller commits."""
+    today = today or date.today()
+    query = update(DiscountCode)\
+        .where(DiscountCode.expiry_date >= today)\
+        .values(expiry_date=today - timedelta(days=1))\
+        .execution_options(synchronize_session=False)
+    if prefix:
+        query = query.where(_prefix_filter(prefix.upper()))
+        db.session.execute(
+            update(DiscountCampaign).where(DiscountCampaign.prefix == prefix.upper())
+            .values(expiry_date=today - timedelta(days=1)).execution_options(synchronize_session=False)
+        )
+    return db.session.execute(query).rowcount
+
+@click.command('issue-codes')
+@click.argument('name')
+@click.option('--prefix', required=True, help='Codes are named PREFIX-XXXXXXXX.')
+@click.option('--count', type=int, help='How many codes (not needed to continue a campaign).')
+@click.option('--value', type=float, help='Euros off per code.')
+@click.option('--expires', type=click.DateTime(['%Y-%m-%d']), help='Last day the codes work.')
+@click.option('--batch-size', type=int, default=BATCH_SIZE, help='Rows per insert and commit.')
+def issue_codes_command(name, prefix, count, value, expires, batch_size):
+    """Issue a campaign of discount codes (or finish an interrupted one)."""
+    campaign = db.session.execute(
+        select(DiscountCampaign).where(DiscountCampaign.prefix == prefix.upper())
+    ).scalar_one_or_none()
+    if campaign is None:
+        if count is None or value is None or expires is None:
+            raise click.UsageError('a new campaign needs --count, --value and --expires')
+        try:
+            campaign = create_campaign(name, prefix, count, value, expires.date())
+        except CampaignError as e:
+            raise click.ClickException(str(e))
+        db.session.commit()
+    elif campaign.issued >= campaign.code_count:
+        click.echo(f'campaign {campaign.prefix} is complete ({campaign.issued} codes)')
+        return
+
+    with click.progressbar(length=campaign.code_count, label=f'issuing {campaign.prefix}') as bar:
+        bar.update(campaign.issued)
+        done = [campaign.issued]
+
+        def progress(issued, total):
+            bar.update(issued - done[0])
+            done[0] = issued
+
+        added = issue_codes(campaign, batch_size, progress)
+    click.echo(f'{added} codes issued')
+
+@click.command('reset-codes')
+@click.option('--prefix', help='Only this campaign.')
+@click.option('--expires', type=click.DateTime(['%Y-%m-%d']), help='New last day for the codes.')
+def reset_codes_command(prefix, expires):
+    """Make used discount codes usable again."""
+    changed = reset_codes(prefix, expires.date() if expires else None)
+    db.session.commit()
+    code_index.invalidate()
+    click.echo(f'{changed} codes reset')
+
+@click.command('expire-codes')
+@click.option('--prefix', help='Only this campaign.')
+def expire_codes_command(prefix):
+    """End discount codes that are still valid."""
+    changed = expire_codes(prefix)
+    db.session.commit()
+    click.echo(f'{changed} codes expired')
@@ -1,93 +1,35 @@
 # my pizza website code
-from flask import Blueprint, render_template, request, redirect, url_for, flash
-from models import db, User, Customer, Staff, Pizza, Drink, Dessert, Order, OrderItem, DiscountCode, OrderDiscount, Ingredient
-from datetime import datetime, timedelta, date
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, make_response, jsonify
+from models import db, User, Customer, Staff, Order, OrderItem, get_menu_catalog
+from datetime import datetime, date
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import text, func, case
-import random
+from sqlalchemy import select, update, func
+from markupsafe import Markup
+from delivery_scheduler import delivery_scheduler
+from order_listing import load_order_page, parse_filters, DEFAULT_PAGE_SIZE, ORDER_STATUSES
+from rollups import record_order_cancelled
+from order_service import parse_order_lines, place_order
+from driver_pool import create_emergency_driver
+from delivery_runs import release_driver
+from order_api import place_batch, validate_order, BatchError, DEFAULT_MAX_BATCH
+import intake
+from discounts import code_index
+from campaigns import reset_codes
+import cache
+from cache import cached
+import metrics
+from reports import ReportRunner, DEFAULT_WORKERS, DEFAULT_SECTION_TIMEOUT
+from driver_board import load_driver_board, load_delivery_overview, cooldown_minutes_left
+from db_pool import pool_stats
+from profiling import profiler
 
-def create_emergency_driver(postal_code):
-    # make new driver when we need one
-    try:
-        # list of driver names we can use
-        driver_names = [
-            ('Express', 'Mario'), ('Veloce', 'Luigi'), ('Rapido', 'Giuseppe'),
-            ('Sprint', 'Antonio'), ('Flash', 'Marco'), ('Turbo', 'Luca'),
-            ('Speed', 'Andrea'), ('Fast', 'Matteo'), ('Quick', 'Franco'),
-            ('Zoom', 'Roberto'), ('Rush', 'Paolo'), ('Jet', 'Simone')
-        ]
-        
-        # pick random name
-        surname, first_name = random.choice(driver_names)
-        
-        # make unique email with timestamp
-        timestamp = str(int(datetime.now().timestamp()))[-6:]  # last 6 digits
-        email = f'{first_name.lower()}.{surname.lower()}.{timestamp}@mammamiapizza.com'
-        
-        # make new user for the driver
-        new_user = User(
-            first_name=first_name,
-            last_name=surname,
-            gender='Male',  # just use male 
-            email=email,
-            phone=f'+39 380 {random.randint(1000000, 9999999)}',
-            date_of_birth=date(1990, 1, 1),  # fake birthday
-            address=f'Emergency Driver Address, Milano',
-            postal_code=postal_code,  # same area as order
-            user_type='Staff'
-        )
-        
-        db.session.add(new_user)
-        db.session.flush()  # get user id
-        
-        # make new staff record
-        new_staff = Staff(
-            user_id=new_user.user_id,
-            assigned_postal_code=postal_code,
-            is_available=True,
-            last_delivery_time=None
-        )
-        
-        db.session.add(new_staff)
-        db.session.flush()  # get staff id
-        return new_staff
-        
-    except Exception as e:
-        return None
-
-def update_delivery_statuses():
-    # update order status automatically
-    try:
-        current_time = datetime.now()
-        
-        # change "In Progress" to "Out for Delivery" after 30 seconds
-        in_progress_orders = Order.query.filter_by(delivery_status='In Progress').all()
-        for order in in_progress_orders:
-            if order.created_at and (current_time - order.created_at).total_seconds() >= 30:  # 30 seconds
-                order.delivery_status = 'Out for Delivery'
-                db.session.add(order)
-        
-        # change "Out for Delivery" to "Delivered" after 2 minutes
-        # and let driver work again
-        out_for_delivery_orders = Order.query.filter_by(delivery_status='Out for Delivery').all()
-        for order in out_for_delivery_orders:
-            if order.created_at and (current_time - order.created_at).total_seconds() >= 120:  # 2 minutes
-                order.delivery_status = 'Delivered'
-                db.session.add(order)
-                
-                # make driver available again
-                if order.staff_id:
-                    staff = Staff.query.get(order.staff_id)
-                    if staff:
-                        staff.is_available = True
-                        staff.last_delivery_time = current_time
-                        db.session.add(staff)
-        
-        db.session.commit()
-        
-    except Exception as e:
-        db.session.rollback()
-        print(f"Error updating delivery statuses: {e}")
+def menu_section(name, catalog, ordering=False):
+    # rendered pizza/drink/dessert section (templates/menu_<name>.html), only
+    # rendered again when the menu changed
+    def render():
+        return render_template(f'menu_{name}.html', pizzas=catalog.pizzas, drinks=catalog.drinks,
+                               desserts=catalog.desserts, ordering=ordering)
+    return Markup(cached('menu_fragments', (name, ordering, catalog.version), render))
 
 # different parts of website
 users_bp = Blueprint('users', __name__)      # user stuff
@@ -111,52 +53,70 @@ def user_detail(user_id):
 @products_bp.route('/products')
 def show_menu():
     # show pizza menu for ordering
-    # Get all the food we sell
-    pizzas = Pizza.query.all()
-    drinks = Drink.query.all() 
-    desserts = Dessert.query.all()
+    # Get all the food we sell (prices and diet labels are precomputed)
+    catalog = get_menu_catalog()
+    
+    # The page also lists the customers, so it changes when one is added
+    customer_count, last_customer_id = db.session.execute(
+        select(func.count(Customer.customer_id), func.max(Customer.customer_id))
+    ).one()
     
-    # Get list of customers so they can place orders - fix the tuple unpacking issue
-    customers = []
-    all_customers = Customer.query.all()
-    for customer in all_customers:
-        user = User.query.get(customer.user_id)
-        if user:  # make sure user exists
-            customers.append((customer, user))
+    def render():
+        # Customers with their names in one query, for the order form
+        customers = db.session.execute(
+            select(Customer, User).join(User, User.user_id == Customer.user_id)
+            .order_by(Customer.customer_id)
+        ).all()
+        return render_template('menu.html',
+                               pizza_section=menu_section('pizzas', catalog, ordering=True),
+                               drink_section=menu_section('drinks', catalog),
+                               dessert_section=menu_section('desserts', catalog),
+                               customers=customers)
     
-    return render_template('menu.html', 
-                         pizzas=pizzas, 
-                         drinks=drinks, 
-                         desserts=desserts, 
-                         customers=customers)
+    # Browsers that have this page already get a 304 without any rendering
+    return cache.conditional(f'menu-{catalog.etag}-{customer_count}-{last_customer_id}',
+                             catalog.loaded_at, render, private=True)
 
 @products_bp.route('/pizzas')
 def show_pizzas():
     # just show pizzas
-    pizzas = Pizza.query.all()
-    return render_template('pizzas.html', pizzas=pizzas)
+    catalog = get_menu_catalog()
+    return cache.conditional(f'pizzas-{catalog.etag}', catalog.loaded_at,
+                             lambda: render_template('pizzas.html',
+                                                     pizza_section=menu_section('pizzas', catalog, ordering=False)))
 
 # order pages
 @orders_bp.route('/orders')
 def show_orders():
-    # show all orders
-    # Update delivery statuses automatically
-    update_delivery_statuses()
+    # show orders one page at a time, newest first
+    filters = parse_filters(request.args)
+    cursor = request.args.get('cursor') or None
+    direction = request.args.get('direction', 'next')
+    page_size = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
     
-    # Get orders with customer information
-    orders = db.session.query(Order, Customer, User)\
-        .join(Customer, Order.customer_id == Customer.customer_id)\
-        .join(User, Customer.user_id == User.user_id)\
-        .order_by(Order.created_at.desc()).all()
+    # Get one page of orders with customer information
+    try:
+        page = load_order_page(filters, cursor, direction, page_size)
+    except ValueError:
+        flash('That page link is no longer valid - showing the newest orders.', 'error')
+        page = load_order_page(filters, None, 'next', page_size)
     
-    return render_template('orders.html', orders=orders)
+    # filters as they go back into the page links
+    filter_args = {key: (value.strftime('%Y-%m-%d') if isinstance(value, datetime) else value)
+                   for key, value in filters.items()}
+    if 'limit' in request.args:
+        filter_args['limit'] = page_size
+    
+    return render_template('orders.html',
+                         orders=page.orders,
+                         next_cursor=page.next_cursor,
+                         prev_cursor=page.prev_cursor,
+                         filters=filter_args,
+                         statuses=ORDER_STATUSES)
 
 @orders_bp.route('/orders/<int:order_id>')
 def order_detail(order_id):
     # show order details
-    # Update delivery statuses automatically
-    update_delivery_statuses()
-    
     # Get the order
     order = Order.query.get_or_404(order_id)
     
@@ -185,6 +145,9 @@ def create_order():
         flash('Please select a customer!', 'error')
         return redirect(url_for('products.show_menu'))
     
+    # Time each stage of the order (see metrics.py)
+    timer = metrics.StageTimer()
+    
     # Start database transaction explicitly
     try:
         db.session.begin()
@@ -193,345 +156,161 @@ def create_order():
         customer = Customer.query.get(customer_id)
         user = User.query.get(customer.user_id if customer else None)
         
-        # Create a new order
-        new_order = Order()
-        new_order.customer_id = customer_id
-        new_order.delivery_status = 'Pending'
-        new_order.discount_amount = 0.00
-        
-        db.session.add(new_order)
-        db.session.flush()  # Save to get order ID
-        
-        # Add items to the order
-        total_price = 0.00
-        pizza_count = 0
-        has_items = False
-        
-        # Add pizzas with validation
-        for pizza in Pizza.query.all():
-            quantity = request.form.get(f'pizza_{pizza.pizza_id}')
-            if quantity and int(quantity) > 0:
-                quantity = int(quantity)
-                pizza_count += quantity
-                has_items = True
-                
-                # Calculate price for this pizza type
-                price_per_pizza = float(pizza.final_price)
-                item_total = price_per_pizza * quantity
-                total_price += item_total
-                
-                # Create order item
-                order_item = OrderItem()
-                order_item.order_id = new_order.order_id
-                order_item.item_type = 'Pizza'
-                order_item.pizza_id = pizza.pizza_id
-                order_item.quantity = quantity
-                order_item.total_price = item_total
-                db.session.add(order_item)
-        
-        # Add drinks
-        for drink in Drink.query.all():
-            quantity = request.form.get(f'drink_{drink.drink_id}')
-            if quantity and int(quantity) > 0:
-                quantity = int(quantity)
-                has_items = True
-                
-                # Calculate price for this drink type
-                item_total = float(drink.price) * quantity
-                total_price += item_total
-                
-                # Create order item
-                order_item = OrderItem()
-                order_item.order_id = new_order.order_id
-                order_item.item_type = 'Drink'
-                order_item.drink_id = drink.drink_id
-                order_item.quantity = quantity
-                order_item.total_price = item_total
-                db.session.add(order_item)
-        
-        # Add desserts
-        for dessert in Dessert.query.all():
-            quantity = request.form.get(f'dessert_{dessert.dessert_id}')
-            if quantity and int(quantity) > 0:
-                quantity = int(quantity)
-                has_items = True
-                
-                # Calculate price for this dessert type
-                item_total = float(dessert.price) * quantity
-                total_price += item_total
-                
-                # Create order item
-                order_item = OrderItem()
-                order_item.order_id = new_order.order_id
-                order_item.item_type = 'Dessert'
-                order_item.dessert_id = dessert.dessert_id
-                order_item.quantity = quantity
-                order_item.total_price = item_total
-                db.session.add(order_item)
+        # Work out what was ordered from the submitted fields only
+        catalog = get_menu_catalog()
+        lines = parse_order_lines(request.form, catalog)
+        timer.lap('lookup')
         
         # Check if any items were added
-        if not has_items:
+        if not lines:
+            metrics.order_rollbacks.inc('no_items')
+            timer.done('rejected')
             flash('Please add at least one item to your order!', 'error')
             return redirect(url_for('products.show_menu'))
         
-        # Calculate discounts
-        total_discount = 0.00
-        discount_messages = []
+        # In queue mode a worker places it a moment later (see intake.py)
+        if current_app.config.get('ORDER_INTAKE_ASYNC'):
+            return _queue_form_order(customer, lines, discount_code, timer)
         
-        # Loyalty discount (10% off for customers with 10+ pizzas, then reset counter)
-        loyalty_discount_applied = False
-        if customer.is_loyal_customer():
-            loyalty_discount = total_price * 0.10
-            total_discount += loyalty_discount
-            discount_messages.append(f'Loyalty discount: €{loyalty_discount:.2f} (10% off for {customer.total_pizzas_ordered} pizzas ordered!)')
-            loyalty_discount_applied = True
-        
-        # Birthday discount (free cheapest pizza + free drink if ordered)
-        if user.is_birthday_today():
-            birthday_discount = 0.00
-            birthday_items = []
-            
-            # Find cheapest pizza in order and give it for free
-            pizza_items = OrderItem.query.filter_by(order_id=new_order.order_id, item_type='Pizza').all()
-            if pizza_items:
-                cheapest_pizza_price = min(float(item.total_price) / item.quantity for item in pizza_items)
-                birthday_discount += cheapest_pizza_price
-                birthday_items.append(f'Free cheapest pizza: €{cheapest_pizza_price:.2f}')
-            
-            # Give one free drink if drinks are ordered
-            drink_items = OrderItem.query.filter_by(order_id=new_order.order_id, item_type='Drink').all()
-            if drink_items:
-                # Find cheapest drink and give one for free
-                cheapest_drink_price = min(float(item.total_price) / item.quantity for item in drink_items)
-                birthday_discount += cheapest_drink_price
-                birthday_items.append(f'Free drink: €{cheapest_drink_price:.2f}')
-            
-            if birthday_items:
-                discount_messages.append(f'Happy Birthday {user.first_name}! {", ".join(birthday_items)}')
-            
-            total_discount += birthday_discount
-        
-        # Discount code
-        if discount_code:
-            code = DiscountCode.query.filter_by(code_name=discount_code).first()
-            if code and code.is_still_valid():
-                code_discount = float(code.discount_value)
-                total_discount += code_discount
-                discount_messages.append(f'Discount code "{discount_code}": €{code_discount:.2f} off')
-                
-                # Mark code as used
-                code.is_used = True
-                db.session.add(code)
-            else:
-                discount_messages.append(f'Invalid or expired discount code: {discount_code}')
-        
-        # Assign delivery driver
-        try:
-            # Find an available driver for this postal code area
-            driver = Staff.query.join(User).filter(
-                Staff.assigned_postal_code == user.postal_code,
-                Staff.is_available == True
-            ).first()
-            
-            # Check if driver can deliver now (30-minute rule)
-            if driver and driver.can_deliver_now():
-                # Assign existing available driver
-                new_order.staff_id = driver.staff_id
-                new_order.delivery_status = 'In Progress'
-                driver.is_available = False
-                driver.last_delivery_time = datetime.now()
-                
-                driver_user = User.query.get(driver.user_id)
-                discount_messages.append(f'Driver assigned: {driver_user.get_full_name()}')
-            else:
-                # No available driver - create a new one
-                new_driver_created = create_emergency_driver(user.postal_code)
-                
-                if new_driver_created:
-                    # Assign the newly created driver
-                    new_order.staff_id = new_driver_created.staff_id
-                    new_order.delivery_status = 'In Progress'
-                    new_driver_created.is_available = False
-                    new_driver_created.last_delivery_time = datetime.now()
-                    
-                    new_driver_user = User.query.get(new_driver_created.user_id)
-                    discount_messages.append(f'NEW driver created and assigned: {new_driver_user.get_full_name()} for area {user.postal_code}')
-        except Exception as e:
-            discount_messages.append(f'Driver assignment error: {str(e)}')
-        
-        # Finalize the order
-        # Make sure discount doesn't exceed total
-        if total_discount > total_price:
-            total_discount = total_price
-        
-        final_total = total_price - total_discount
-        new_order.discount_amount = total_discount
-        new_order.final_total = final_total
-        customer.total_pizzas_ordered += pizza_count
-        
-        # Reset loyalty counter if loyalty discount was applied
-        if loyalty_discount_applied:
-            customer.total_pizzas_ordered = 0
-        
-        # Final validation before commit
-        if customer.total_pizzas_ordered < 0:
-            raise ValueError("Invalid customer pizza count after update")
+        # Price, discount and dispatch it (see order_service.py)
+        placed = place_order(customer, user, lines, discount_code, timer=timer)
+        new_order = placed.order
         
         # Save everything in transaction
-        db.session.add(new_order)
-        db.session.add(customer)
         db.session.commit()
+        timer.lap('commit')
+        metrics.orders_created.inc()
+        timer.done('created')
+        
+        # Dashboards have to show the new order (and maybe a new driver)
+        cache.invalidate(cache.ORDER_CREATED)
+        if placed.new_driver:
+            cache.invalidate(cache.DRIVER_CREATED)
+        
+        # Let the background scheduler move the order along from here
+        delivery_scheduler.order_placed(new_order.order_id, new_order.created_at, new_order.staff_id)
         
         # Show success message
         success_message = f'Order #{new_order.order_id} created! Total: €{new_order.final_total:.2f}'
-        if total_discount > 0:
-            success_message += f' (Saved: €{total_discount:.2f})'
+        if placed.total_discount > 0:
+            success_message += f' (Saved: €{placed.total_discount:.2f})'
         
         flash(success_message, 'success')
-        for message in discount_messages:
+        for message in placed.messages:
             flash(message, 'info')
         
         return redirect(url_for('orders.order_detail', order_id=new_order.order_id))
         
     except Exception as e:
         db.session.rollback()
+        metrics.order_rollbacks.inc(metrics.rollback_cause(e))
+        timer.done('failed')
         flash(f'Order failed - all changes rolled back: {str(e)}', 'error')
         return redirect(url_for('products.show_menu'))
 
-@orders_bp.route('/reports')
-def show_reports():
-    """Enhanced Business Reports Dashboard with detailed analytics"""
+def _queue_form_order(customer, lines, discount_code, timer):
+    # the order form in queue mode: only write the order to the intake queue
+    if customer is None:
+        raise ValueError(f'customer {request.form.get("customer_id")} does not exist')
     try:
-        last_month = datetime.now() - timedelta(days=30)
-
-        # Undelivered Orders (using view if available, fallback to query) 
-        try:
-            undelivered_orders = db.session.execute(text("""
-                SELECT order_id, customer_name, delivery_status,
-                       CONCAT(TIMESTAMPDIFF(MINUTE, created_at, NOW()), ' mins') AS waiting_time
-                FROM undelivered_orders
-            """)).fetchall()
-        except:
-            # Fallback if view doesn't exist
-            undelivered_orders = db.session.query(
-                Order.order_id,
-                func.concat(User.first_name, ' ', User.last_name).label('customer_name'),
-                Order.delivery_status,
-                func.concat(func.timestampdiff(text('MINUTE'), Order.created_at, func.now()), ' mins').label('waiting_time')
-            ).join(Customer, Customer.customer_id == Order.customer_id)\
-             .join(User, User.user_id == Customer.user_id)\
-             .filter(Order.delivery_status.in_(['Pending', 'In Progress', 'Out for Delivery'])).all()
-
-        # ---  Top 3 Pizzas Sold (last 30 days) 
-        top_pizzas = (
-            db.session.query(
-                Pizza.name.label('name'),
-                func.sum(OrderItem.quantity).label('orders'),
-                func.sum(OrderItem.total_price).label('revenue')
-            )
-            .join(OrderItem, OrderItem.pizza_id == Pizza.pizza_id)
-            .join(Order, Order.order_id == OrderItem.order_id)
-            .filter(
-                OrderItem.item_type == 'Pizza',
-                Order.created_at >= last_month
-            )
-            .group_by(Pizza.pizza_id, Pizza.name)
-            .order_by(func.sum(OrderItem.quantity).desc())
-            .limit(3)
-            .all()
-        )
-
-        # --- Earnings by Gender ---
-        gender_earnings = (
-            db.session.query(
-                func.coalesce(User.gender, 'Other').label('gender'),
-                func.count(Order.order_id).label('orders'),
-                func.sum(Order.final_total).label('revenue')
-            )
-            .join(Customer, Customer.customer_id == Order.customer_id)
-            .join(User, User.user_id == Customer.user_id)
-            .filter(Order.created_at >= last_month)
-            .group_by(User.gender)
-            .all()
-        )
-
-        # --- Earnings by Age Group ---
-        age_diff = func.timestampdiff(text('YEAR'), User.date_of_birth, func.curdate())
-
-        age_group_earnings = (
-            db.session.query(
-                case(
-                    (age_diff < 20, 'Under 20'),
-                    ((age_diff >= 20) & (age_diff <= 29), '20-29'),
-                    ((age_diff >= 30) & (age_diff <= 39), '30-39'),
-                    ((age_diff >= 40) & (age_diff <= 49), '40-49'),
-                    (age_diff >= 50, '50+'),
-                    else_='Unknown'
-                ).label('age_range'),
-                func.count(Order.order_id).label('orders'),
-                func.sum(Order.final_total).label('revenue')
-            )
-            .join(Customer, Customer.customer_id == Order.customer_id)
-            .join(User, User.user_id == Customer.user_id)
-            .filter(Order.created_at >= last_month)
-            .group_by('age_range')
-            .all()
-        )
+        entry = intake.enqueue(customer.customer_id, lines, discount_code,
+                               max_depth=current_app.config.get('ORDER_INTAKE_MAX_DEPTH', intake.DEFAULT_MAX_DEPTH))
+    except intake.QueueFull:
+        db.session.rollback()
+        timer.done('rejected')
+        flash('We are very busy right now, please try again in a minute.', 'error')
+        return redirect(url_for('products.show_menu'))
+    db.session.commit()
+    timer.done('queued')
+    intake.intake_workers.notify()
+    flash(f'Order received (intake #{entry.intake_id}), it will show up in the order list in a moment.', 'success')
+    return redirect(url_for('orders.show_orders'))
 
-        # --- Earnings by Postal Code ---
-        postal_code_earnings = (
-            db.session.query(
-                User.postal_code.label('postal_code'),
-                func.count(Order.order_id).label('orders'),
-                func.sum(Order.final_total).label('revenue')
-            )
-            .join(Customer, Customer.customer_id == Order.customer_id)
-            .join(User, User.user_id == Customer.user_id)
-            .filter(Order.created_at >= last_month)
-            .group_by(User.postal_code)
-            .order_by(func.sum(Order.final_total).desc())
-            .limit(10)  # Top 10 postal codes
-            .all()
-        )
+@orders_bp.route('/api/orders/intake', methods=['POST'])
+def queue_order():
+    """Accept one JSON order into the intake queue and answer right away (see intake.py)"""
+    customer_id, lines, discount_code, errors = validate_order(request.get_json(silent=True), get_menu_catalog())
+    if not errors and db.session.get(Customer, customer_id) is None:
+        errors = [f'customer {customer_id} does not exist']
+    if errors:
+        metrics.intake_refused.inc('invalid')
+        return jsonify({'status': 'rejected', 'errors': errors}), 400
+    try:
+        entry = intake.enqueue(customer_id, lines, discount_code,
+                               max_depth=current_app.config.get('ORDER_INTAKE_MAX_DEPTH', intake.DEFAULT_MAX_DEPTH))
+    except intake.QueueFull as e:
+        db.session.rollback()
+        response = jsonify({'status': 'refused', 'errors': [str(e)]})
+        response.headers['Retry-After'] = str(intake.RETRY_AFTER)
+        return response, 503
+    db.session.commit()
+    intake.intake_workers.notify()
+    status_url = url_for('orders.queued_order_status', intake_id=entry.intake_id)
+    response = jsonify({'intake_id': entry.intake_id, 'status': 'Queued', 'status_url': status_url})
+    response.headers['Location'] = status_url
+    return response, 202
 
-        # ---  Customer Statistics ---
-        total_customers = Customer.query.count()
-        loyalty_customers = Customer.query.filter(Customer.total_pizzas_ordered >= 10).count()
+@orders_bp.route('/api/orders/intake/<int:intake_id>')
+def queued_order_status(intake_id):
+    """Poll what happened to a queued order"""
+    status = intake.intake_status(intake_id)
+    if status is None:
+        return jsonify({'error': f'no intake entry {intake_id}'}), 404
+    return jsonify(status)
 
-        # --- Monthly Revenue ---
-        monthly_revenue = (
-            db.session.query(func.sum(Order.final_total))
-            .filter(
-                Order.created_at >= last_month,
-                Order.delivery_status != 'Cancelled'
-            )
-            .scalar() or 0
-        )
+@orders_bp.route('/api/orders/batch', methods=['POST'])
+def create_orders_batch():
+    """Place a batch of orders from JSON, one result per order (see order_api.py)"""
+    try:
+        results, created = place_batch(request.get_json(silent=True),
+                                       max_orders=current_app.config.get('ORDER_BATCH_MAX', DEFAULT_MAX_BATCH))
+    except BatchError as e:
+        return jsonify({'error': str(e)}), e.status
+    
+    # same follow-up as a single order
+    if created:
+        cache.invalidate(cache.ORDER_CREATED)
+    if any(order.new_driver for order in created):
+        cache.invalidate(cache.DRIVER_CREATED)
+    for order in created:
+        delivery_scheduler.order_placed(order.order_id, order.created_at, order.staff_id)
+    
+    counts = {status: sum(1 for result in results if result['status'] == status)
+              for status in ('created', 'rejected', 'failed')}
+    return jsonify(dict(counts, results=results))
 
-        # Render template with all enhanced datasets
-        return render_template(
-            'reports.html',
-            undelivered_orders=undelivered_orders,
-            top_pizzas=top_pizzas,
-            gender_earnings=gender_earnings,
-            age_group_earnings=age_group_earnings,
-            postal_code_earnings=postal_code_earnings,
-            total_customers=total_customers,
-            loyalty_customers=loyalty_customers,
-            monthly_revenue=float(monthly_revenue)
-        )
-                             
-    except Exception as e:
-        flash(f'Error generating reports: {str(e)}', 'error')
-        return render_template('reports.html', 
-                             undelivered_orders=[],
-                             top_pizzas=[],
-                             gender_earnings=[],
-                             age_group_earnings=[],
-                             postal_code_earnings=[],
-                             total_customers=0,
-                             loyalty_customers=0,
-                             monthly_revenue=0.0)
+@orders_bp.route('/reports')
+def show_reports():
+    """Enhanced Business Reports Dashboard with detailed analytics"""
+    # Run all report sections side by side (see reports.py); a failing
+    # section only empties its own panel
+    runner = ReportRunner(db.engine,
+                          workers=current_app.config.get('REPORT_WORKERS', DEFAULT_WORKERS),
+                          timeout=current_app.config.get('REPORT_SECTION_TIMEOUT', DEFAULT_SECTION_TIMEOUT))
+    report = cached('reports', 'all', runner.run, keep=lambda result: not result.errors)
+    
+    for name, error in report.errors.items():
+        flash(f'Could not load {name.replace("_", " ")}: {error}', 'error')
+    
+    data = report.data
+    response = make_response(render_template(
+        'reports.html',
+        undelivered_orders=data['undelivered_orders'],
+        top_pizzas=data['top_pizzas'],
+        gender_earnings=data['gender_earnings'],
+        age_group_earnings=data['age_group_earnings'],
+        postal_code_earnings=data['postal_code_earnings'],
+        total_customers=data['customer_counts']['total_customers'],
+        loyalty_customers=data['customer_counts']['loyalty_customers'],
+        monthly_revenue=data['monthly_revenue'],
+        report_errors=report.errors,
+        report_timings=report.timings
+    ))
+    
+    # per-section timings for the browser dev tools
+    response.headers['Server-Timing'] = ', '.join(
+        f'{name};dur={took}' for name, took in report.timings.items() if took is not None)
+    return response
 
 @orders_bp.route('/orders/<int:order_id>/complete_delivery', methods=['POST'])
 def complete_delivery(order_id):
@@ -540,15 +319,27 @@ def complete_delivery(order_id):
         order = Order.query.get_or_404(order_id)
         
         if order.staff_id:
-            # Mark order as delivered
-            order.delivery_status = 'Delivered'
+            # Mark order as delivered, unless it was delivered or cancelled
+            # in the meantime (a cancelled order is out of the rollups already)
+            completed = db.session.execute(
+                update(Order)
+                .where(Order.order_id == order_id,
+                       Order.delivery_status.in_(['Pending', 'In Progress', 'Out for Delivery']))
+                .values(delivery_status='Delivered')
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not completed:
+                db.session.rollback()
+                flash(f'Order #{order_id} is already {order.delivery_status.lower()}', 'error')
+                return redirect(url_for('orders.order_detail', order_id=order_id))
             
-            # Make driver available again (but with 30 minute cooldown)
+            # Make driver available again (but with 30 minute cooldown),
+            # unless the rest of their delivery run is still out
             driver = Staff.query.get(order.staff_id)
-            driver.last_delivery_time = datetime.now()
-            driver.is_available = True
+            release_driver(driver.staff_id)
             
             db.session.commit()
+            cache.invalidate(cache.DELIVERY_COMPLETED)
             
             driver_user = User.query.get(driver.user_id)
             flash(f'Delivery completed by {driver_user.get_full_name()}!', 'success')
@@ -561,46 +352,61 @@ def complete_delivery(order_id):
     
     return redirect(url_for('orders.order_detail', order_id=order_id))
 
+@orders_bp.route('/orders/<int:order_id>/cancel', methods=['POST'])
+def cancel_order(order_id):
+    """Cancel an order that has not been delivered yet"""
+    try:
+        order = Order.query.get_or_404(order_id)
+        
+        # only cancel if nobody delivered or cancelled it in the meantime
+        cancelled = db.session.execute(
+            update(Order)
+            .where(Order.order_id == order_id,
+                   Order.delivery_status.in_(['Pending', 'In Progress', 'Out for Delivery']))
+            .values(delivery_status='Cancelled')
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        
+        if cancelled:
+            # Take it out of the report rollups and let the driver go
+            record_order_cancelled(order)
+            if order.staff_id:
+                release_driver(order.staff_id, delivered=False)
+            db.session.commit()
+            cache.invalidate(cache.ORDER_CANCELLED)
+            flash(f'Order #{order_id} cancelled', 'success')
+        else:
+            db.session.rollback()
+            flash(f'Order #{order_id} can no longer be cancelled', 'error')
+    
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error cancelling order: {str(e)}', 'error')
+    
+    return redirect(url_for('orders.order_detail', order_id=order_id))
+
 @orders_bp.route('/delivery-status')
 def delivery_status():
     """Show which drivers are available and current delivery progress"""
     try:
-        # Update delivery statuses automatically
-        update_delivery_statuses()
-        
-        # Get all delivery staff with their information
+        # Get all delivery staff with their current order (one query)
+        now = datetime.now()
         staff_list = []
-        all_staff = Staff.query.join(User).all()
         
-        for staff in all_staff:
-            user = User.query.get(staff.user_id)
-            
+        board = cached('driver_board', 'all', load_driver_board)
+        for driver in board:
             # Check availability status
-            if staff.can_deliver_now():
-                status = 'Available'
+            minutes_left = cooldown_minutes_left(driver.last_delivery_time, now)
+            if minutes_left > 0:
+                status = f'Unavailable for {minutes_left} more minutes'
             else:
-                if staff.last_delivery_time:
-                    minutes_left = max(0, 30 - int((datetime.now() - staff.last_delivery_time).total_seconds() / 60))
-                    if minutes_left > 0:
-                        status = f'Unavailable for {minutes_left} more minutes'
-                    else:
-                        status = 'Available'
-                else:
-                    status = 'Available'
-            
-            # Find current order assigned to this staff member
-            current_order = Order.query.filter(
-                Order.staff_id == staff.staff_id,
-                Order.delivery_status.in_(['In Progress', 'Out for Delivery'])
-            ).first()
+                status = 'Available'
             
             current_order_info = None
-            if current_order:
-                customer = Customer.query.get(current_order.customer_id)
-                customer_user = User.query.get(customer.user_id)
-                
-                # Calculate time since order started
-                time_elapsed = (datetime.now() - current_order.created_at).total_seconds() / 60
+            if driver.order_id:
+                # Calculate time since the driver got the order (the
+                # scheduler's steps count from there, see delivery_scheduler.py)
+                time_elapsed = (now - driver.order_dispatched_at).total_seconds() / 60
                 
                 # Determine expected status progression
                 if time_elapsed < 0.5:  # Less than 30 seconds
@@ -611,36 +417,28 @@ def delivery_status():
                     expected_next_status = "Should be delivered (updating...)"
                 
                 current_order_info = {
-                    'order_id': current_order.order_id,
-                    'customer_name': customer_user.get_full_name(),
-                    'customer_address': customer_user.address,
-                    'delivery_status': current_order.delivery_status,
+                    'order_id': driver.order_id,
+                    'customer_name': driver.customer_name,
+                    'customer_address': driver.customer_address,
+                    'delivery_status': driver.order_status,
                     'time_elapsed': int(time_elapsed),
                     'expected_next_status': expected_next_status
                 }
             
             staff_info = {
-                'staff_id': staff.staff_id,
-                'staff_name': user.get_full_name(),
-                'phone': user.phone,
-                'assigned_postal_code': staff.assigned_postal_code,
-                'is_available': staff.is_available,
-                'last_delivery_time': staff.last_delivery_time,
+                'staff_id': driver.staff_id,
+                'staff_name': driver.full_name,
+                'phone': driver.phone,
+                'assigned_postal_code': driver.assigned_postal_code,
+                'is_available': driver.is_available,
+                'last_delivery_time': driver.last_delivery_time,
                 'availability_status': status,
                 'current_order': current_order_info
             }
             staff_list.append(staff_info)
         
-        # Get orders by status for overview
-        pending_orders = Order.query.filter_by(delivery_status='Pending').count()
-        in_progress_orders = Order.query.filter_by(delivery_status='In Progress').count()
-        out_for_delivery_orders = Order.query.filter_by(delivery_status='Out for Delivery').count()
-        
-        delivery_overview = {
-            'pending': pending_orders,
-            'in_progress': in_progress_orders,
-            'out_for_delivery': out_for_delivery_orders
-        }
+        # Get orders by status for overview (one GROUP BY)
+        delivery_overview = cached('delivery_overview', 'all', load_delivery_overview)
         
         return render_template('delivery_status.html', 
                              staff_list=staff_list, 
@@ -654,16 +452,12 @@ def delivery_status():
 def reset_discount_codes():
     """Reset all discount codes so they can be used again (for testing)"""
     try:
-        # Get all discount codes and make them valid again
-        codes = DiscountCode.query.all()
-        count = 0
-        
-        for code in codes:
-            code.is_used = False
-            code.expiry_date = date(2026, 12, 31)  # Set expiry to end of 2026
-            count += 1
+        # one UPDATE for all of them, however many campaign codes there are
+        count = reset_codes(expiry_date=date(2026, 12, 31))  # Set expiry to end of 2026
         
         db.session.commit()
+        # the codes are live again, the redemption filter has to know
+        code_index.invalidate()
         flash(f'Reset {count} discount codes - they can all be used again!', 'success')
         
     except Exception as e:
@@ -676,52 +470,34 @@ def reset_discount_codes():
 def show_drivers():
     """Show all delivery drivers and their status"""
     try:
-        # Get all staff with their user information
-        drivers = db.session.query(Staff, User)\
-            .join(User, Staff.user_id == User.user_id)\
-            .filter(User.user_type == 'Staff')\
-            .order_by(Staff.assigned_postal_code, User.first_name).all()
-        
+        # Get all staff with their user information and order counts (one query)
+        now = datetime.now()
         driver_list = []
-        for staff, user in drivers:
+        
+        board = cached('driver_board', 'staff_by_area',
+                       lambda: load_driver_board(staff_only=True, by_area=True))
+        for driver in board:
             # Check availability status
-            if staff.can_deliver_now():
+            minutes_left = cooldown_minutes_left(driver.last_delivery_time, now)
+            if minutes_left > 0:
+                status = f'Unavailable ({minutes_left}m left)'
+                status_class = 'warning'
+            else:
                 status = 'Available'
                 status_class = 'success'
-            else:
-                if staff.last_delivery_time:
-                    minutes_left = max(0, 30 - int((datetime.now() - staff.last_delivery_time).total_seconds() / 60))
-                    if minutes_left > 0:
-                        status = f'Unavailable ({minutes_left}m left)'
-                        status_class = 'warning'
-                    else:
-                        status = 'Available'
-                        status_class = 'success'
-                else:
-                    status = 'Available'
-                    status_class = 'success'
-            
-            # Check if this is an emergency driver (created automatically)
-            is_emergency = '@mammamiapizza.com' in user.email
-            
-            # Get current orders
-            current_orders = Order.query.filter(
-                Order.staff_id == staff.staff_id,
-                Order.delivery_status.in_(['In Progress', 'Out for Delivery'])
-            ).count()
             
             driver_info = {
-                'staff_id': staff.staff_id,
-                'name': user.get_full_name(),
-                'email': user.email,
-                'phone': user.phone,
-                'postal_code': staff.assigned_postal_code,
-                'is_available': staff.is_available,
+                'staff_id': driver.staff_id,
+                'name': driver.full_name,
+                'email': driver.email,
+                'phone': driver.phone,
+                'postal_code': driver.assigned_postal_code,
+                'is_available': driver.is_available,
                 'status': status,
                 'status_class': status_class,
-                'current_orders': current_orders,
-                'is_emergency': is_emergency,
-                'last_delivery': staff.last_delivery_time
+                'current_orders': driver.active_orders,
+                'is_emergency': driver.is_emergency,
+                'last_delivery': driver.last_delivery_time
             }
             driver_list.append(driver_info)
         
@@ -731,6 +507,36 @@ def show_drivers():
         flash(f'Error loading drivers: {str(e)}', 'error')
         return redirect(url_for('orders.show_orders'))
 
+@orders_bp.route('/admin/cache-stats')
+def show_cache_stats():
+    """Hit/miss counters of the dashboard result caches"""
+    return jsonify(dict(cache.cache_stats(), discount_code_index=code_index.stats()))
+
+@orders_bp.route('/admin/pool-stats')
+def show_pool_stats():
+    """Connection pool checkout waits and churn"""
+    return jsonify(pool_stats(db.engine))
+
+@orders_bp.route('/metrics')
+def show_metrics():
+    """Order pipeline metrics and pool numbers for Prometheus"""
+    stats = pool_stats(db.engine)
+    gauges = [(f'mamma_mia_db_pool_{name}', f'Connection pool {name.replace("_", " ")}.', stats[name])
+              for name in ('size', 'checked_in', 'checked_out', 'overflow') if name in stats]
+    gauges.append(('mamma_mia_intake_queue_depth', 'Orders waiting in the intake queue.', intake.queue_depth()))
+    response = make_response(metrics.registry.render(gauges))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+@orders_bp.route('/admin/profile')
+def show_profile():
+    """Recent requests per endpoint: time, SQL statements and N+1 loops"""
+    endpoints = profiler.by_endpoint()
+    if request.args.get('format') == 'json':
+        return jsonify(endpoints)
+    return render_template('profile.html', endpoints=endpoints,
+                           slow_request_ms=profiler.slow_request_ms, n_plus_one=profiler.n_plus_one)
+
 @orders_bp.route('/admin/create-driver', methods=['POST'])
 def manual_create_driver():
     """Manually create a new driver for testing"""
@@ -741,6 +547,7 @@ def manual_create_driver():
         
         if new_driver:
             db.session.commit()
+            cache.invalidate(cache.DRIVER_CREATED)
             new_user = User.query.get(new_driver.user_id)
             flash(f'✅ New driver created: {new_user.get_full_name()} for area {postal_code}', 'success')
         else:
@@ -0,0 +1,306 @@
+# fills the database with made-up but realistic looking data, for
+# benchmarks and load tests
+#
+# The same seed always gives the same data. Orders follow a week/day shape
+# (lunch and dinner peaks, busy Fridays and Saturdays, slow growth over the
+# period), customers and drivers are spread over the Milano postal codes with
+# the central ones busiest, and a few customers order far more than the rest.
+# Loyalty counters and discounts are worked out the same way create_order
+# does, so the data passes the same consistency checks as real orders.
+#
+#   flask --app app generate-data --scale medium
+import random
+from bisect import bisect
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+import click
+from sqlalchemy import select, insert, update, func
+
+from models import (db, User, Customer, Staff, Ingredient, Pizza, PizzaIngredient, Drink, Dessert,
+                    Order, OrderItem, DiscountCode, LoyaltyLedger, get_menu_catalog)
+from rollups import rebuild_rollups
+
+SCALES = {
+    'tiny': dict(customers=200, drivers=40, orders=2000, days=30, codes=50),
+    'small': dict(customers=5000, drivers=200, orders=50000, days=90, codes=500),
+    'medium': dict(customers=100000, drivers=1000, orders=1000000, days=365, codes=10000),
+    'large': dict(customers=1000000, drivers=4000, orders=5000000, days=730, codes=100000),
+}
+
+# rows per INSERT
+BATCH = 5000
+
+# Milano 20121 - 20162, most central first
+POSTAL_CODES = [f'201{n:02d}' for n in range(21, 63)]
+POSTAL_WEIGHTS = [1 / (rank + 1) ** 0.7 for rank in range(len(POSTAL_CODES))]
+
+# share of the day's orders per hour, and of the week's per weekday (Monday first)
+HOUR_WEIGHTS = [0.3, 0.1, 0, 0, 0, 0, 0, 0, 0, 0, 0.2, 1,
+                6, 7, 3, 1, 1, 2, 6, 10, 11, 7, 3, 1]
+WEEKDAY_WEIGHTS = [0.8, 0.8, 0.9, 1.0, 1.4, 1.5, 1.2]
+GROWTH = 0.3  # the last day is this much busier than the first
+
+CANCELLED_SHARE = 0.03
+
+MALE_NAMES = ['Marco', 'Giuseppe', 'Antonio', 'Francesco', 'Matteo', 'Luca', 'Andrea', 'Paolo',
+              'Alessandro', 'Lorenzo', 'Davide', 'Simone', 'Federico', 'Riccardo', 'Stefano']
+FEMALE_NAMES = ['Sofia', 'Elena', 'Giulia', 'Chiara', 'Francesca', 'Martina', 'Sara', 'Alessia',
+                'Valentina', 'Anna', 'Laura', 'Giorgia', 'Silvia', 'Federica', 'Beatrice']
+LAST_NAMES = ['Rossi', 'Bianchi', 'Ferrari', 'Romano', 'Conti', 'Martini', 'De Luca', 'Galli',
+              'Ricci', 'Colombo', 'Bruno', 'Greco', 'Marino', 'Costa', 'Fontana', 'Moretti',
+              'Barbieri', 'Lombardi', 'Esposito', 'Rinaldi']
+STREETS = ['Via Roma', 'Corso Venezia', 'Via Torino', 'Viale Monza', 'Via Brera', 'Corso Buenos Aires',
+           'Via Padova', 'Viale Papiniano', 'Via Dante', 'Corso Como']
+
+# used when the database has no menu yet (same as sql/mamma_mia_pizza-data.sql)
+BASE_INGREDIENTS = [
+    ('Mozzarella di Bufala', 2.50, 'Dairy'), ('Pomodori San Marzano', 1.20, 'Vegetable'),
+    ('Prosciutto di Parma', 4.80, 'Meat'), ('Basilico Fresco', 0.80, 'Vegetable'),
+    ('Funghi Porcini', 3.20, 'Vegetable'), ('Salame Piccante', 2.90, 'Meat'),
+    ('Olive Nere di Gaeta', 1.60, 'Vegetable'), ('Gorgonzola DOP', 3.10, 'Dairy'),
+    ('Rucola', 1.40, 'Vegetable'), ('Olio Extra Vergine', 0.95, 'Other'),
+]
+BASE_PIZZAS = [
+    ('Margherita', [2, 1, 4, 10]), ('Marinara', [2, 4, 10]), ('Prosciutto e Funghi', [2, 1, 3, 5]),
+    ('Quattro Stagioni', [2, 1, 3, 5, 7]), ('Diavola', [2, 1, 6]), ('Capricciosa', [2, 1, 3, 5, 7]),
+    ('Quattro Formaggi', [1, 8]), ('Prosciutto di Parma', [2, 1, 3, 9]),
+    ('Funghi Porcini', [2, 1, 5]), ('Vegetariana', [2, 1, 4, 5, 7, 9]),
+]
+BASE_DRINKS = [('Coca-Cola 33cl', 2.50), ('Acqua Naturale 50cl', 2.00), ('Birra Peroni 33cl', 3.50),
+               ('Vino Chianti (bicchiere)', 4.50), ('Caffe Espresso', 1.50)]
+BASE_DESSERTS = [('Tiramisu della Casa', 5.50), ('Panna Cotta', 4.80), ('Cannoli Siciliani', 5.20),
+                 ('Gelato Artigianale', 4.50)]
+
+class _Picker:
+    """Weighted random choice with the cumulative weights worked out once"""
+
+    def __init__(self, rng, items, weights):
+        self.rng = rng
+        self.items = items
+        self.cum_weights = list(accumulate(weights))
+        self.total = self.cum_weights[-1]
+
+    def __call__(self):
+        return self.items[bisect(self.cum_weights, self.rng.random() * self.total)]
+
+def _next_id(column):
+    return (db.session.execute(select(func.max(column))).scalar() or 0) + 1
+
+def _insert(model, rows):
+    for start in range(0, len(rows), BATCH):
+        db.session.execute(insert(model), rows[start:start + BATCH])
+    rows.clear()
+
+def ensure_menu():
+    # put in the base menu if there are no pizzas yet
+    if db.session.execute(select(func.count(Pizza.pizza_id))).scalar():
+        return
+    ingredients = [Ingredient(name=name, cost_per_unit=cost, category=category)
+                   for name, cost, category in BASE_INGREDIENTS]
+    db.session.add_all(ingredients)
+    db.session.flush()
+    for name, ingredient_numbers in BASE_PIZZAS:
+        pizza = Pizza(name=name, description=name)
+        db.session.add(pizza)
+        db.session.flush()
+        db.session.add_all([PizzaIngredient(pizza_id=pizza.pizza_id, ingredient_id=ingredients[n - 1].ingredient_id)
+                            for n in ingredient_numbers])
+    db.session.add_all([Drink(name=name, price=price) for name, price in BASE_DRINKS])
+    db.session.add_all([Dessert(name=name, price=price) for name, price in BASE_DESSERTS])
+    db.session.commit()
+
+def _person(rng, user_id, user_type, postal_code, today):
+    gender = rng.choices(('Male', 'Female', 'Other'), (48, 48, 4))[0]
+    first_name = rng.choice(FEMALE_NAMES if gender == 'Female' else MALE_NAMES)
+    last_name = rng.choice(LAST_NAMES)
+    age_days = rng.randint(18 * 365, 75 * 365) if user_type == 'Customer' else rng.randint(19 * 365, 45 * 365)
+    return {
+        'user_id': user_id,
+        'first_name': first_name,
+        'last_name': last_name,
+        'gender': gender,
+        'email': f"{first_name}.{last_name}.{user_id}@example.com".lower().replace(' ', ''),
+        'phone': f'+39 3{rng.randint(10, 49)} {rng.randint(1000000, 9999999)}',
+        'date_of_birth': today - timedelta(days=age_days),
+        'address': f'{rng.choice(STREETS)} {rng.randint(1, 200)}, Milano',
+        'postal_code': postal_code,
+        'user_type': user_type,
+    }
+
+def _orders_per_day(total, days, start):
+    # spread `total` orders over the days by weekday and growth, exactly
+    weights = [WEEKDAY_WEIGHTS[(start + timedelta(days=d)).weekday()] * (1 + GROWTH * d / max(days - 1, 1))
+               for d in range(days)]
+    scale = total / sum(weights)
+    counts, placed, running = [], 0, 0.0
+    for weight in weights:
+        running += weight * scale
+        count = int(round(running)) - placed
+        counts.append(count)
+        placed += count
+    return counts
+
+def generate(customers, drivers, orders, days, codes=0, seed=42, end=None, echo=None):
+    """Add generated customers, drivers, orders and discount codes.
+
+    Orders fall in the `days` days before `end` (default now) and are all
+    delivered or cancelled. Rows are added next to whatever is already in
+    the database. The daily rollups are rebuilt afterwards. Returns the
+    number of rows added per kind.
+    """
+    echo = echo or (lambda message: None)
+    rng = random.Random(seed)
+    end = (end or datetime.now()).replace(microsecond=0)
+    start_day = (end - timedelta(days=days)).date()
+    today = end.date()
+
+    ensure_menu()
+    catalog = get_menu_catalog()
+    pick_postal_code = _Picker(rng, POSTAL_CODES, POSTAL_WEIGHTS)
+    # a few pizzas sell much better than the others
+    pick_pizza = _Picker(rng, catalog.pizzas, [1 / (rank + 1) for rank in range(len(catalog.pizzas))])
+    pick_hour = _Picker(rng, list(range(24)), HOUR_WEIGHTS)
+
+    user_id = _next_id(User.user_id)
+    customer_id = _next_id(Customer.customer_id)
+    staff_id = _next_id(Staff.staff_id)
+    order_id = _next_id(Order.order_id)
+    order_item_id = _next_id(OrderItem.order_item_id)
+    code_id = _next_id(DiscountCode.code_id)
+
+    # drivers: at least one per postal code, the rest where the customers are
+    users, staff = [], []
+    drivers_by_code = {code: [] for code in POSTAL_CODES}
+    for n in range(drivers):
+        code = POSTAL_CODES[n] if n < len(POSTAL_CODES) else pick_postal_code()
+        users.append(_person(rng, user_id, 'Staff', code, today))
+        staff.append({'staff_id': staff_id, 'user_id': user_id, 'assigned_postal_code': code, 'is_available': True,
+                      'last_delivery_time': end - timedelta(minutes=rng.randint(31, 600))})
+        drivers_by_code[code].append(staff_id)
+        user_id += 1
+        staff_id += 1
+    _insert(User, users)
+    _insert(Staff, staff)
+    echo(f'{drivers} drivers')
+
+    # customers, in batches so millions fit in memory
+    first_customer = customer_id
+    customer_codes = []
+    rows = []
+    for n in range(customers):
+        code = pick_postal_code()
+        users.append(_person(rng, user_id, 'Customer', code, today))
+        rows.append({'customer_id': customer_id, 'user_id': user_id, 'total_pizzas_ordered': 0})
+        customer_codes.append(code)
+        user_id += 1
+        customer_id += 1
+        if len(rows) >= BATCH:
+            _insert(User, users)
+            _insert(Customer, rows)
+    _insert(User, users)
+    _insert(Customer, rows)
+    db.session.commit()
+    echo(f'{customers} customers')
+
+    # orders, day by day so every customer's orders come in time order
+    loyalty = [0] * customers
+    order_rows, item_rows = [], []
+    added_orders = added_items = 0
+    for day_number, count in enumerate(_orders_per_day(orders, days, start_day)):
+        day = datetime.combine(start_day + timedelta(days=day_number), datetime.min.time())
+        times = sorted(day + timedelta(hours=pick_hour(), seconds=rng.randint(0, 3599)) for _ in range(count))
+        for created_at in times:
+            # regulars: low customer numbers order much more often
+            index = int(customers * rng.random() ** 2.5)
+            lines = []
+            for _ in range(rng.choices((1, 2, 3), (60, 30, 10))[0]):
+                pizza = pick_pizza()
+                quantity = rng.choices((1, 2), (80, 20))[0]
+                lines.append(('Pizza', pizza.pizza_id, None, None, quantity, pizza.final_price * quantity))
+            if rng.random() < 0.55:
+                drink = rng.choice(catalog.drinks)
+                quantity = rng.randint(1, 2)
+                lines.append(('Drink', None, drink.drink_id, None, quantity, float(drink.price) * quantity))
+            if rng.random() < 0.25:
+                dessert = rng.choice(catalog.desserts)
+                lines.append(('Dessert', None, None, dessert.dessert_id, 1, float(dessert.price)))
+
+            # loyalty the same way as create_order: 10% off at 10+ pizzas, then start over
+            total_price = sum(line[5] for line in lines)
+            discount = 0.0
+            if loyalty[index] >= 10:
+                discount = round(total_price * 0.10, 2)
+                loyalty[index] = 0
+            else:
+                loyalty[index] += sum(line[4] for line in lines if line[0] == 'Pizza')
+
+            code = customer_codes[index]
+            order_rows.append({
+                'order_id': order_id,
+                'customer_id': first_customer + index,
+                'staff_id': rng.choice(drivers_by_code[code]) if drivers_by_code[code] else None,
+                'delivery_status': 'Cancelled' if rng.random() < CANCELLED_SHARE else 'Delivered',
+                'created_at': created_at,
+                'discount_amount': discount,
+                'final_total': round(total_price - discount, 2),
+            })
+            for item_type, pizza_id, drink_id, dessert_id, quantity, price in lines:
+                item_rows.append({'order_item_id': order_item_id, 'order_id': order_id, 'item_type': item_type,
+                                  'pizza_id': pizza_id, 'drink_id': drink_id, 'dessert_id': dessert_id,
+                                  'quantity': quantity, 'total_price': round(price, 2)})
+                order_item_id += 1
+            order_id += 1
+
+        if len(order_rows) >= BATCH:
+            added_orders += len(order_rows)
+            added_items += len(item_rows)
+            _insert(Order, order_rows)
+            _insert(OrderItem, item_rows)
+            db.session.commit()
+            echo(f'{added_orders} orders')
+    added_orders += len(order_rows)
+    added_items += len(item_rows)
+    _insert(Order, order_rows)
+    _insert(OrderItem, item_rows)
+
+    # loyalty counters where they ended up
+    counters = [{'customer_id': first_customer + index, 'total_pizzas_ordered': count}
+                for index, count in enumerate(loyalty) if count]
+    for start in range(0, len(counters), BATCH):
+        db.session.execute(update(Customer), counters[start:start + BATCH])
+    # and the ledger starts from them, like after a compaction
+    _insert(LoyaltyLedger, [{'customer_id': row['customer_id'], 'pizzas': row['total_pizzas_ordered'],
+                             'redeemed': False, 'folded': True, 'created_at': end}
+                            for row in counters])
+    db.session.commit()
+    echo(f'{added_orders} orders')
+
+    # discount codes, unused, some already expired
+    code_rows = []
+    for n in range(codes):
+        code_rows.append({'code_id': code_id, 'code_name': f'GEN{seed}-{code_id:07d}',
+                          'discount_value': rng.choice((2, 3, 5, 10)), 'is_used': False,
+                          'expiry_date': today + timedelta(days=rng.randint(-30, 365))})
+        code_id += 1
+    _insert(DiscountCode, code_rows)
+
+    rebuild_rollups()
+    db.session.commit()
+    return {'drivers': drivers, 'customers': customers, 'orders': added_orders,
+            'order_items': added_items, 'discount_codes': codes}
+
+@click.command('generate-data')
+@click.option('--scale', type=click.Choice(list(SCALES)), default='small', help='How much data to make.')
+@click.option('--customers', type=int, help='Override the number of customers.')
+@click.option('--drivers', type=int, help='Override the number of drivers.')
+@click.option('--orders', type=int, help='Override the number of orders.')
+@click.option('--days', type=int, help='Override how many days the orders cover.')
+@click.option('--seed', type=int, default=42, help='Same seed, same data.')
+def generate_data_command(scale, seed, **overrides):
+    """Fill the database with generated customers, drivers and orders."""
+    settings = dict(SCALES[scale])
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    db.create_all()
+    added = generate(seed=seed, echo=click.echo, **settings)
+    click.echo(', '.join(f'{count} {kind}' for kind, count in added.items()))
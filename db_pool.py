@@ -0,0 +1,168 @@
+# engine options from the app config, and a pool that keeps its own numbers
+#
+# Under load the first thing to run out is usually connections: requests
+# queue up waiting for the pool long before the database is busy. The
+# TimedQueuePool measures how long every checkout waited and counts the
+# connections it opened and closed (churn - a high number means the pool is
+# too small, or overflow connections keep being opened and thrown away).
+# The numbers are on /admin/pool-stats.
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+class PoolStats:
+    """Checkout wait times and connection churn of one pool"""
+
+    SLOW_CHECKOUT = 0.01  # seconds
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0   # seconds
+        self.wait_max = 0.0
+        self.slow_checkouts = 0  # waited more than SLOW_CHECKOUT
+        self.timeouts = 0
+        self.created = 0
+        self.closed = 0
+
+    def record_checkout(self, waited, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            if waited > self.SLOW_CHECKOUT:
+                self.slow_checkouts += 1
+            if timed_out:
+                self.timeouts += 1
+
+    def record_created(self):
+        with self._lock:
+            self.created += 1
+
+    def record_closed(self):
+        with self._lock:
+            self.closed += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'wait_avg_ms': round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+                'slow_checkouts': self.slow_checkouts,
+                'timeouts': self.timeouts,
+                'connections_created': self.created,
+                'connections_closed': self.closed,
+            }
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records checkout waits and opened/closed connections"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def connect(self):
+        # the whole checkout: waiting for a free connection, opening a new
+        # one, and the pre-ping
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeout:
+            self.stats.record_checkout(time.perf_counter() - started, timed_out=True)
+            raise
+        self.stats.record_checkout(time.perf_counter() - started)
+        return connection
+
+    def _create_connection(self):
+        self.stats.record_created()
+        return super()._create_connection()
+
+    def _close_connection(self, connection, *, terminate=False):
+        self.stats.record_closed()
+        return super()._close_connection(connection, terminate=terminate)
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the database in config"""
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+
+    if uri.startswith('sqlite'):
+        # timeout is how long to wait for another writer's lock
+        options['connect_args'] = {'timeout': config['DB_STATEMENT_TIMEOUT']}
+        if uri in ('sqlite://', 'sqlite:///:memory:'):
+            return options  # Flask-SQLAlchemy gives in-memory databases one shared connection
+    elif uri.startswith('mysql'):
+        options['connect_args'] = {'connect_timeout': config['DB_CONNECT_TIMEOUT']}
+
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=config['DB_POOL_SIZE'],
+        max_overflow=config['DB_MAX_OVERFLOW'],
+        pool_timeout=config['DB_POOL_TIMEOUT'],
+        pool_recycle=config['DB_POOL_RECYCLE'],
+    )
+    return options
+
+def setup_connections(engine, config):
+    # per-connection settings that can't go in the connect arguments
+    if engine.dialect.name == 'mysql':
+        timeout_ms = int(config['DB_STATEMENT_TIMEOUT'] * 1000)
+
+        @event.listens_for(engine, 'connect')
+        def set_statement_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f'SET SESSION max_execution_time = {timeout_ms}')
+            cursor.close()
+
+    elif engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:'):
+        @event.listens_for(engine, 'connect')
+        def use_wal(dbapi_connection, connection_record):
+            # readers don't block the writer (and the other way round)
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.close()
+
+@contextmanager
+def statement_timeout(conn, seconds):
+    """Let the database stop this connection's statements after `seconds`.
+
+    MySQL gets a lower max_execution_time for the session (SELECTs only, put
+    back afterwards), SQLite a progress handler that interrupts the statement
+    once the time is up. Either way the statement fails with an
+    OperationalError and the connection can be used again.
+    """
+    dialect = conn.dialect.name
+    if dialect == 'mysql':
+        previous = conn.exec_driver_sql('SELECT @@SESSION.max_execution_time').scalar()
+        conn.exec_driver_sql(f'SET SESSION max_execution_time = {int(seconds * 1000)}')
+        try:
+            yield
+        finally:
+            if not conn.invalidated:
+                conn.exec_driver_sql(f'SET SESSION max_execution_time = {int(previous)}')
+    elif dialect == 'sqlite':
+        dbapi_connection = conn.connection.dbapi_connection
+        deadline = time.monotonic() + seconds
+        dbapi_connection.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        try:
+            yield
+        finally:
+            dbapi_connection.set_progress_handler(None, 0)
+    else:
+        yield
+
+def pool_stats(engine):
+    """Pool numbers for /admin/pool-stats"""
+    pool = engine.pool
+    stats = {'pool': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_in=pool.checkedin(),
+                     checked_out=pool.checkedout(), overflow=pool.overflow())
+    if isinstance(pool, TimedQueuePool):
+        stats.update(pool.stats.as_dict())
+    return stats
@@ -0,0 +1,121 @@
+# delivery runs: several orders for one postal code on one driver
+#
+# With one order per driver every order takes a driver off the road for the
+# delivery and the 30 minute break after it, so at the Friday peak we run out
+# of drivers and call in emergency ones by the dozen. With DELIVERY_BATCHING
+# on, place_order leaves new orders Pending without a driver and the
+# delivery scheduler sends them out in runs instead:
+#
+#   - waiting orders are grouped by the customer's postal code
+#   - a run leaves when its oldest order has waited DELIVERY_BATCH_WINDOW
+#     seconds, or as soon as DELIVERY_RUN_CAPACITY orders are waiting
+#   - one driver (from dispatch, else the emergency pool) takes up to
+#     DELIVERY_RUN_CAPACITY orders; they all get the same dispatched_at, so
+#     the scheduler moves them to Out for Delivery and Delivered together
+#   - the driver is free again (and starts their break) once none of their
+#     orders is on its way anymore
+#
+# Without batching the same dispatcher, with runs of one, picks up orders
+# that are waiting because the emergency pool of their area was full.
+#
+# Simulated peak evenings, batching against one order per run:
+#   python bench_runs.py --orders 600 --capacity 4 --window 120
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, func
+
+from models import db, Order, Customer, User, Staff
+from dispatch import claim_driver
+from driver_pool import emergency_driver
+import metrics
+
+DEFAULT_WINDOW = 120       # seconds the oldest order of a run waits at most
+DEFAULT_CAPACITY = 4       # orders per run
+
+ON_THE_WAY = ('Pending', 'In Progress', 'Out for Delivery')
+
+def _waiting():
+    # placed, but nobody is bringing them yet
+    return Order.delivery_status == 'Pending', Order.staff_id.is_(None)
+
+def waiting_by_area():
+    """postal code -> (waiting orders, when the oldest one was placed)"""
+    rows = db.session.execute(
+        select(User.postal_code, func.count(Order.order_id), func.min(Order.created_at))
+        .join(Customer, Customer.customer_id == Order.customer_id)
+        .join(User, User.user_id == Customer.user_id)
+        .where(*_waiting())
+        .group_by(User.postal_code)
+    ).all()
+    return {postal_code: (count, oldest) for postal_code, count, oldest in rows}
+
+def _next_run(postal_code, capacity):
+    # the oldest waiting orders of the area, locked for this run
+    return db.session.execute(
+        select(Order.order_id, Order.created_at)
+        .join(Customer, Customer.customer_id == Order.customer_id)
+        .join(User, User.user_id == Customer.user_id)
+        .where(*_waiting(), User.postal_code == postal_code)
+        .order_by(Order.created_at, Order.order_id)
+        .limit(capacity)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+def _driver_for(postal_code, now):
+    staff_id = claim_driver(postal_code, now)
+    if staff_id:
+        return staff_id
+    emergency = emergency_driver(postal_code, now)
+    return emergency.staff_id if emergency else None
+
+def dispatch_runs(now=None, window=DEFAULT_WINDOW, capacity=DEFAULT_CAPACITY):
+    """Send out every run that is due, one driver each.
+
+    Returns a list of (staff_id, order_ids). The caller commits.
+    """
+    now = now or datetime.now()
+    due_before = now - timedelta(seconds=window)
+    runs = []
+    for postal_code, (count, oldest) in sorted(waiting_by_area().items()):
+        while count >= capacity or (count and oldest <= due_before):
+            orders = _next_run(postal_code, capacity)
+            if not orders or (len(orders) < capacity and orders[0].created_at > due_before):
+                break
+            # the driver and the orders go together or not at all
+            with db.session.begin_nested() as savepoint:
+                staff_id = _driver_for(postal_code, now)
+                if staff_id is None:
+                    savepoint.rollback()
+                    break
+                order_ids = [order.order_id for order in orders]
+                assigned = db.session.execute(
+                    update(Order)
+                    .where(Order.order_id.in_(order_ids), *_waiting())
+                    .values(staff_id=staff_id, delivery_status='In Progress', dispatched_at=now)
+                    .execution_options(synchronize_session=False)
+                ).rowcount
+                if not assigned:
+                    savepoint.rollback()
+                    break
+            runs.append((staff_id, order_ids))
+            metrics.delivery_run_orders.observe(assigned)
+            count -= len(orders)
+            oldest = orders[-1].created_at  # close enough, the loop looks again
+    return runs
+
+def release_driver(staff_id, now=None, delivered=True):
+    """Free the driver if none of their orders is on its way anymore.
+
+    delivered=False (a cancelled order) doesn't start their break. Returns
+    True if they were freed. The caller commits.
+    """
+    values = {'is_available': True}
+    if delivered:
+        values['last_delivery_time'] = now or datetime.now()
+    busy = select(Order.order_id).where(Order.staff_id == staff_id, Order.delivery_status.in_(ON_THE_WAY)).exists()
+    return db.session.execute(
+        update(Staff)
+        .where(Staff.staff_id == staff_id, ~busy)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    ).rowcount > 0
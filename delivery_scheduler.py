@@ -0,0 +1,372 @@
+# background worker that moves orders through their delivery steps
+#
+# Orders used to be advanced by update_delivery_statuses() at the start of
+# every orders/delivery page, so simple page views did writes. Now every order
+# that gets a driver is put in a deadline queue (a heap ordered by due time)
+# and a background thread wakes up exactly when the next step is due:
+#   30 seconds after dispatch:  'In Progress'      -> 'Out for Delivery'
+#   2 minutes after dispatch:   'Out for Delivery' -> 'Delivered' (+ free the driver)
+#
+# Dispatch is when the order got its driver (Orders.dispatched_at; older
+# orders without it count from created_at). Orders still waiting for a driver
+# - a delivery run with DELIVERY_BATCHING, or a full emergency pool - get a
+# DISPATCH step that hands them to delivery_runs.dispatch_runs().
+#
+# The heap only knows the orders placed in this process. Orders placed by
+# other web workers, the JSON API or `flask process-intake` are picked up by
+# a sweep every DELIVERY_SWEEP_INTERVAL seconds (and once at start): it moves
+# on everything that is overdue with advance_deliveries() and queues what is
+# still in flight, so any one running scheduler keeps every order moving.
+import heapq
+import itertools
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, select, func
+
+from models import db, Order, Staff
+import cache
+
+# seconds after the order got its driver
+OUT_FOR_DELIVERY_AFTER = 30
+DELIVERED_AFTER = 120
+
+# wait this long before trying a step again when the database fails
+RETRY_AFTER = 5
+
+# seconds between looks at the database for orders from other processes
+SWEEP_INTERVAL = 30
+
+# (from status, to status) for each step
+OUT_FOR_DELIVERY = ('In Progress', 'Out for Delivery')
+DELIVERED = ('Out for Delivery', 'Delivered')
+DISPATCH = ('Pending', 'In Progress')
+
+def dispatch_time():
+    # when an order's delivery clock started (orders from before dispatched_at: created_at)
+    return func.coalesce(Order.dispatched_at, Order.created_at)
+
+def _on_the_way():
+    # the driver still has an order that isn't delivered or cancelled
+    return select(Order.order_id).where(
+        Order.staff_id == Staff.staff_id,
+        Order.delivery_status.in_(['Pending', 'In Progress', 'Out for Delivery'])
+    ).exists()
+
+def advance_deliveries(now=None):
+    """Move every due order one or two steps with set-based statements.
+
+    Runs three statements no matter how many orders are in flight and returns
+    how many rows each one changed. The caller commits.
+
+    The UPDATEs skip the ORM's session synchronize step (no extra SELECT per
+    statement), so objects already loaded in the session are not refreshed.
+    """
+    now = now or datetime.now()
+    out_cutoff = now - timedelta(seconds=OUT_FOR_DELIVERY_AFTER)
+    delivered_cutoff = now - timedelta(seconds=DELIVERED_AFTER)
+
+    # 'In Progress' -> 'Out for Delivery' after 30 seconds
+    out_for_delivery = db.session.execute(
+        update(Order)
+        .where(Order.delivery_status == OUT_FOR_DELIVERY[0], dispatch_time() <= out_cutoff)
+        .values(delivery_status=OUT_FOR_DELIVERY[1])
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    # free the drivers of orders about to be delivered (joined UPDATE Staff ... Orders)
+    drivers_released = db.session.execute(
+        update(Staff)
+        .where(Staff.staff_id == Order.staff_id,
+               Order.delivery_status == DELIVERED[0],
+               dispatch_time() <= delivered_cutoff)
+        .values(is_available=True, last_delivery_time=now)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    # 'Out for Delivery' -> 'Delivered' after 2 minutes
+    delivered = db.session.execute(
+        update(Order)
+        .where(Order.delivery_status == DELIVERED[0], dispatch_time() <= delivered_cutoff)
+        .values(delivery_status=DELIVERED[1])
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    return {
+        'out_for_delivery': out_for_delivery,
+        'delivered': delivered,
+        'drivers_released': drivers_released
+    }
+
+class SystemClock:
+    # real time
+    def now(self):
+        return datetime.now()
+
+class ManualClock:
+    # fake time for tests - only moves when advance() is called
+    def __init__(self, start=None):
+        self.current = start or datetime.now()
+
+    def now(self):
+        return self.current
+
+    def advance(self, seconds):
+        self.current += timedelta(seconds=seconds)
+        return self.current
+
+class DeliveryScheduler:
+    """Deadline queue of delivery steps, run by one background thread.
+
+    Tests can pass a ManualClock, skip start() and call run_due() after
+    advancing the clock instead of sleeping (run_due() sweeps when a sweep
+    is due on that clock too).
+    """
+
+    def __init__(self, app=None, clock=None):
+        self.app = None
+        self.clock = clock or SystemClock()
+        self._heap = []                # (due, seq, order_id, step)
+        self._queued = set()           # (order_id, step) already in the heap
+        self._seq = itertools.count()  # keeps heap order stable for equal times
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._next_sweep = None        # clock time of the next sweep, None: right away
+        self.batch_window = 120
+        self.run_capacity = 1
+        self.sweep_interval = SWEEP_INTERVAL
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['delivery_scheduler'] = self
+        # orders waiting for a driver are looked at this often; without
+        # batching every run is a single order
+        self.batch_window = app.config.get('DELIVERY_BATCH_WINDOW', 120)
+        self.run_capacity = app.config.get('DELIVERY_RUN_CAPACITY', 4) \
+            if app.config.get('DELIVERY_BATCHING', False) else 1
+        self.sweep_interval = app.config.get('DELIVERY_SWEEP_INTERVAL', SWEEP_INTERVAL)
+        # started by the first request, not here: CLI commands (migrate,
+        # reset-codes, ...) shouldn't move deliveries as a side effect or
+        # wait for the first sweep
+        if app.config.get('DELIVERY_SCHEDULER_ENABLED', True) and not app.testing:
+            app.before_request(self._start_once)
+
+    # --- queue ---------------------------------------------------------
+
+    def schedule_order(self, order_id, dispatched_at):
+        # queue both remaining steps for an order that just got a driver
+        self._push(dispatched_at + timedelta(seconds=OUT_FOR_DELIVERY_AFTER), order_id, OUT_FOR_DELIVERY)
+        self._push(dispatched_at + timedelta(seconds=DELIVERED_AFTER), order_id, DELIVERED)
+
+    def schedule_dispatch(self, order_id, due):
+        # look for a driver (and the rest of the run) for a waiting order
+        self._push(due, order_id, DISPATCH)
+
+    def order_placed(self, order_id, created_at, staff_id):
+        """Queue what comes next for a new order, with or without a driver"""
+        if staff_id:
+            self.schedule_order(order_id, created_at)
+        elif self.run_capacity > 1:
+            # right away, in case this order fills a run
+            self.schedule_dispatch(order_id, created_at)
+        else:
+            # the emergency pool of the area was full just now, try again later
+            self.schedule_dispatch(order_id, created_at + timedelta(seconds=self.batch_window))
+
+    def _push(self, due, order_id, step):
+        with self._lock:
+            if (order_id, step) in self._queued:
+                return
+            self._queued.add((order_id, step))
+            heapq.heappush(self._heap, (due, next(self._seq), order_id, step))
+        self._wake.set()  # the new step might be due before the one we sleep on
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                item = heapq.heappop(self._heap)
+                self._queued.discard((item[2], item[3]))
+                due.append(item)
+        return due
+
+    def next_due(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def next_wake(self):
+        # when run_due() has something to do next: a step or the sweep
+        if self._next_sweep is None:
+            return self.clock.now()
+        next_due = self.next_due()
+        return self._next_sweep if next_due is None else min(next_due, self._next_sweep)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+    def sweep(self, now=None):
+        """Move on what fell due without us and queue every order in flight.
+
+        Catches up after a restart, and picks up the orders of other
+        processes. Returns how many orders advance_deliveries() moved.
+        """
+        now = now or self.clock.now()
+        self._next_sweep = now + timedelta(seconds=self.sweep_interval)
+        with self.app.app_context():
+            try:
+                moved = advance_deliveries(now)
+                db.session.commit()
+                if moved['out_for_delivery'] or moved['delivered']:
+                    cache.invalidate(cache.DELIVERY_STATUS_CHANGED)
+                self.load_in_flight()
+                return moved['out_for_delivery'] + moved['delivered']
+            except Exception as e:
+                db.session.rollback()
+                print(f"Could not sweep in-flight deliveries: {e}")
+                return 0
+            finally:
+                db.session.remove()
+
+    def load_in_flight(self):
+        """Queue every order that is still on its way (needs an app context)"""
+        rows = db.session.execute(
+            select(Order.order_id, Order.delivery_status, dispatch_time(), Order.staff_id)
+            .where(Order.delivery_status.in_(['Pending', 'In Progress', 'Out for Delivery']))
+        ).all()
+        now = self.clock.now()
+        for order_id, status, dispatched_at, staff_id in rows:
+            if status == 'Pending':
+                if staff_id is None:
+                    self.schedule_dispatch(order_id, now)
+            elif dispatched_at is None:
+                continue
+            elif status == 'In Progress':
+                self.schedule_order(order_id, dispatched_at)
+            else:
+                self._push(dispatched_at + timedelta(seconds=DELIVERED_AFTER), order_id, DELIVERED)
+        return len(rows)
+
+    # --- running steps -------------------------------------------------
+
+    def run_due(self):
+        """Apply every step that is due now. Returns how many orders moved."""
+        now = self.clock.now()
+        if self._next_sweep is None or now >= self._next_sweep:
+            self.sweep(now)
+        due = self._pop_due(now)
+        if not due:
+            return 0
+
+        with self.app.app_context():
+            try:
+                moved, runs, waiting = self._apply(due, now)
+                db.session.commit()
+                if moved:
+                    cache.invalidate(cache.DELIVERY_STATUS_CHANGED)
+                if runs:
+                    cache.invalidate(cache.DRIVER_CREATED)
+                for _, order_ids in runs:
+                    for order_id in order_ids:
+                        self.schedule_order(order_id, now)
+                # no driver for these yet, look again later
+                for order_id in waiting:
+                    self.schedule_dispatch(order_id, now + timedelta(seconds=self.batch_window))
+                return moved
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error updating delivery statuses: {e}")
+                # try these steps again a bit later
+                retry_at = now + timedelta(seconds=RETRY_AFTER)
+                for _, _, order_id, step in due:
+                    self._push(retry_at, order_id, step)
+                return 0
+            finally:
+                db.session.remove()
+
+    def _apply(self, due, now):
+        out_ids = [order_id for _, _, order_id, step in due if step == OUT_FOR_DELIVERY]
+        delivered_ids = [order_id for _, _, order_id, step in due if step == DELIVERED]
+        dispatch_ids = [order_id for _, _, order_id, step in due if step == DISPATCH]
+        moved = 0
+
+        # the WHERE on the old status makes each step safe to run twice, and
+        # skips orders that were delivered or cancelled by hand in the meantime
+        if out_ids:
+            moved += db.session.execute(
+                update(Order)
+                .where(Order.order_id.in_(out_ids), Order.delivery_status == OUT_FOR_DELIVERY[0])
+                .values(delivery_status=OUT_FOR_DELIVERY[1])
+                .execution_options(synchronize_session=False)
+            ).rowcount
+
+        if delivered_ids:
+            drivers = db.session.execute(
+                select(Order.staff_id).where(Order.order_id.in_(delivered_ids),
+                                             Order.delivery_status == DELIVERED[0],
+                                             Order.staff_id.isnot(None))
+                .distinct()
+            ).scalars().all()
+            moved += db.session.execute(
+                update(Order)
+                .where(Order.order_id.in_(delivered_ids), Order.delivery_status == DELIVERED[0])
+                .values(delivery_status=DELIVERED[1])
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            # a driver on a run is free once the last order of it is delivered
+            if drivers:
+                db.session.execute(
+                    update(Staff)
+                    .where(Staff.staff_id.in_(drivers), ~_on_the_way())
+                    .values(is_available=True, last_delivery_time=now)
+                    .execution_options(synchronize_session=False)
+                )
+
+        runs, waiting = [], []
+        if dispatch_ids:
+            # here, not at the top: delivery_runs -> driver_pool -> delivery_scheduler
+            from delivery_runs import dispatch_runs
+            runs = dispatch_runs(now, self.batch_window, self.run_capacity)
+            moved += sum(len(order_ids) for _, order_ids in runs)
+            waiting = db.session.execute(
+                select(Order.order_id).where(Order.order_id.in_(dispatch_ids),
+                                             Order.delivery_status == DISPATCH[0],
+                                             Order.staff_id.is_(None))
+            ).scalars().all()
+
+        return moved, runs, waiting
+
+    # --- background thread ---------------------------------------------
+
+    def _start_once(self):
+        if self._thread is None:
+            self.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='delivery-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.run_due()
+            timeout = max(0.0, (self.next_wake() - self.clock.now()).total_seconds())
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+# shared scheduler, set up in create_app like db
+delivery_scheduler = DeliveryScheduler()
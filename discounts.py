@@ -0,0 +1,244 @@
+# discount code redemption
+#
+# A code is claimed with one conditional UPDATE
+#
+#   UPDATE Discount_Code SET is_used = true
+#   WHERE code_name = :code AND is_used = false AND expiry_date >= :today
+#
+# and it is ours only if that changed a row. Two orders racing for the same
+# code can't both get it: the second UPDATE waits for the first one's row
+# lock and then finds is_used already set (or gets the code after all if the
+# first order rolled back).
+#
+# In front of that sits a Bloom filter of the live codes (unused and not
+# expired), so typos and guessing are turned away without asking the
+# database. A Bloom filter never says no to a code it holds, it only
+# sometimes says yes to one it doesn't (about 1 in 100), and then the
+# UPDATE just changes nothing. It takes ~1.2 bytes per code instead of a
+# set of strings, so a million live codes fit in about 1.2 MB.
+#
+# The filter only has to be right about codes that became live:
+#   - codes added since the last look are picked up by id every
+#     REFRESH_SECONDS (in every process, also codes added elsewhere)
+#   - resets count up the 'discount_codes' row of Data_Version in their
+#     transaction; every process compares that counter with the one its
+#     filter was built at before it trusts the filter, so a reset in the CLI
+#     or in another web worker is seen on the next checkout everywhere
+#   - resets and campaigns in this process also call code_index.invalidate()
+#   - the whole filter is rebuilt every REBUILD_SECONDS, which also drops
+#     codes that were used or expired in the meantime
+# Rebuilds and refreshes run in a background thread (a million codes take
+# seconds), and the new filter is swapped in when it is done. Until then
+# checkouts keep using the old one, or ask the database when there is none.
+import hashlib
+import math
+import threading
+import time
+from datetime import date
+
+from flask import current_app
+from sqlalchemy import select, update, func
+
+from models import db, DiscountCode, data_version
+import metrics
+
+REFRESH_SECONDS = 30
+REBUILD_SECONDS = 600
+FALSE_POSITIVE_RATE = 0.01
+MIN_CAPACITY = 1024
+
+# Data_Version row counted up whenever codes become live again in bulk
+CODES_VERSION = 'discount_codes'
+
+def _key(code_name):
+    # MySQL compares code names without case, so the filter does too
+    return code_name.strip().casefold().encode()
+
+class BloomFilter:
+    """Set membership in a fixed bit array: no false negatives, some false positives"""
+
+    def __init__(self, capacity, error_rate=FALSE_POSITIVE_RATE):
+        capacity = max(capacity, MIN_CAPACITY)
+        self.capacity = capacity
+        self.bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        # two 64 bit hashes combined into k positions (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._array[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    @property
+    def size_bytes(self):
+        return len(self._array)
+
+class LiveCodeIndex:
+    """Bloom filter of the unused, unexpired discount codes, kept fresh"""
+
+    def __init__(self):
+        self._filter = None
+        self._watermark = 0       # highest code_id looked at
+        self._built_at = 0.0
+        self._refreshed_at = 0.0
+        self._version = None      # Data_Version counter the filter was built at
+        self._generation = 0      # bumped by invalidate(), so a build from before is dropped
+        self._worker = None       # the background rebuild or refresh, one at a time
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        # codes became live again in bulk (reset, campaign): rebuild on next use
+        with self._lock:
+            self._filter = None
+            self._generation += 1
+
+    def _live_codes(self, after_id=0):
+        return db.session.execute(
+            select(DiscountCode.code_id, DiscountCode.code_name)
+            .where(DiscountCode.code_id > after_id, DiscountCode.is_used == False,
+                   DiscountCode.expiry_date >= date.today())
+            .execution_options(yield_per=10000)    # campaigns make millions of codes, stream them
+        )
+
+    def rebuild(self):
+        """Build the filter from the database and swap it in (needs an app context).
+
+        Returns False if the index was invalidated meanwhile and the new
+        filter was thrown away.
+        """
+        with self._lock:
+            generation = self._generation
+        # read first: a reset after this is caught by the next comparison
+        version = data_version(CODES_VERSION)
+        total, last_id = db.session.execute(
+            select(func.count(DiscountCode.code_id), func.max(DiscountCode.code_id))
+        ).one()
+        # sized for all codes there are, with room for as many new ones
+        bloom = BloomFilter(2 * (total or 0))
+        for _, code_name in self._live_codes():
+            bloom.add(_key(code_name))
+        with self._lock:
+            if self._generation != generation:
+                return False
+            self._filter = bloom
+            self._version = version
+            self._watermark = last_id or 0
+            self._built_at = self._refreshed_at = time.monotonic()
+        return True
+
+    def refresh(self):
+        """Add the codes made since we last looked (needs an app context)"""
+        with self._lock:
+            bloom, watermark = self._filter, self._watermark
+        if bloom is None:
+            return
+        # setting bits in the filter in use is fine: a code being added is
+        # at worst turned away a moment longer
+        for code_id, code_name in self._live_codes(watermark):
+            bloom.add(_key(code_name))
+            watermark = max(watermark, code_id)
+        with self._lock:
+            if self._filter is bloom:
+                self._watermark = watermark
+                self._refreshed_at = time.monotonic()
+
+    def _run(self, app, job):
+        with app.app_context():
+            try:
+                job()
+            except Exception as e:
+                print(f"Could not update the discount code filter: {e}")
+            finally:
+                db.session.remove()
+
+    def _start(self, job):
+        # in the background, so no checkout waits for it
+        with self._lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._worker = threading.Thread(target=self._run, args=(current_app._get_current_object(), job),
+                                            name='code-index', daemon=True)
+            self._worker.start()
+
+    def _current(self):
+        now = time.monotonic()
+        bloom = self._filter
+        if bloom is not None and self._version != data_version(CODES_VERSION):
+            # codes were reset somewhere else since the filter was built
+            self._start(self.rebuild)
+            return None
+        if bloom is None or now - self._built_at > REBUILD_SECONDS or bloom.count > bloom.capacity:
+            self._start(self.rebuild)
+        elif now - self._refreshed_at >= REFRESH_SECONDS:
+            self._start(self.refresh)
+        return bloom
+
+    def wait(self, timeout=None):
+        # for benchmarks and scripts: let a running rebuild or refresh finish
+        worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
+
+    def might_be_live(self, code_name):
+        """False means the code surely can't be used right now"""
+        bloom = self._current()
+        # no filter yet (first use, or just invalidated): the database decides
+        return bloom is None or _key(code_name) in bloom
+
+    def stats(self):
+        bloom = self._filter
+        return {
+            'codes': bloom.count if bloom else 0,
+            'capacity': bloom.capacity if bloom else 0,
+            'bytes': bloom.size_bytes if bloom else 0,
+            'hashes': bloom.hashes if bloom else 0,
+            'watermark': self._watermark,
+        }
+
+code_index = LiveCodeIndex()
+
+def _reject_reason(code_name):
+    # only asked after a failed claim, to count why
+    row = db.session.execute(
+        select(DiscountCode.is_used, DiscountCode.expiry_date).where(DiscountCode.code_name == code_name)
+    ).first()
+    if row is None:
+        return 'unknown'
+    return 'used' if row.is_used else 'expired'
+
+def redeem_code(code_name, today=None):
+    """Claim a discount code in the current transaction.
+
+    Returns (code_id, discount_value) if the code was live and is now used,
+    or None. The caller commits (or rolls back to give the code back).
+    """
+    today = today or date.today()
+    code_name = code_name.strip()
+    if not code_name or not code_index.might_be_live(code_name):
+        metrics.discount_code_rejects.inc('filtered')
+        return None
+
+    claimed = db.session.execute(
+        update(DiscountCode)
+        .where(DiscountCode.code_name == code_name, DiscountCode.is_used == False,
+               DiscountCode.expiry_date >= today)
+        .values(is_used=True)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        metrics.discount_code_rejects.inc(_reject_reason(code_name))
+        return None
+    return db.session.execute(
+        select(DiscountCode.code_id, DiscountCode.discount_value).where(DiscountCode.code_name == code_name)
+    ).one()
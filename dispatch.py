@@ -0,0 +1,98 @@
+# picks and reserves a delivery driver for a new order
+#
+# Eligible drivers for a postal code are the available, not retired ones whose
+# 30 minute break is over, longest idle first (drivers that never delivered come first
+# because NULL sorts first). The Staff index on
+# (assigned_postal_code, is_available, last_delivery_time) keeps that list in
+# order, so the database only has to read the first few entries.
+#
+# Reserving is done with a conditional UPDATE that only succeeds while the
+# driver is still free. If two orders race for the same driver, one of them
+# changes 0 rows and simply moves on to the next driver in the list, so a
+# driver can never end up on two orders and we only call on the emergency
+# driver pool (driver_pool.py) when nobody at all is left.
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, or_
+
+from models import db, Staff, User
+
+# drivers need a 30 minute break after a delivery (see Staff.can_deliver_now)
+DRIVER_COOLDOWN = timedelta(minutes=30)
+
+# how many times to try the next driver before giving up
+MAX_TRIES = 3
+
+def free_now(now):
+    # conditions for a driver that can take an order right now, in any area
+    return (
+        Staff.is_available == True,
+        Staff.is_retired == False,
+        or_(Staff.last_delivery_time.is_(None),
+            Staff.last_delivery_time <= now - DRIVER_COOLDOWN)
+    )
+
+def _eligible(postal_code, now):
+    # free drivers of this postal code
+    return (Staff.assigned_postal_code == postal_code, *free_now(now))
+
+def eligible_drivers(postal_code, now=None, limit=None):
+    """Staff ids that could deliver in this postal code now, longest idle first"""
+    now = now or datetime.now()
+    query = select(Staff.staff_id)\
+        .where(*_eligible(postal_code, now))\
+        .order_by(Staff.last_delivery_time, Staff.staff_id)
+    if limit:
+        query = query.limit(limit)
+    return db.session.execute(query).scalars().all()
+
+def claim_first(conditions, order_by, values):
+    """Reserve the first driver matching conditions with a conditional UPDATE.
+
+    values are set on the driver it claims. Returns the staff_id, or None
+    when nobody matches. The caller commits.
+    """
+    for _ in range(MAX_TRIES):
+        # lock only the one driver we are about to claim, so a concurrent
+        # order in the same area skips just that row and gets the next free
+        # driver (FOR UPDATE SKIP LOCKED where the database supports it)
+        staff_id = db.session.execute(
+            select(Staff.staff_id)
+            .where(*conditions)
+            .order_by(*order_by)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).scalar()
+        if staff_id is None:
+            return None
+
+        claimed = db.session.execute(
+            update(Staff)
+            .where(Staff.staff_id == staff_id, *conditions)
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if claimed:
+            return staff_id
+        # taken while we looked (databases without SKIP LOCKED) - try the next one
+    return None
+
+def claim_driver(postal_code, now=None):
+    """Reserve the longest idle eligible driver for this postal code.
+
+    Returns the staff_id, or None if no driver is free. The driver is marked
+    unavailable in the current transaction, so the caller commits (or rolls
+    back to give the driver back).
+    """
+    now = now or datetime.now()
+    return claim_first(_eligible(postal_code, now), (Staff.last_delivery_time, Staff.staff_id),
+                       {'is_available': False, 'last_delivery_time': now})
+
+def driver_name(staff_id):
+    # full name of a driver, for the flash messages
+    first_name, last_name = db.session.execute(
+        select(User.first_name, User.last_name)
+        .join(Staff, Staff.user_id == User.user_id)
+        .where(Staff.staff_id == staff_id)
+    ).one()
+    return f"{first_name} {last_name}"
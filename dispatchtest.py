@@ -0,0 +1,142 @@
+# dispatch race test: many orders for one postal code at the very same moment
+#
+# Moves --drivers regular drivers into one postal code and frees them, then
+# lets --orders threads
+# wait on a barrier and place an order for that area all at once, through
+# place_order() like the order form does. Afterwards it checks that:
+#   - no driver got two of the orders
+#   - no emergency driver was brought in while a driver of the area was free,
+#     i.e. emergency drivers <= orders - free drivers
+#   - every order got a driver (as long as the emergency pool had room)
+#
+#   python dispatchtest.py --orders 24 --drivers 12
+#   python dispatchtest.py --database-url mysql+pymysql://... --orders 64
+import threading
+from collections import Counter
+
+import click
+from sqlalchemy import select, update, func
+
+from models import db, Customer, User, Order, Staff, get_menu_catalog
+from datagen import SCALES
+from bench import bench_app
+from driver_pool import per_area_cap
+from order_service import place_order, price_line
+
+class Race:
+    def __init__(self, app, drivers):
+        self.app = app
+        self._lock = threading.Lock()
+        self.placed = []           # (order_id, staff_id, emergency driver or None)
+        self.failures = Counter()  # error -> count
+        with app.app_context():
+            # the postal code with the most drivers gets some more, all of
+            # them free and rested
+            self.postal_code = db.session.execute(
+                select(Staff.assigned_postal_code)
+                .where(Staff.is_emergency == False)
+                .group_by(Staff.assigned_postal_code)
+                .order_by(func.count(Staff.staff_id).desc(), Staff.assigned_postal_code)
+                .limit(1)
+            ).scalar()
+            moved = db.session.execute(
+                select(Staff.staff_id).where(Staff.is_emergency == False).order_by(Staff.staff_id).limit(drivers)
+            ).scalars().all()
+            db.session.execute(
+                update(Staff).where(Staff.staff_id.in_(moved)).values(assigned_postal_code=self.postal_code)
+                .execution_options(synchronize_session=False))
+            db.session.execute(
+                update(Staff).where(Staff.assigned_postal_code == self.postal_code)
+                .values(is_available=True, is_retired=False, last_delivery_time=None)
+                .execution_options(synchronize_session=False))
+            db.session.commit()
+            self.free = db.session.execute(
+                select(func.count(Staff.staff_id))
+                .where(Staff.assigned_postal_code == self.postal_code, Staff.is_available == True)
+            ).scalar()
+            self.emergency_room = per_area_cap() - db.session.execute(
+                select(func.count(Staff.staff_id))
+                .where(Staff.assigned_postal_code == self.postal_code, Staff.is_emergency == True,
+                       Staff.is_retired == False)
+            ).scalar()
+            # any customer will do, the order goes to the area we pick
+            self.customer_ids = db.session.execute(
+                select(Customer.customer_id).order_by(Customer.customer_id).limit(50)).scalars().all()
+            catalog = get_menu_catalog()
+            self.lines = [price_line(catalog, 'Pizza', catalog.pizzas[0].pizza_id, 1)]
+            self.first_order_id = (db.session.execute(select(func.max(Order.order_id))).scalar() or 0) + 1
+            db.session.remove()
+
+    def _order(self, index, barrier):
+        with self.app.app_context():
+            customer = db.session.get(Customer, self.customer_ids[index % len(self.customer_ids)])
+            user = db.session.get(User, customer.user_id)
+            db.session.expunge(user)
+            user.postal_code = self.postal_code  # only for this order, never written back
+            db.session.commit()
+            barrier.wait()
+            try:
+                placed = place_order(customer, user, self.lines)
+                db.session.commit()
+                with self._lock:
+                    self.placed.append((placed.order.order_id, placed.order.staff_id, placed.new_driver))
+            except Exception as e:
+                db.session.rollback()
+                with self._lock:
+                    self.failures[f'{type(e).__name__}: {str(e)[:100]}'] += 1
+            finally:
+                db.session.remove()
+
+    def run(self, orders):
+        barrier = threading.Barrier(orders)
+        threads = [threading.Thread(target=self._order, args=(index, barrier)) for index in range(orders)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def check(self):
+        """Problems found, as readable lines"""
+        problems = []
+        drivers = Counter(staff_id for _, staff_id, _ in self.placed if staff_id)
+        for staff_id, count in drivers.items():
+            if count > 1:
+                problems.append(f'driver {staff_id} got {count} of the orders')
+        emergency = sum(1 for _, _, new_driver in self.placed if new_driver)
+        needed = max(0, len(self.placed) - self.free)
+        if emergency > needed:
+            problems.append(f'{emergency} emergency drivers for {len(self.placed)} orders '
+                            f'with {self.free} drivers free (needed {needed})')
+        waiting = sum(1 for _, staff_id, _ in self.placed if not staff_id)
+        if waiting > max(0, needed - self.emergency_room):
+            problems.append(f'{waiting} orders left without a driver')
+        return problems
+
+@click.command()
+@click.option('--scale', type=click.Choice(list(SCALES)), default='tiny', help='How much data to generate.')
+@click.option('--database-url', help='Use this database (no data is generated).')
+@click.option('--orders', type=int, default=24, help='Orders placed at the same moment.')
+@click.option('--drivers', type=int, default=12, help='Regular drivers moved into the postal code.')
+@click.option('--seed', type=int, default=42)
+def main(scale, database_url, orders, drivers, seed):
+    """Race many orders for one postal code and check the driver assignment."""
+    with bench_app(scale, database_url, seed) as app:
+        race = Race(app, drivers)
+        click.echo(f'{orders} orders at once for {race.postal_code} '
+                   f'({race.free} drivers free, room for {race.emergency_room} emergency drivers)')
+        race.run(orders)
+        problems = race.check()
+
+    emergency = Counter(new_driver.how for _, _, new_driver in race.placed if new_driver)
+    click.echo(f'{len(race.placed)} orders placed, {sum(race.failures.values())} failed, '
+               f'emergency drivers: {dict(emergency) or 0}')
+    for message, count in race.failures.most_common(10):
+        click.echo(f'  failed {count}x: {message}')
+    for problem in problems:
+        click.echo(f'PROBLEM {problem}')
+    if problems:
+        raise click.ClickException(f'{len(problems)} dispatch problems')
+    click.echo('dispatch holds')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# data for the driver pages (/delivery-status and /drivers)
+#
+# Both pages used to loop over every staff member and look up their user,
+# current order, customer and order count one query at a time. Here the whole
+# board comes back from one joined query (plus one GROUP BY for the overview),
+# as small read-only rows.
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import select, func
+from sqlalchemy.orm import aliased
+
+from models import db, User, Customer, Staff, Order
+from dispatch import DRIVER_COOLDOWN
+from delivery_scheduler import dispatch_time
+
+# orders a driver is still busy with
+ACTIVE_STATUSES = ('In Progress', 'Out for Delivery')
+
+_DRIVER_FIELDS = [
+    'staff_id', 'first_name', 'last_name', 'email', 'phone',
+    'assigned_postal_code', 'is_available', 'last_delivery_time', 'is_emergency',
+    'active_orders',
+    # current order (None when the driver has nothing on)
+    'order_id', 'order_status', 'order_dispatched_at',
+    'customer_first_name', 'customer_last_name', 'customer_address'
+]
+
+class DriverRow(namedtuple('DriverRow', _DRIVER_FIELDS)):
+    # one driver with their current job
+    __slots__ = ()
+
+    @property
+    def full_name(self):
+        return f"{self.first_name} {self.last_name}"
+
+    @property
+    def customer_name(self):
+        return f"{self.customer_first_name} {self.customer_last_name}"
+
+def load_driver_board(staff_only=False, by_area=False):
+    """All drivers (but retired ones) with their current order and active order count.
+
+    staff_only leaves out users that are not of type Staff, by_area sorts by
+    postal code and first name (like the /drivers page).
+    """
+    # active order count and the oldest active order per driver
+    active = select(
+        Order.staff_id.label('staff_id'),
+        func.count(Order.order_id).label('active_orders'),
+        func.min(Order.order_id).label('current_order_id')
+    ).where(Order.delivery_status.in_(ACTIVE_STATUSES))\
+     .group_by(Order.staff_id).subquery()
+
+    customer_user = aliased(User)
+    query = select(
+        Staff.staff_id, User.first_name, User.last_name, User.email, User.phone,
+        Staff.assigned_postal_code, Staff.is_available, Staff.last_delivery_time, Staff.is_emergency,
+        func.coalesce(active.c.active_orders, 0),
+        Order.order_id, Order.delivery_status, dispatch_time(),
+        customer_user.first_name, customer_user.last_name, customer_user.address
+    ).join(User, Staff.user_id == User.user_id)\
+     .outerjoin(active, active.c.staff_id == Staff.staff_id)\
+     .outerjoin(Order, Order.order_id == active.c.current_order_id)\
+     .outerjoin(Customer, Customer.customer_id == Order.customer_id)\
+     .outerjoin(customer_user, customer_user.user_id == Customer.user_id)\
+     .where(Staff.is_retired == False)
+
+    if staff_only:
+        query = query.where(User.user_type == 'Staff')
+    if by_area:
+        query = query.order_by(Staff.assigned_postal_code, User.first_name)
+    else:
+        query = query.order_by(Staff.staff_id)
+
+    return [DriverRow(*row) for row in db.session.execute(query)]
+
+def load_delivery_overview():
+    # number of orders in each delivery status, from one GROUP BY
+    counts = dict(db.session.execute(
+        select(Order.delivery_status, func.count(Order.order_id))
+        .group_by(Order.delivery_status)
+    ).all())
+    return {
+        'pending': counts.get('Pending', 0),
+        'in_progress': counts.get('In Progress', 0),
+        'out_for_delivery': counts.get('Out for Delivery', 0)
+    }
+
+def cooldown_minutes_left(last_delivery_time, now=None):
+    # minutes until the driver's 30 minute break is over (0 = can deliver)
+    if last_delivery_time is None:
+        return 0
+    now = now or datetime.now()
+    elapsed = now - last_delivery_time
+    if elapsed >= DRIVER_COOLDOWN:
+        return 0
+    return max(0, 30 - int(elapsed.total_seconds() / 60))
@@ -0,0 +1,275 @@
+# the emergency driver pool: drivers we bring in when nobody in an area is free
+#
+# We used to insert a new User and Staff row every time no driver was free,
+# so the Staff table only ever grew, and with it the dispatch query and the
+# driver pages. Now, when dispatch finds nobody, emergency_driver() tries in
+# this order:
+#
+#   1. an idle emergency driver from any area (free and past their break),
+#      who moves over to this postal code
+#   2. a retired emergency driver, taken on again for this postal code
+#   3. a new emergency driver
+#
+# Each of these adds a driver to the area's pool, so none of them happens
+# once the area already has EMERGENCY_DRIVERS_PER_AREA emergency drivers;
+# then the order waits (Pending) and the delivery scheduler looks for a
+# driver for it again every DELIVERY_BATCH_WINDOW seconds
+# (delivery_runs.dispatch_runs).
+#
+# Every step is a conditional UPDATE or an insert inside a savepoint, so two
+# orders can't get the same driver and a failed insert doesn't take the
+# order's transaction down with it. (The cap is checked with a count before
+# the steps, so orders racing for the last place can overshoot it by one or
+# two - fine for a cap that only keeps the table from growing without end.)
+#
+# Two jobs keep the pool the right size, from cron:
+#   flask --app app provision-drivers       drivers for next hour's forecast
+#   flask --app app retire-drivers          retire drivers idle for 14 days
+# Retired drivers are left out of dispatch and the driver pages but keep
+# their rows, so the pool reuses them before it makes new ones.
+import math
+import random
+import secrets
+from collections import namedtuple
+from datetime import datetime, date, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import select, update, func, or_
+
+from models import db, User, Customer, Staff, Order
+from dispatch import DRIVER_COOLDOWN, claim_first, free_now
+from delivery_scheduler import DELIVERED_AFTER
+import metrics
+import cache
+
+EMAIL_DOMAIN = 'mammamiapizza.com'
+DEFAULT_PER_AREA = 10        # emergency drivers per postal code at most
+DEFAULT_RETIRE_AFTER_DAYS = 14
+FORECAST_WEEKS = 4           # past weeks the forecast looks at
+
+# one order keeps a driver busy for the delivery plus their break
+ORDERS_PER_DRIVER_HOUR = timedelta(hours=1) / (timedelta(seconds=DELIVERED_AFTER) + DRIVER_COOLDOWN)
+
+DRIVER_NAMES = [
+    ('Express', 'Mario'), ('Veloce', 'Luigi'), ('Rapido', 'Giuseppe'),
+    ('Sprint', 'Antonio'), ('Flash', 'Marco'), ('Turbo', 'Luca'),
+    ('Speed', 'Andrea'), ('Fast', 'Matteo'), ('Quick', 'Franco'),
+    ('Zoom', 'Roberto'), ('Rush', 'Paolo'), ('Jet', 'Simone')
+]
+
+# what the pool did for an order: the driver and 'reassigned', 'revived' or 'created'
+EmergencyDriver = namedtuple('EmergencyDriver', 'staff_id how')
+
+def per_area_cap():
+    return current_app.config.get('EMERGENCY_DRIVERS_PER_AREA', DEFAULT_PER_AREA)
+
+def create_emergency_driver(postal_code, now=None, busy=False):
+    """Insert a new emergency driver for this postal code (in a savepoint).
+
+    busy=True puts them straight on an order. Returns the Staff, or None if
+    the insert failed. The caller commits.
+    """
+    now = now or datetime.now()
+    surname, first_name = random.choice(DRIVER_NAMES)
+    try:
+        with db.session.begin_nested():
+            new_user = User(
+                first_name=first_name,
+                last_name=surname,
+                gender='Male',
+                # random part so drivers made at the same moment don't clash
+                email=f'{first_name.lower()}.{surname.lower()}.{secrets.token_hex(4)}@{EMAIL_DOMAIN}',
+                phone=f'+39 380 {random.randint(1000000, 9999999)}',
+                date_of_birth=date(1990, 1, 1),
+                address='Emergency Driver Address, Milano',
+                postal_code=postal_code,
+                user_type='Staff'
+            )
+            db.session.add(new_user)
+            db.session.flush()
+            # a fresh driver is ready right away (their break is over), and
+            # the idle time the retirement job looks at starts now
+            new_staff = Staff(
+                user_id=new_user.user_id,
+                assigned_postal_code=postal_code,
+                is_available=not busy,
+                last_delivery_time=now if busy else now - DRIVER_COOLDOWN,
+                is_emergency=True,
+                is_retired=False
+            )
+            db.session.add(new_staff)
+            db.session.flush()
+    except Exception as e:
+        print(f"Could not create an emergency driver: {e}")
+        return None
+    metrics.emergency_drivers_created.inc()
+    return new_staff
+
+def _area_pool_size(postal_code):
+    return db.session.execute(
+        select(func.count(Staff.staff_id))
+        .where(Staff.assigned_postal_code == postal_code, Staff.is_emergency == True, Staff.is_retired == False)
+    ).scalar()
+
+def emergency_driver(postal_code, now=None):
+    """Put an emergency driver on an order in this postal code.
+
+    Returns an EmergencyDriver (the driver is already marked busy), or None
+    when the area's pool is full; the caller leaves the order waiting for
+    the scheduler's next try (DeliveryScheduler.order_placed). The caller
+    commits.
+    """
+    now = now or datetime.now()
+    busy = {'assigned_postal_code': postal_code, 'is_available': False, 'last_delivery_time': now}
+    # moving a driver over grows the area's pool just like a new one does
+    if _area_pool_size(postal_code) >= per_area_cap():
+        metrics.emergency_drivers_refused.inc()
+        return None
+
+    staff_id = claim_first((Staff.is_emergency == True, *free_now(now)),
+                           (Staff.last_delivery_time, Staff.staff_id), busy)
+    if staff_id:
+        metrics.emergency_drivers_reused.inc('reassigned')
+        return EmergencyDriver(staff_id, 'reassigned')
+
+    staff_id = claim_first((Staff.is_emergency == True, Staff.is_retired == True),
+                           (Staff.last_delivery_time, Staff.staff_id), dict(busy, is_retired=False))
+    if staff_id:
+        metrics.emergency_drivers_reused.inc('revived')
+        return EmergencyDriver(staff_id, 'revived')
+
+    new_staff = create_emergency_driver(postal_code, now, busy=True)
+    return EmergencyDriver(new_staff.staff_id, 'created') if new_staff else None
+
+# --- pre-provisioning ---------------------------------------------------------
+
+def forecast_orders(at, weeks=FORECAST_WEEKS):
+    """Orders expected per postal code in the hour from `at`.
+
+    The average of the same hour on the same weekday over the past weeks.
+    """
+    windows = [(at - timedelta(weeks=n), at - timedelta(weeks=n) + timedelta(hours=1))
+               for n in range(1, weeks + 1)]
+    rows = db.session.execute(
+        select(User.postal_code, func.count(Order.order_id))
+        .join(Customer, Customer.customer_id == Order.customer_id)
+        .join(User, User.user_id == Customer.user_id)
+        .where(or_(*(Order.created_at.between(start, end) for start, end in windows)))
+        .group_by(User.postal_code)
+    ).all()
+    return {postal_code: count / weeks for postal_code, count in rows}
+
+def drivers_needed(expected_orders):
+    return math.ceil(expected_orders / ORDERS_PER_DRIVER_HOUR)
+
+def plan_provisioning(at):
+    """postal code -> emergency drivers to add before the hour from `at`"""
+    drivers = dict(db.session.execute(
+        select(Staff.assigned_postal_code, func.count(Staff.staff_id))
+        .where(Staff.is_retired == False)
+        .group_by(Staff.assigned_postal_code)
+    ).all())
+    emergency = dict(db.session.execute(
+        select(Staff.assigned_postal_code, func.count(Staff.staff_id))
+        .where(Staff.is_emergency == True, Staff.is_retired == False)
+        .group_by(Staff.assigned_postal_code)
+    ).all())
+    cap = per_area_cap()
+    plan = {}
+    for postal_code, expected in forecast_orders(at).items():
+        missing = drivers_needed(expected) - drivers.get(postal_code, 0)
+        room = cap - emergency.get(postal_code, 0)
+        if min(missing, room) > 0:
+            plan[postal_code] = min(missing, room)
+    return plan
+
+def provision(postal_code, count, now=None):
+    """Make count more emergency drivers ready in this postal code.
+
+    Retired drivers are taken on again first, the rest are new. Returns how
+    many of each. The caller commits.
+    """
+    now = now or datetime.now()
+    ready = {'assigned_postal_code': postal_code, 'is_available': True, 'is_retired': False,
+             'last_delivery_time': now - DRIVER_COOLDOWN}
+    revived = db.session.execute(
+        select(Staff.staff_id)
+        .where(Staff.is_emergency == True, Staff.is_retired == True)
+        .order_by(Staff.staff_id)
+        .limit(count)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+    if revived:
+        db.session.execute(
+            update(Staff)
+            .where(Staff.staff_id.in_(revived), Staff.is_retired == True)
+            .values(**ready)
+            .execution_options(synchronize_session=False)
+        )
+    created = 0
+    for _ in range(count - len(revived)):
+        if create_emergency_driver(postal_code, now):
+            created += 1
+    metrics.emergency_drivers_reused.inc('revived', amount=len(revived))
+    return {'revived': len(revived), 'created': created}
+
+# --- retirement ---------------------------------------------------------------
+
+def retire_idle_drivers(idle_for, now=None):
+    """Retire free emergency drivers that didn't deliver for idle_for, in one UPDATE.
+
+    Returns how many were retired. The caller commits.
+    """
+    now = now or datetime.now()
+    on_order = select(Order.order_id).where(
+        Order.staff_id == Staff.staff_id,
+        Order.delivery_status.in_(['Pending', 'In Progress', 'Out for Delivery'])
+    ).exists()
+    retired = db.session.execute(
+        update(Staff)
+        .where(Staff.is_emergency == True, Staff.is_retired == False, Staff.is_available == True,
+               or_(Staff.last_delivery_time.is_(None), Staff.last_delivery_time < now - idle_for),
+               ~on_order)
+        .values(is_retired=True, is_available=False)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    metrics.emergency_drivers_retired.inc(amount=retired)
+    return retired
+
+@click.command('provision-drivers')
+@click.option('--postal-code', help='Provision this area only (with --count).')
+@click.option('--count', type=int, help='Drivers to add in --postal-code.')
+@click.option('--hours-ahead', type=int, default=1, help='Forecast the hour starting this many hours from now.')
+@click.option('--dry-run', is_flag=True, help='Only print the plan.')
+def provision_drivers_command(postal_code, count, hours_ahead, dry_run):
+    """Get emergency drivers ready before a busy hour."""
+    if postal_code or count:
+        if not (postal_code and count):
+            raise click.UsageError('--postal-code and --count go together')
+        plan = {postal_code: count}
+    else:
+        at = datetime.now().replace(minute=0, second=0, microsecond=0) + timedelta(hours=hours_ahead)
+        plan = plan_provisioning(at)
+        click.echo(f'forecast for {at:%a %H:%M}: {sum(plan.values())} drivers short in {len(plan)} areas')
+    for area, missing in sorted(plan.items()):
+        if dry_run:
+            click.echo(f'  {area}: {missing}')
+            continue
+        done = provision(area, missing)
+        db.session.commit()
+        click.echo(f"  {area}: {done['revived']} taken on again, {done['created']} new")
+    if plan and not dry_run:
+        cache.invalidate(cache.DRIVER_CREATED)
+
+@click.command('retire-drivers')
+@click.option('--idle-days', type=int, help='Retire drivers idle this long (default EMERGENCY_RETIRE_AFTER_DAYS).')
+def retire_drivers_command(idle_days):
+    """Retire emergency drivers that have been idle for a long time."""
+    if idle_days is None:
+        idle_days = current_app.config.get('EMERGENCY_RETIRE_AFTER_DAYS', DEFAULT_RETIRE_AFTER_DAYS)
+    retired = retire_idle_drivers(timedelta(days=idle_days))
+    db.session.commit()
+    if retired:
+        cache.invalidate(cache.DRIVER_CREATED)
+    click.echo(f'{retired} emergency drivers retired')
@@ -0,0 +1,330 @@
+# order intake queue: accept an order now, place it a moment later
+#
+# Placing an order (pricing, discounts, driver, commit) holds a web worker for
+# the whole time, so when the database is slow at the Friday peak the intake
+# stalls. In queue mode the request only checks the order against the menu
+# and writes it to the Order_Intake table (a durable outbox - it survives a
+# restart), and answers with the intake id right away. Workers take queued
+# entries and run them through place_order, the same as the order form.
+#
+#   - the worker marks an entry Done in the same transaction as the order, so
+#     an order is never placed twice or lost in between
+#   - an entry is only taken when the same customer has nothing older that
+#     is still queued or being placed, so each customer's orders are placed
+#     in the order they came in (their loyalty counter depends on it)
+#   - taking an entry is a conditional UPDATE (Queued -> Processing), so any
+#     number of worker threads and processes can share the queue
+#   - past ORDER_INTAKE_MAX_DEPTH waiting entries new orders are refused
+#     (503 with Retry-After) instead of piling up
+#   - an entry stuck in Processing (its worker died) goes back to the queue
+#     after STALE_AFTER seconds
+#
+# Workers run in their own processes, `flask --app app process-intake
+# --workers 4` (which runs a delivery scheduler too), and/or as threads in the web app when ORDER_INTAKE_WORKERS is
+# set (off by default, so CLI commands and web workers that don't need them
+# don't start any). With ORDER_INTAKE_ASYNC on, one of the two has to run.
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import select, update, func
+from sqlalchemy.orm import aliased
+
+from models import db, Customer, User, OrderIntake, get_menu_catalog
+from order_service import ORDER_ITEM_FIELDS, price_line, sort_lines, place_order
+from delivery_scheduler import delivery_scheduler
+import metrics
+import cache
+
+DEFAULT_WORKERS = 0   # threads in the web app, see above
+DEFAULT_MAX_DEPTH = 500
+IDLE_WAIT = 2.0            # seconds a worker sleeps when the queue is empty
+STALE_AFTER = 120          # seconds in Processing before an entry is taken again
+MAX_ATTEMPTS = 3           # tries for entries that fail on a database error
+CANDIDATES = 10            # entries looked at per claim
+RETRY_AFTER = 5            # seconds, for the Retry-After header when full
+
+WAITING = ('Queued', 'Processing')
+
+class QueueFull(Exception):
+    """Too many orders are waiting already"""
+
+def items_from_lines(lines):
+    # priced order lines back to the plain items we keep in the queue
+    return [{'type': line['item_type'].lower(),
+             'id': line['pizza_id'] or line['drink_id'] or line['dessert_id'],
+             'quantity': line['quantity']}
+            for line in lines]
+
+def queue_depth():
+    return db.session.execute(
+        select(func.count(OrderIntake.intake_id)).where(OrderIntake.status.in_(WAITING))
+    ).scalar()
+
+def enqueue(customer_id, lines, discount_code='', max_depth=DEFAULT_MAX_DEPTH):
+    """Queue an order that was checked against the menu. The caller commits.
+
+    Raises QueueFull when max_depth orders are already waiting.
+    """
+    if queue_depth() >= max_depth:
+        metrics.intake_refused.inc('full')
+        raise QueueFull(f'{max_depth} orders are already waiting')
+    entry = OrderIntake(customer_id=customer_id, status='Queued', created_at=datetime.now(),
+                        payload=json.dumps({'items': items_from_lines(lines), 'discount_code': discount_code}))
+    db.session.add(entry)
+    db.session.flush()
+    metrics.intake_enqueued.inc()
+    return entry
+
+def intake_status(intake_id):
+    """What happened to a queued order, as a dict (None if there is no such entry)"""
+    entry = db.session.get(OrderIntake, intake_id)
+    if entry is None:
+        return None
+    status = {
+        'intake_id': entry.intake_id,
+        'customer_id': entry.customer_id,
+        'status': entry.status,
+        'order_id': entry.order_id,
+        'messages': json.loads(entry.messages) if entry.messages else [],
+        'error': entry.error,
+        'created_at': entry.created_at.isoformat() if entry.created_at else None,
+        'finished_at': entry.finished_at.isoformat() if entry.finished_at else None,
+    }
+    if entry.status == 'Queued':
+        # orders in front of this one
+        status['position'] = db.session.execute(
+            select(func.count(OrderIntake.intake_id))
+            .where(OrderIntake.status == 'Queued', OrderIntake.intake_id < entry.intake_id)
+        ).scalar()
+    return status
+
+# --- workers ------------------------------------------------------------------
+
+def _ready(limit):
+    # oldest queued entries whose customer has nothing older still waiting
+    older = aliased(OrderIntake)
+    blocked = select(older.intake_id).where(
+        older.customer_id == OrderIntake.customer_id,
+        older.status.in_(WAITING),
+        older.intake_id < OrderIntake.intake_id,
+    ).exists()
+    return db.session.execute(
+        select(OrderIntake.intake_id)
+        .where(OrderIntake.status == 'Queued', ~blocked)
+        .order_by(OrderIntake.intake_id)
+        .limit(limit)
+    ).scalars().all()
+
+def claim_next(now=None):
+    """Take the next ready entry for this worker. Returns (intake_id, attempt) or None."""
+    now = now or datetime.now()
+    for intake_id in _ready(CANDIDATES):
+        claimed = db.session.execute(
+            update(OrderIntake)
+            .where(OrderIntake.intake_id == intake_id, OrderIntake.status == 'Queued')
+            .values(status='Processing', started_at=now, attempts=OrderIntake.attempts + 1)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return intake_id, db.session.execute(
+                select(OrderIntake.attempts).where(OrderIntake.intake_id == intake_id)
+            ).scalar()
+    db.session.commit()  # end the read transaction
+    return None
+
+def _finish(intake_id, attempt, **values):
+    # only if we still own the entry (it may have been taken again as stale)
+    return db.session.execute(
+        update(OrderIntake)
+        .where(OrderIntake.intake_id == intake_id, OrderIntake.status == 'Processing',
+               OrderIntake.attempts == attempt)
+        .values(finished_at=datetime.now(), **values)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+def _fail(intake_id, attempt, error, retry=False):
+    if retry and attempt < MAX_ATTEMPTS:
+        db.session.execute(
+            update(OrderIntake)
+            .where(OrderIntake.intake_id == intake_id, OrderIntake.status == 'Processing',
+                   OrderIntake.attempts == attempt)
+            .values(status='Queued', error=error[:255])
+            .execution_options(synchronize_session=False)
+        )
+        outcome = 'retried'
+    else:
+        _finish(intake_id, attempt, status='Failed', error=error[:255])
+        outcome = 'failed'
+    db.session.commit()
+    metrics.intake_processed.inc(outcome)
+    return outcome
+
+def process(intake_id, attempt):
+    """Place the order of a claimed entry. Returns 'done', 'failed' or 'retried'."""
+    entry = db.session.get(OrderIntake, intake_id)
+    if entry.started_at and entry.created_at:
+        metrics.intake_wait_seconds.observe((entry.started_at - entry.created_at).total_seconds())
+    payload = json.loads(entry.payload)
+
+    timer = metrics.StageTimer()
+    row = db.session.execute(
+        select(Customer, User).join(User, User.user_id == Customer.user_id)
+        .where(Customer.customer_id == entry.customer_id)
+    ).first()
+    catalog = get_menu_catalog()
+    lines = []
+    for item in payload['items']:
+        line = price_line(catalog, ORDER_ITEM_FIELDS[item['type']], item['id'], item['quantity'])
+        if line is not None:
+            lines.append(line)
+    timer.lap('lookup')
+    if row is None or not lines:
+        # the customer or everything they ordered went away while it waited
+        db.session.rollback()
+        metrics.order_rollbacks.inc('no_items' if row else 'invalid')
+        timer.done('rejected')
+        return _fail(intake_id, attempt, 'customer not found' if row is None else 'nothing on the menu anymore')
+
+    customer, user = row
+    try:
+        placed = place_order(customer, user, sort_lines(lines), payload.get('discount_code', ''), timer=timer)
+        order = placed.order
+        if not _finish(intake_id, attempt, status='Done', order_id=order.order_id,
+                       messages=json.dumps(placed.messages), error=None):
+            raise RuntimeError(f'intake {intake_id} was taken over by another worker')
+        order_id, created_at, staff_id = order.order_id, order.created_at, order.staff_id
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        cause = metrics.rollback_cause(e)
+        metrics.order_rollbacks.inc(cause)
+        timer.done('failed')
+        # lock timeouts and deadlocks are worth another try, the rest is not
+        return _fail(intake_id, attempt, str(e), retry=cause == 'operational')
+    timer.lap('commit')
+    metrics.orders_created.inc()
+    metrics.intake_processed.inc('done')
+    timer.done('created')
+
+    cache.invalidate(cache.ORDER_CREATED)
+    if placed.new_driver:
+        cache.invalidate(cache.DRIVER_CREATED)
+    delivery_scheduler.order_placed(order_id, created_at, staff_id)
+    return 'done'
+
+def requeue_stale(now=None):
+    """Put entries whose worker went away back in the queue. Returns how many.
+
+    Entries that already had MAX_ATTEMPTS tries are failed instead, so an
+    order that takes its worker down every time doesn't come back forever.
+    """
+    now = now or datetime.now()
+    stale = (OrderIntake.status == 'Processing',
+             OrderIntake.started_at < now - timedelta(seconds=STALE_AFTER))
+    db.session.execute(
+        update(OrderIntake)
+        .where(*stale, OrderIntake.attempts >= MAX_ATTEMPTS)
+        .values(status='Failed', finished_at=now, error='worker stopped while placing the order')
+        .execution_options(synchronize_session=False)
+    )
+    moved = db.session.execute(
+        update(OrderIntake)
+        .where(*stale)
+        .values(status='Queued')
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return moved
+
+def run_once():
+    """Claim and place one entry (needs an app context). Returns the outcome or None."""
+    claimed = claim_next()
+    if claimed is None:
+        return None
+    return process(*claimed)
+
+class IntakeWorkers:
+    """A pool of threads working through the intake queue"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.workers = 0
+        self._threads = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['intake_workers'] = self
+        self.workers = app.config.get('ORDER_INTAKE_WORKERS', DEFAULT_WORKERS)
+        if self.workers and not app.testing:
+            self.start()
+
+    def notify(self):
+        # something was queued, don't wait for the idle timeout
+        self._wake.set()
+
+    def start(self, workers=None):
+        if self._threads:
+            return
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._run, name=f'intake-worker-{n}', daemon=True)
+                         for n in range(workers or self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        last_stale_check = 0.0
+        while not self._stop.is_set():
+            outcome = None
+            with self.app.app_context():
+                try:
+                    if time.monotonic() - last_stale_check > STALE_AFTER / 4:
+                        requeue_stale()
+                        last_stale_check = time.monotonic()
+                    outcome = run_once()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Intake worker error: {e}")
+                finally:
+                    db.session.remove()
+            if outcome is None:
+                # nothing ready (or the database is down): wait for new orders
+                self._wake.wait(IDLE_WAIT)
+                self._wake.clear()
+
+# shared workers, set up in create_app like the delivery scheduler
+intake_workers = IntakeWorkers()
+
+@click.command('process-intake')
+@click.option('--workers', type=int, default=4, help='Worker threads in this process.')
+def process_intake_command(workers):
+    """Place queued orders until stopped (Ctrl-C)."""
+    # the app may have started its own workers already, use our number instead
+    intake_workers.stop()
+    intake_workers.start(workers)
+    # and move the orders placed here along (no request ever starts it in
+    # this process)
+    if current_app.config.get('DELIVERY_SCHEDULER_ENABLED', True):
+        delivery_scheduler.start()
+    click.echo(f'{workers} intake workers running, Ctrl-C to stop')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        intake_workers.stop()
+        delivery_scheduler.stop()
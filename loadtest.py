@@ -0,0 +1,221 @@
+# load test for order intake: many customers ordering at the same time
+#
+# Worker threads act as customers all over town and keep posting
+# /orders/create through the Flask test client (so the whole app runs, just
+# without a web server in front). Some orders use discount codes from a small
+# shared pool, and customers are picked from a limited set, so the workers
+# really fight over the same drivers, codes and loyalty counters.
+#
+# At the end it prints throughput and latency percentiles, and checks that
+# the database still makes sense:
+#   - no driver is on two delivery runs at once (a run is the orders one
+#     driver got at the same moment, one order each without DELIVERY_BATCHING)
+#   - no discount code was redeemed by two orders
+#   - every customer's loyalty counter (and ledger) matches the pizzas they ordered
+#   - no order was left without items
+#
+#   python loadtest.py --workers 32 --duration 30
+#   python loadtest.py --database-url mysql+pymysql://... --workers 64
+import random
+import threading
+import time
+from collections import Counter
+from datetime import date
+
+import click
+from sqlalchemy import select, func
+
+from models import db, Customer, User, Order, OrderItem, OrderDiscount, DiscountCode, get_menu_catalog
+from datagen import SCALES
+from bench import bench_app, percentile
+from loyalty import ledger_counters
+from delivery_scheduler import dispatch_time
+
+ACTIVE_STATUSES = ('Pending', 'In Progress', 'Out for Delivery')
+
+class Outcome:
+    """What the workers saw, shared between them"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []        # ms, successful orders
+        self.failures = Counter()  # first error message -> count
+
+    def record(self, took, error=None):
+        with self._lock:
+            if error is None:
+                self.latencies.append(took * 1000)
+            else:
+                self.failures[error] += 1
+
+class LoadTest:
+    def __init__(self, app, workers, customers, code_share, seed=1):
+        self.app = app
+        self.workers = workers
+        self.code_share = code_share
+        self.rng = random.Random(seed)
+        with app.app_context():
+            # customers from every postal code, a few of each
+            rows = db.session.execute(
+                select(Customer.customer_id, User.postal_code)
+                .join(User, User.user_id == Customer.user_id)
+                .order_by(Customer.customer_id)
+            ).all()
+            by_code = {}
+            for customer_id, postal_code in rows:
+                by_code.setdefault(postal_code, []).append(customer_id)
+            self.customer_ids = []
+            while len(self.customer_ids) < min(customers, len(rows)):
+                for ids in by_code.values():
+                    if ids and len(self.customer_ids) < customers:
+                        self.customer_ids.append(ids.pop(self.rng.randrange(len(ids))))
+            self.codes = db.session.execute(
+                select(DiscountCode.code_name)
+                .where(DiscountCode.is_used == False, DiscountCode.expiry_date >= date.today())
+                .limit(max(1, workers // 4))
+            ).scalars().all()
+            catalog = get_menu_catalog()
+            self.pizza_ids = [pizza.pizza_id for pizza in catalog.pizzas]
+            self.drink_ids = [drink.drink_id for drink in catalog.drinks]
+            # loyalty counters before the test, to replay the orders on
+            self.start_counters = dict(db.session.execute(
+                select(Customer.customer_id, Customer.total_pizzas_ordered)
+                .where(Customer.customer_id.in_(self.customer_ids))
+            ).all())
+            self.first_order_id = (db.session.execute(select(func.max(Order.order_id))).scalar() or 0) + 1
+            db.session.remove()
+
+    def _order_form(self, rng):
+        form = {'customer_id': rng.choice(self.customer_ids)}
+        for pizza_id in rng.sample(self.pizza_ids, rng.randint(1, min(2, len(self.pizza_ids)))):
+            form[f'pizza_{pizza_id}'] = rng.randint(1, 3)
+        if self.drink_ids and rng.random() < 0.5:
+            form[f'drink_{rng.choice(self.drink_ids)}'] = 1
+        if self.codes and rng.random() < self.code_share:
+            form['discount_code'] = rng.choice(self.codes)
+        return form
+
+    def _worker(self, seed, deadline, outcome):
+        rng = random.Random(seed)
+        client = self.app.test_client()
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                response = client.post('/orders/create', data=self._order_form(rng))
+                took = time.perf_counter() - started
+            except Exception as e:
+                outcome.record(0, f'{type(e).__name__}: {e}')
+                continue
+            if '/orders/' in response.headers.get('Location', ''):
+                outcome.record(took)
+                continue
+            # the reason is in the flashed messages
+            with client.session_transaction() as session:
+                flashes = session.pop('_flashes', [])
+            errors = [message for category, message in flashes if category == 'error']
+            outcome.record(took, (errors or ['no reason given'])[0][:120])
+
+    def run(self, duration):
+        outcome = Outcome()
+        deadline = time.monotonic() + duration
+        threads = [threading.Thread(target=self._worker, args=(self.rng.random(), deadline, outcome))
+                   for _ in range(self.workers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcome, time.perf_counter() - started
+
+    # --- invariants ---------------------------------------------------------
+
+    def check_invariants(self):
+        """Problems found in the data, as readable lines"""
+        problems = []
+        with self.app.app_context():
+            dispatched_at = dispatch_time()
+            for staff_id, count in db.session.execute(
+                select(Order.staff_id, func.count(func.distinct(dispatched_at)))
+                .where(Order.delivery_status.in_(ACTIVE_STATUSES), Order.staff_id.isnot(None))
+                .group_by(Order.staff_id).having(func.count(func.distinct(dispatched_at)) > 1)
+            ):
+                problems.append(f'driver {staff_id} is on {count} delivery runs')
+
+            for code_name, count in db.session.execute(
+                select(DiscountCode.code_name, func.count(OrderDiscount.order_discount_id))
+                .join(OrderDiscount, OrderDiscount.code_id == DiscountCode.code_id)
+                .group_by(DiscountCode.code_id, DiscountCode.code_name)
+                .having(func.count(OrderDiscount.order_discount_id) > 1)
+            ):
+                problems.append(f'discount code {code_name} was redeemed {count} times')
+
+            for (order_id,) in db.session.execute(
+                select(Order.order_id)
+                .outerjoin(OrderItem, OrderItem.order_id == Order.order_id)
+                .where(Order.order_id >= self.first_order_id, OrderItem.order_item_id.is_(None))
+            ):
+                problems.append(f'order {order_id} has no items')
+
+            # replay every new order on the counters the way create_order does
+            # (10+ pizzas: discount and start over, otherwise add the pizzas)
+            expected = dict(self.start_counters)
+            pizzas = func.coalesce(func.sum(OrderItem.quantity), 0)
+            for customer_id, order_id, count in db.session.execute(
+                select(Order.customer_id, Order.order_id, pizzas)
+                .outerjoin(OrderItem, (OrderItem.order_id == Order.order_id) & (OrderItem.item_type == 'Pizza'))
+                .where(Order.order_id >= self.first_order_id)
+                .group_by(Order.customer_id, Order.order_id)
+                .order_by(Order.order_id)
+            ):
+                if customer_id not in expected:
+                    continue
+                expected[customer_id] = 0 if expected[customer_id] >= 10 else expected[customer_id] + count
+            for customer_id, actual in db.session.execute(
+                select(Customer.customer_id, Customer.total_pizzas_ordered)
+                .where(Customer.customer_id.in_(list(expected)))
+            ):
+                if actual != expected[customer_id]:
+                    problems.append(f'customer {customer_id} has loyalty counter {actual}, '
+                                    f'orders say {expected[customer_id]}')
+
+            # and the ledger has to add up to the same counters
+            for customer_id, count in ledger_counters(list(expected)).items():
+                if count != expected[customer_id]:
+                    problems.append(f'customer {customer_id} has loyalty ledger {count}, '
+                                    f'orders say {expected[customer_id]}')
+        return problems
+
+@click.command()
+@click.option('--scale', type=click.Choice(list(SCALES)), default='small', help='How much data to generate.')
+@click.option('--database-url', help='Load test this database (no data is generated).')
+@click.option('--workers', type=int, default=16, help='Customers ordering at the same time.')
+@click.option('--customers', type=int, default=200, help='Distinct customers the workers order as.')
+@click.option('--duration', type=float, default=20.0, help='Seconds to keep ordering.')
+@click.option('--code-share', type=float, default=0.2, help='Share of orders that try a discount code.')
+@click.option('--seed', type=int, default=42)
+def main(scale, database_url, workers, customers, duration, code_share, seed):
+    """Order intake under concurrent load, with invariant checks."""
+    with bench_app(scale, database_url, seed) as app:
+        test = LoadTest(app, workers, customers, code_share, seed)
+        click.echo(f'{workers} workers, {len(test.customer_ids)} customers, '
+                   f'{len(test.codes)} shared discount codes, {duration:g}s')
+        outcome, elapsed = test.run(duration)
+        problems = test.check_invariants()
+
+    latencies = sorted(outcome.latencies)
+    failed = sum(outcome.failures.values())
+    click.echo(f'orders: {len(latencies)} ok, {failed} failed in {elapsed:.1f}s '
+               f'= {len(latencies) / elapsed:.1f} orders/s')
+    if latencies:
+        click.echo('latency ms: ' + '  '.join(f'p{q} {percentile(latencies, q):.1f}' for q in (50, 90, 99, 99.9))
+                   + f'  max {latencies[-1]:.1f}')
+    for message, count in outcome.failures.most_common(10):
+        click.echo(f'  failed {count}x: {message}')
+    for problem in problems:
+        click.echo(f'INVARIANT {problem}')
+    if problems:
+        raise click.ClickException(f'{len(problems)} invariant violations')
+    click.echo('invariants hold')
+
+if __name__ == '__main__':
+    main()
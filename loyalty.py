@@ -0,0 +1,185 @@
+# loyalty counter: 10% off once a customer has LOYALTY_THRESHOLD+ pizzas
+#
+# Customer.total_pizzas_ordered used to be read, changed in Python and written
+# back by every order, so two orders of the same customer at the same time
+# could both read the old number and one of them got lost. Now an order
+# touches the counter with two conditional UPDATEs, one of which changes it:
+#
+#   UPDATE Customer SET total_pizzas_ordered = 0
+#   WHERE customer_id = :id AND total_pizzas_ordered >= 10      -- discount!
+#
+#   UPDATE Customer SET total_pizzas_ordered = total_pizzas_ordered + :pizzas
+#   WHERE customer_id = :id                                     -- otherwise
+#
+# The database does the arithmetic on the row it has locked, so nothing is
+# lost and only one of two racing orders gets the discount. The row lock is
+# taken at the end of place_order, so it is held only until the commit.
+#
+# Next to that every order appends a row to Loyalty_Ledger with its pizzas
+# and whether it got the discount. The ledger is the history the counter can
+# be rebuilt from (replay()); the counter is the quick copy the checkout and
+# the reports read. Once in a while compact_ledger() (`flask --app app
+# compact-loyalty`, from cron) folds each customer's older entries into one
+# `folded` entry holding the counter as it was then, and puts counters that
+# don't match their ledger right.
+#
+# A ledger only starts from the counter when migration 6 seeded it with a
+# folded entry. Databases made with create_all() or from the SQL files have
+# counters but no seed, so a ledger without a folded or redeemed entry is
+# taken to start at whatever part of the counter its entries don't explain
+# (ledger_start()), and compaction folds that in instead of wiping it.
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import select, update, delete, insert, func
+
+from models import db, Customer, LoyaltyLedger, LOYALTY_THRESHOLD
+import metrics
+
+LOYALTY_RATE = 0.10
+KEEP_DAYS = 7          # entries younger than this are left as they are
+BATCH_SIZE = 500       # customers per compaction transaction
+
+def count_order(customer_id, order_id, pizzas, now=None):
+    """Count an order towards the customer's loyalty discount.
+
+    Returns True when the customer had LOYALTY_THRESHOLD+ pizzas waiting: this
+    order gets the discount and the counter starts over at 0 (the order's own
+    pizzas don't count then). The caller commits.
+    """
+    redeemed = db.session.execute(
+        update(Customer)
+        .where(Customer.customer_id == customer_id, Customer.total_pizzas_ordered >= LOYALTY_THRESHOLD)
+        .values(total_pizzas_ordered=0)
+        .execution_options(synchronize_session=False)
+    ).rowcount > 0
+    if not redeemed and pizzas:
+        db.session.execute(
+            update(Customer)
+            .where(Customer.customer_id == customer_id)
+            .values(total_pizzas_ordered=func.coalesce(Customer.total_pizzas_ordered, 0) + pizzas)
+            .execution_options(synchronize_session=False)
+        )
+    if redeemed or pizzas:
+        db.session.execute(insert(LoyaltyLedger).values(
+            customer_id=customer_id, order_id=order_id, pizzas=pizzas, redeemed=redeemed,
+            folded=False, created_at=now or datetime.now()))
+    if redeemed:
+        metrics.loyalty_discounts.inc()
+    return redeemed
+
+def replay(entries, start=0):
+    """The counter after these ledger entries (oldest first)"""
+    count = start
+    for entry in entries:
+        if entry.folded:
+            count = entry.pizzas
+        elif entry.redeemed:
+            count = 0
+        else:
+            count += entry.pizzas
+    return count
+
+def _entries(customer_ids):
+    # customer_id -> their ledger entries, oldest first
+    by_customer = defaultdict(list)
+    for entry in db.session.execute(
+        select(LoyaltyLedger.entry_id, LoyaltyLedger.customer_id, LoyaltyLedger.pizzas,
+               LoyaltyLedger.redeemed, LoyaltyLedger.folded)
+        .where(LoyaltyLedger.customer_id.in_(customer_ids))
+        .order_by(LoyaltyLedger.customer_id, LoyaltyLedger.entry_id)
+    ):
+        by_customer[entry.customer_id].append(entry)
+    return by_customer
+
+def ledger_counters(customer_ids):
+    """customer_id -> the counter their ledger adds up to"""
+    by_customer = _entries(list(customer_ids))
+    return {customer_id: replay(by_customer.get(customer_id, ())) for customer_id in customer_ids}
+
+def ledger_start(entries, counter):
+    """Where a ledger starts: 0, or for an unseeded one what the counter had before it"""
+    if any(entry.folded or entry.redeemed for entry in entries):
+        return 0  # the counter is known from there on
+    return max(0, (counter or 0) - sum(entry.pizzas for entry in entries))
+
+def _compact_customers(customer_ids, watermark):
+    # fold the entries up to the watermark of these customers, one transaction
+    # lock the counters first: orders update the counter before they add
+    # their entry, so nothing is added to these ledgers until we commit
+    counters = dict(db.session.execute(
+        select(Customer.customer_id, Customer.total_pizzas_ordered)
+        .where(Customer.customer_id.in_(customer_ids))
+        .with_for_update()
+    ).all())
+    dropped, folds, repairs = [], [], []
+    for customer_id, entries in _entries(customer_ids).items():
+        old = [entry for entry in entries if entry.entry_id <= watermark]
+        start = ledger_start(entries, counters.get(customer_id))
+        count = replay(entries, start)
+        if (counters.get(customer_id) or 0) != count:
+            repairs.append({'customer_id': customer_id, 'total_pizzas_ordered': count})
+        if not old:
+            continue
+        folded = replay(old, start)
+        if folded:
+            # the newest old entry becomes the folded one, so it keeps its place
+            folds.append({'entry_id': old[-1].entry_id, 'order_id': None, 'pizzas': folded,
+                          'redeemed': False, 'folded': True})
+            old = old[:-1]
+        dropped.extend(entry.entry_id for entry in old)
+
+    if dropped:
+        db.session.execute(delete(LoyaltyLedger).where(LoyaltyLedger.entry_id.in_(dropped)))
+    if folds:
+        db.session.execute(update(LoyaltyLedger), folds)
+    if repairs:
+        db.session.execute(update(Customer), repairs)
+    db.session.commit()
+    return len(dropped), len(repairs)
+
+def compact_ledger(keep_days=KEEP_DAYS, batch_size=BATCH_SIZE, now=None):
+    """Fold ledger entries older than keep_days into one entry per customer.
+
+    Also sets counters that don't match their ledger to what the ledger says.
+    Commits every batch_size customers. Returns a dict of what was done.
+    """
+    now = now or datetime.now()
+    watermark = db.session.execute(
+        select(func.max(LoyaltyLedger.entry_id))
+        .where(LoyaltyLedger.created_at < now - timedelta(days=keep_days))
+    ).scalar()
+    stats = {'customers': 0, 'entries_removed': 0, 'counters_repaired': 0}
+    if watermark is None:
+        return stats
+
+    last_customer = 0
+    while True:
+        # customers with something to fold, a batch at a time
+        customer_ids = db.session.execute(
+            select(LoyaltyLedger.customer_id)
+            .where(LoyaltyLedger.entry_id <= watermark, LoyaltyLedger.folded == False,
+                   LoyaltyLedger.customer_id > last_customer)
+            .group_by(LoyaltyLedger.customer_id)
+            .order_by(LoyaltyLedger.customer_id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not customer_ids:
+            break
+        removed, repaired = _compact_customers(customer_ids, watermark)
+        stats['customers'] += len(customer_ids)
+        stats['entries_removed'] += removed
+        stats['counters_repaired'] += repaired
+        last_customer = customer_ids[-1]
+    db.session.commit()
+    return stats
+
+@click.command('compact-loyalty')
+@click.option('--keep-days', type=int, default=KEEP_DAYS, help='Leave entries younger than this.')
+@click.option('--batch-size', type=int, default=BATCH_SIZE, help='Customers per transaction.')
+def compact_loyalty_command(keep_days, batch_size):
+    """Fold old loyalty ledger entries into the counters."""
+    stats = compact_ledger(keep_days, batch_size)
+    click.echo(f"{stats['customers']} customers compacted, {stats['entries_removed']} entries removed, "
+               f"{stats['counters_repaired']} counters repaired")
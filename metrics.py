@@ -0,0 +1,208 @@
+# counters and latency histograms for the order pipeline, for Prometheus
+#
+# create_order goes through a few stages (look up the customer and menu, save
+# the order and its lines, work out the discounts, find a driver, maybe hire
+# an emergency one, add up the totals and rollups, commit). A StageTimer laps
+# the clock between them, so we can see which stage the time goes to under
+# load. Next to that there are
+# counters for created orders (orders/s is rate(...) in Prometheus), emergency
+# drivers, rejected discount codes, rollbacks by cause and batch orders that
+# failed validation (those never got a transaction to roll back).
+#
+# Everything lives in memory in this process and is served at /metrics in
+# the Prometheus text format. Recording is a lock and a few additions, so it
+# can stay on in production. With several worker processes each one has its
+# own numbers (Prometheus adds them up per instance).
+import bisect
+import threading
+import time
+
+# seconds; order stages are mostly milliseconds, a commit waiting on locks can take seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """A number that only goes up, optionally one per label value"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, _label_text(self.labels, label_values), value
+
+class Histogram:
+    """Observed durations counted into fixed buckets, optionally per label value"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}    # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            series = sorted((label_values, list(values)) for label_values, values in self._series.items())
+        names = self.labels + ('le',)
+        for label_values, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                yield self.name + '_bucket', _label_text(names, label_values + (_number(bound),)), cumulative
+            yield self.name + '_bucket', _label_text(names, label_values + ('+Inf',)), values[-1]
+            yield self.name + '_sum', _label_text(self.labels, label_values), values[-2]
+            yield self.name + '_count', _label_text(self.labels, label_values), values[-1]
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, extra=()):
+        """Everything in the Prometheus text format.
+
+        extra are (name, help, value) gauges read at scrape time, like the
+        connection pool numbers.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_number(value)}')
+        for name, help, value in extra:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# --- the order pipeline -----------------------------------------------------
+
+ORDER_STAGES = ('lookup', 'order_lines', 'discounts', 'driver', 'emergency_driver', 'totals', 'commit')
+
+order_stage_seconds = registry.histogram(
+    'mamma_mia_order_stage_seconds', 'Time spent in each stage of create_order.', labels=('stage',))
+order_seconds = registry.histogram(
+    'mamma_mia_order_seconds', 'Time create_order took, by outcome.', labels=('outcome',))
+orders_created = registry.counter(
+    'mamma_mia_orders_created_total', 'Orders committed.')
+emergency_drivers_created = registry.counter(
+    'mamma_mia_emergency_drivers_created_total', 'Emergency drivers created because nobody was free.')
+emergency_drivers_reused = registry.counter(
+    'mamma_mia_emergency_drivers_reused_total', 'Emergency drivers put to work again instead of created, by how.',
+    labels=('how',))
+emergency_drivers_refused = registry.counter(
+    'mamma_mia_emergency_drivers_refused_total', 'Orders left waiting because the area emergency pool was full.')
+emergency_drivers_retired = registry.counter(
+    'mamma_mia_emergency_drivers_retired_total', 'Emergency drivers retired after a long idle time.')
+discount_code_rejects = registry.counter(
+    'mamma_mia_discount_code_rejects_total', 'Discount codes refused at checkout, by reason.', labels=('reason',))
+loyalty_discounts = registry.counter(
+    'mamma_mia_loyalty_discounts_total', 'Orders that got the 10% loyalty discount.')
+delivery_run_orders = registry.histogram(
+    'mamma_mia_delivery_run_orders', 'Orders per delivery run sent out by the dispatcher.',
+    buckets=(1, 2, 3, 4, 6, 8, 12))
+order_rollbacks = registry.counter(
+    'mamma_mia_order_rollbacks_total', 'create_order transactions rolled back, by cause.', labels=('cause',))
+orders_rejected = registry.counter(
+    'mamma_mia_orders_rejected_total', 'Batch orders that failed validation (nothing was saved), by reason.',
+    labels=('reason',))
+batch_stage_seconds = registry.histogram(
+    'mamma_mia_batch_stage_seconds', 'Time spent in the stages a whole order batch shares.', labels=('stage',))
+
+def rollback_cause(error):
+    """A short, fixed name for why an order transaction failed"""
+    # by class name so we don't depend on which driver raised it
+    names = {cls.__name__ for cls in type(error).__mro__}
+    if 'IntegrityError' in names:
+        return 'integrity'
+    if 'OperationalError' in names:
+        return 'operational'    # deadlocks, lock wait timeouts, lost connections
+    if 'SQLAlchemyError' in names:
+        return 'database'
+    if isinstance(error, ValueError):
+        return 'validation'
+    return 'error'
+
+class StageTimer:
+    """Laps the clock between the stages of one create_order call"""
+
+    def __init__(self, histogram=None):
+        self.histogram = histogram or order_stage_seconds
+        self.started = self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.histogram.observe(now - self._last, stage)
+        self._last = now
+
+    def skip(self):
+        # don't count the time since the last lap towards the next stage
+        self._last = time.perf_counter()
+
+    def done(self, outcome):
+        order_seconds.observe(time.perf_counter() - self.started, outcome)
+
+# --- the order intake queue (intake.py) ---------------------------------------
+
+intake_enqueued = registry.counter(
+    'mamma_mia_intake_enqueued_total', 'Orders accepted into the intake queue.')
+intake_refused = registry.counter(
+    'mamma_mia_intake_refused_total', 'Orders refused at intake, by reason.', labels=('reason',))
+intake_processed = registry.counter(
+    'mamma_mia_intake_processed_total', 'Queued orders a worker finished, by outcome.', labels=('outcome',))
+intake_wait_seconds = registry.histogram(
+    'mamma_mia_intake_wait_seconds', 'Time an order waited in the queue before a worker took it.',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
@@ -0,0 +1,158 @@
+# versioned schema changes for databases that already exist
+#
+# sql/mamma_mia_pizza-schema.sql always describes the newest schema, but a
+# database made from an older copy of it is missing the tables, columns and
+# indexes added since. Every change is a numbered step below; `flask migrate` runs
+# the steps a database hasn't had yet, in order, and writes them down in the
+# schema_migrations table. Steps only ever add things (step 12 rebuilds the
+# rollup tables, rows included) and check first, so running them on a
+# database that already has them just records them.
+from datetime import datetime
+
+import click
+from sqlalchemy import select, insert, update, func, true, false, inspect, text
+from sqlalchemy.schema import CreateColumn
+
+from models import (db, SchemaMigration, OrderIntake, DiscountCampaign, LoyaltyLedger, Customer, Staff, User, Order,
+                    DataVersion, DailyPizzaSales, DailyGenderSales, DailyAgeGroupSales, DailyPostalCodeSales)
+
+# (version, name, step) - append new steps at the end, never renumber
+MIGRATIONS = []
+
+def migration(version, name):
+    def register(step):
+        MIGRATIONS.append((version, name, step))
+        return step
+    return register
+
+def _create_tables(conn, *models):
+    for model in models:
+        model.__table__.create(conn, checkfirst=True)
+
+def _add_columns(conn, model, *names):
+    # ALTER TABLE ... ADD COLUMN for columns declared on the model, unless there already
+    table = model.__table__
+    existing = {column['name'] for column in inspect(conn).get_columns(table.name)}
+    for name in names:
+        if name not in existing:
+            column = CreateColumn(table.c[name]).compile(dialect=conn.dialect)
+            conn.execute(text(f'ALTER TABLE {conn.dialect.identifier_preparer.format_table(table)} ADD COLUMN {column}'))
+
+def _create_indexes(conn, *names):
+    # the indexes are declared on the models (__table_args__), look them up by name
+    indexes = {index.name: index for table in db.metadata.tables.values() for index in table.indexes}
+    for name in names:
+        indexes[name].create(conn, checkfirst=True)
+
+@migration(1, 'daily reporting rollups')
+def add_rollup_tables(conn):
+    _create_tables(conn, DailyPizzaSales, DailyGenderSales, DailyAgeGroupSales, DailyPostalCodeSales)
+
+@migration(2, 'dispatch and order list indexes')
+def add_dispatch_indexes(conn):
+    _create_indexes(conn, 'ix_staff_dispatch', 'ix_orders_created', 'ix_orders_customer_created')
+
+@migration(3, 'hot path indexes')
+def add_hot_path_indexes(conn):
+    # Discount_Code.code_name is already UNIQUE, so it has its index
+    _create_indexes(conn, 'ix_orders_status_created', 'ix_orders_staff_status',
+                    'ix_order_item_order_type', 'ix_order_item_pizza')
+
+@migration(4, 'order intake queue')
+def add_order_intake(conn):
+    # the table comes with its indexes
+    _create_tables(conn, OrderIntake)
+
+@migration(5, 'discount code campaigns')
+def add_discount_campaigns(conn):
+    _create_tables(conn, DiscountCampaign)
+
+@migration(6, 'loyalty ledger')
+def add_loyalty_ledger(conn):
+    _create_tables(conn, LoyaltyLedger)
+    _create_indexes(conn, 'ix_customer_loyalty')
+    # the counters as they are now are where every customer's ledger starts
+    has_ledger = select(LoyaltyLedger.entry_id).where(LoyaltyLedger.customer_id == Customer.customer_id).exists()
+    conn.execute(insert(LoyaltyLedger).from_select(
+        ['customer_id', 'pizzas', 'redeemed', 'folded', 'created_at'],
+        select(Customer.customer_id, Customer.total_pizzas_ordered, false(), true(), func.now())
+        .where(Customer.total_pizzas_ordered > 0, ~has_ledger)
+    ))
+
+@migration(7, 'emergency driver pool')
+def add_driver_pool(conn):
+    _add_columns(conn, Staff, 'is_emergency', 'is_retired')
+    _create_indexes(conn, 'ix_staff_pool')
+    # until now emergency drivers were only told apart by their email
+    conn.execute(
+        update(Staff)
+        .where(Staff.user_id.in_(select(User.user_id).where(User.email.like('%@mammamiapizza.com'))))
+        .values(is_emergency=True)
+    )
+
+@migration(8, 'delivery runs')
+def add_dispatched_at(conn):
+    # orders from before count from created_at (see delivery_scheduler.py)
+    _add_columns(conn, Order, 'dispatched_at')
+
+@migration(9, 'data versions')
+def add_data_versions(conn):
+    _create_tables(conn, DataVersion)
+
+@migration(10, 'driver order list index')
+def add_staff_order_index(conn):
+    # the orders list filtered by driver pages through this like the others
+    _create_indexes(conn, 'ix_orders_staff_created')
+
+@migration(11, 'campaign code keys')
+def add_campaign_code_key(conn):
+    # campaigns without a key keep their affine codes (see campaigns.py)
+    _add_columns(conn, DiscountCampaign, 'code_key')
+
+@migration(12, 'rollup slots')
+def add_rollup_slots(conn):
+    # the new slot column is part of the primary key, which can't be changed
+    # in place everywhere: copy each table's rows into slot 0 of a new one
+    for model in (DailyPizzaSales, DailyGenderSales, DailyAgeGroupSales, DailyPostalCodeSales):
+        table = model.__table__
+        if 'slot' in {column['name'] for column in inspect(conn).get_columns(table.name)}:
+            continue
+        rows = [dict(row, slot=0) for row in conn.execute(
+            select(*[column for column in table.c if column.name != 'slot'])).mappings()]
+        table.drop(conn)
+        table.create(conn)
+        if rows:
+            conn.execute(table.insert(), rows)
+
+def applied_versions(engine):
+    with engine.begin() as conn:
+        SchemaMigration.__table__.create(conn, checkfirst=True)
+        return set(conn.execute(select(SchemaMigration.version)).scalars())
+
+def migrate(engine=None):
+    """Apply the steps this database doesn't have yet.
+
+    Each step runs in its own transaction together with its schema_migrations
+    row (MySQL commits DDL straight away, which is why the steps check first).
+    Returns the (version, name) of the steps that ran.
+    """
+    engine = engine or db.engine
+    done = applied_versions(engine)
+    ran = []
+    for version, name, step in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in done:
+            continue
+        with engine.begin() as conn:
+            step(conn)
+            conn.execute(insert(SchemaMigration).values(version=version, name=name, applied_at=datetime.now()))
+        ran.append((version, name))
+    return ran
+
+@click.command('migrate')
+def migrate_command():
+    """Bring the database schema up to date."""
+    ran = migrate()
+    for version, name in ran:
+        click.echo(f'applied {version}: {name}')
+    if not ran:
+        click.echo('schema is up to date')
@@ -1,6 +1,14 @@
 # stuff we need to import for database
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, date
+from sqlalchemy import event, select, update, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from datetime import datetime, date, timezone
+from collections import namedtuple
+import hashlib
+import threading
+import time
 
 # make database connection
 db = SQLAlchemy()
@@ -39,11 +47,20 @@ class User(db.Model):
     def __repr__(self):
         return f'<User {self.get_full_name()}>'
 
+# pizzas a customer orders before they get 10% off (see loyalty.py)
+LOYALTY_THRESHOLD = 10
+
 class Customer(db.Model):
     # people who order pizzas
     __tablename__ = 'Customer'
+    __table_args__ = (
+        # the reports count customers with a loyalty discount waiting
+        db.Index('ix_customer_loyalty', 'total_pizzas_ordered'),
+    )
     
     customer_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # pizzas since the last loyalty discount, kept up to date from the
+    # Loyalty_Ledger with atomic increments
     total_pizzas_ordered = db.Column(db.Integer, default=0)
     user_id = db.Column(db.Integer, db.ForeignKey('User.user_id'), nullable=False)
     
@@ -52,7 +69,7 @@ class Customer(db.Model):
     
     def is_loyal_customer(self):
         # loyal customers get discount if they ordered 10+ pizzas
-        return self.total_pizzas_ordered >= 10
+        return self.total_pizzas_ordered >= LOYALTY_THRESHOLD
     
     def __repr__(self):
         return f'<Customer {self.customer_id}>'
@@ -60,11 +77,21 @@ class Customer(db.Model):
 class Staff(db.Model):
     # people who work here and deliver pizzas
     __tablename__ = 'Staff'
+    __table_args__ = (
+        # dispatch looks up free drivers per area, longest idle first
+        db.Index('ix_staff_dispatch', 'assigned_postal_code', 'is_available', 'last_delivery_time'),
+        # the emergency driver pool looks for idle and retired drivers anywhere
+        db.Index('ix_staff_pool', 'is_emergency', 'is_retired', 'is_available', 'last_delivery_time'),
+    )
     
     staff_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     last_delivery_time = db.Column(db.DateTime)
     is_available = db.Column(db.Boolean, default=True)
     assigned_postal_code = db.Column(db.String(20))  # what area they deliver to
+    # made by the emergency driver pool when nobody was free (see driver_pool.py)
+    is_emergency = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    # emergency driver that was idle too long; kept to be taken on again
+    is_retired = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
     user_id = db.Column(db.Integer, db.ForeignKey('User.user_id'), nullable=False)
     
     # orders they deliver
@@ -80,6 +107,10 @@ class Staff(db.Model):
     def __repr__(self):
         return f'<Staff {self.staff_id}>'
 
+# ingredient categories each diet can eat
+VEGETARIAN_CATEGORIES = ('Vegetable', 'Dairy', 'Vegan', 'Other')
+VEGAN_CATEGORIES = ('Vegan', 'Vegetable', 'Other')
+
 class Ingredient(db.Model):
     # stuff we put on pizzas
     __tablename__ = 'ingredients'
@@ -95,11 +126,11 @@ class Ingredient(db.Model):
     
     def is_vegetarian_friendly(self):
         # check if vegetarians can eat this
-        return self.category in ['Vegetable', 'Dairy', 'Vegan', 'Other']
+        return self.category in VEGETARIAN_CATEGORIES
     
     def is_vegan_friendly(self):
         # check if vegans can eat this
-        return self.category in ['Vegan', 'Vegetable', 'Other']
+        return self.category in VEGAN_CATEGORIES
     
     def __repr__(self):
         return f'<Ingredient {self.name}>'
@@ -144,10 +175,7 @@ class Pizza(db.Model):
     
     def calculate_final_price(self):
         # work out selling price with profit and tax
-        base_cost = self.calculate_base_cost()
-        with_profit = base_cost * 1.40  # add 40% profit
-        with_tax = with_profit * 1.09   # add 9% tax
-        return round(with_tax, 2)
+        return price_from_cost(self.calculate_base_cost())
     
     # easy way to get price
     @property
@@ -157,6 +185,12 @@ class Pizza(db.Model):
     def __repr__(self):
         return f'<Pizza {self.name}>'
 
+def price_from_cost(base_cost):
+    # selling price for a pizza that costs base_cost to make
+    with_profit = base_cost * 1.40  # add 40% profit
+    with_tax = with_profit * 1.09   # add 9% tax
+    return round(with_tax, 2)
+
 class PizzaIngredient(db.Model):
     __tablename__ = 'pizza_ingredients'
     
@@ -197,6 +231,15 @@ class Dessert(db.Model):
 class Order(db.Model):
     # customer orders
     __tablename__ = 'Orders'
+    __table_args__ = (
+        # the /orders list pages through (created_at, order_id), newest first
+        db.Index('ix_orders_created', 'created_at', 'order_id'),
+        db.Index('ix_orders_customer_created', 'customer_id', 'created_at', 'order_id'),
+        db.Index('ix_orders_staff_created', 'staff_id', 'created_at', 'order_id'),
+        # delivery steps, driver board and undelivered orders filter on status
+        db.Index('ix_orders_status_created', 'delivery_status', 'created_at'),
+        db.Index('ix_orders_staff_status', 'staff_id', 'delivery_status'),
+    )
     
     order_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('Customer.customer_id'), nullable=False)
@@ -204,6 +247,8 @@ class Order(db.Model):
     delivery_status = db.Column(db.Enum('Pending', 'In Progress', 'Out for Delivery', 'Delivered', 'Cancelled', 
                                        name='delivery_status_enum'), default='Pending')
     created_at = db.Column(db.DateTime, default=datetime.now)
+    # when it got its driver (the delivery steps count from here, see delivery_scheduler.py)
+    dispatched_at = db.Column(db.DateTime)
     discount_amount = db.Column(db.Numeric(6, 2), default=0.00)
     final_total = db.Column(db.Numeric(8, 2))
     
@@ -231,6 +276,11 @@ class Order(db.Model):
 class OrderItem(db.Model):
     # items in each order
     __tablename__ = 'Order_Item'
+    __table_args__ = (
+        db.Index('ix_order_item_order_type', 'order_id', 'item_type'),
+        # pizza sales per pizza (rollup rebuild, analytics export)
+        db.Index('ix_order_item_pizza', 'pizza_id'),
+    )
     
     order_item_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     order_id = db.Column(db.Integer, db.ForeignKey('Orders.order_id'), nullable=False)
@@ -265,6 +315,27 @@ class DiscountCode(db.Model):
     def __repr__(self):
         return f'<DiscountCode {self.code_name}>'
 
+class DiscountCampaign(db.Model):
+    # discount codes issued together, named <prefix>-XXXXXXXX (see campaigns.py)
+    __tablename__ = 'Discount_Campaign'
+    
+    campaign_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(100), nullable=False)
+    prefix = db.Column(db.String(20), unique=True, nullable=False)
+    discount_value = db.Column(db.Numeric(5, 2), nullable=False)
+    expiry_date = db.Column(db.Date, nullable=False)
+    code_count = db.Column(db.Integer, nullable=False)
+    issued = db.Column(db.Integer, nullable=False, default=0)  # codes inserted so far
+    # secret the code numbers are encrypted with, so codes can't be guessed
+    # from each other (hex); campaigns from before it use the affine scramble
+    code_key = db.Column(db.String(64))
+    code_multiplier = db.Column(db.BigInteger, nullable=False)
+    code_offset = db.Column(db.BigInteger, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<DiscountCampaign {self.prefix} {self.issued}/{self.code_count}>'
+
 class OrderDiscount(db.Model):
     __tablename__ = 'Order_Discount'
     
@@ -290,4 +361,318 @@ class Transaction(db.Model):
     transaction_date = db.Column(db.DateTime, default=datetime.now)
     
     def __repr__(self):
-        return f'<Transaction {self.transaction_id}>'
\ No newline at end of file
+        return f'<Transaction {self.transaction_id}>'
+
+class SchemaMigration(db.Model):
+    # which migrations.py steps have been applied to this database
+    __tablename__ = 'schema_migrations'
+    
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<SchemaMigration {self.version}>'
+
+class OrderIntake(db.Model):
+    # orders accepted by the intake queue and waiting for a worker (see intake.py)
+    __tablename__ = 'Order_Intake'
+    __table_args__ = (
+        # workers take the oldest queued entries, per customer in order
+        db.Index('ix_intake_status', 'status', 'intake_id'),
+        db.Index('ix_intake_customer', 'customer_id', 'status', 'intake_id'),
+    )
+    
+    intake_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('Customer.customer_id'), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON: items and discount code
+    status = db.Column(db.Enum('Queued', 'Processing', 'Done', 'Failed', name='intake_status_enum'),
+                       nullable=False, default='Queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    order_id = db.Column(db.Integer, db.ForeignKey('Orders.order_id'))
+    messages = db.Column(db.Text)  # JSON list of messages for the customer
+    error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<OrderIntake {self.intake_id} {self.status}>'
+
+class LoyaltyLedger(db.Model):
+    # what every order did to its customer's loyalty counter (see loyalty.py)
+    __tablename__ = 'Loyalty_Ledger'
+    __table_args__ = (
+        # a customer's entries in the order they happened
+        db.Index('ix_loyalty_customer', 'customer_id', 'entry_id'),
+    )
+    
+    entry_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('Customer.customer_id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('Orders.order_id'))  # None for folded entries
+    pizzas = db.Column(db.Integer, nullable=False, default=0)
+    # the order got the loyalty discount and the counter started over
+    redeemed = db.Column(db.Boolean, nullable=False, default=False)
+    # the counter as it was after older entries were folded away, pizzas holds it
+    folded = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    
+    def __repr__(self):
+        return f'<LoyaltyLedger {self.entry_id} customer {self.customer_id}>'
+
+class DataVersion(db.Model):
+    # change counters for data every process keeps its own copy of, so a
+    # change made in one process reaches the others (see discounts.py)
+    __tablename__ = 'Data_Version'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<DataVersion {self.name} {self.version}>'
+
+def data_version(name):
+    """The change counter for name (0 before the first change)"""
+    return db.session.execute(select(DataVersion.version).where(DataVersion.name == name)).scalar() or 0
+
+def bump_data_version(name, session=None):
+    """Count a change to name in the current transaction. The caller commits."""
+    session = session or db.session
+    def bump():
+        return session.execute(
+            update(DataVersion).where(DataVersion.name == name)
+            .values(version=DataVersion.version + 1)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    if bump():
+        return
+    try:
+        with session.begin_nested():
+            session.execute(insert(DataVersion).values(name=name, version=1))
+    except IntegrityError:
+        bump()  # another process made the row just now
+
+# ---------------------------------------------------------------------------
+# Reporting rollups
+#
+# Sales pre-added per day for each report dimension, so the reports page sums
+# at most 30 small rows instead of scanning and joining 30 days of orders.
+# Kept up to date by rollups.py when orders are placed or cancelled.
+#
+# Each day and value is split over rollups.ROLLUP_SLOTS rows (`slot`, picked
+# by order id) so concurrent orders don't all wait on the same few rows; the
+# reports add the slots up like they add up the days.
+# ---------------------------------------------------------------------------
+
+class DailyPizzaSales(db.Model):
+    # pizzas sold per day
+    __tablename__ = 'Daily_Pizza_Sales'
+    
+    sales_date = db.Column(db.Date, primary_key=True)
+    pizza_id = db.Column(db.Integer, db.ForeignKey('pizzas.pizza_id'), primary_key=True)
+    slot = db.Column(db.SmallInteger, primary_key=True, autoincrement=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<DailyPizzaSales {self.sales_date} P{self.pizza_id}>'
+
+class DailyGenderSales(db.Model):
+    # orders and revenue per day and customer gender
+    __tablename__ = 'Daily_Gender_Sales'
+    
+    sales_date = db.Column(db.Date, primary_key=True)
+    gender = db.Column(db.String(10), primary_key=True)
+    slot = db.Column(db.SmallInteger, primary_key=True, autoincrement=False, default=0)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<DailyGenderSales {self.sales_date} {self.gender}>'
+
+class DailyAgeGroupSales(db.Model):
+    # orders and revenue per day and customer age group
+    __tablename__ = 'Daily_Age_Group_Sales'
+    
+    sales_date = db.Column(db.Date, primary_key=True)
+    age_range = db.Column(db.String(10), primary_key=True)
+    slot = db.Column(db.SmallInteger, primary_key=True, autoincrement=False, default=0)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<DailyAgeGroupSales {self.sales_date} {self.age_range}>'
+
+class DailyPostalCodeSales(db.Model):
+    # orders and revenue per day and delivery postal code
+    __tablename__ = 'Daily_Postal_Code_Sales'
+    
+    sales_date = db.Column(db.Date, primary_key=True)
+    postal_code = db.Column(db.String(20), primary_key=True)
+    slot = db.Column(db.SmallInteger, primary_key=True, autoincrement=False, default=0)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Numeric(10, 2), nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<DailyPostalCodeSales {self.sales_date} {self.postal_code}>'
+
+
+# ---------------------------------------------------------------------------
+# Menu catalog snapshot
+#
+# The menu page used to walk pizza -> pizza_ingredients -> ingredient for every
+# price, ingredient list and diet label (one query per pizza and ingredient).
+# Instead we load the whole menu once into read-only tuples and keep it until
+# the menu version changes. Rebuilding makes a brand new MenuCatalog and swaps
+# the module reference, so readers always see either the old or the new menu.
+#
+# The menu version is the 'menu' Data_Version, counted up in the same
+# transaction as the change, so a price changed through one web worker
+# reaches all of them. Each process looks it up (one primary key read) at
+# most every MENU_CHECK_INTERVAL seconds, and at once after its own changes.
+# ---------------------------------------------------------------------------
+
+CatalogIngredient = namedtuple('CatalogIngredient', ['ingredient_id', 'name', 'category'])
+CatalogPizza = namedtuple('CatalogPizza', ['pizza_id', 'name', 'description', 'ingredients',
+                                           'base_cost', 'final_price', 'is_vegetarian', 'is_vegan'])
+CatalogDrink = namedtuple('CatalogDrink', ['drink_id', 'name', 'price'])
+CatalogDessert = namedtuple('CatalogDessert', ['dessert_id', 'name', 'price'])
+
+# models that change what the menu looks like or costs
+MENU_MODELS = (Ingredient, Pizza, PizzaIngredient, Drink, Dessert)
+
+MENU_VERSION = 'menu'
+MENU_CHECK_INTERVAL = 2  # seconds another process's menu change can take to show
+
+_menu_catalog = None
+_menu_checked_at = 0.0  # time.monotonic() of the last look at the menu version
+_menu_catalog_lock = threading.Lock()
+
+class MenuCatalog:
+    # immutable copy of everything on the menu
+
+    def __init__(self, version, pizzas, drinks, desserts, database=None):
+        self.version = version
+        self.database = database  # engine url the menu came from (scripts open several)
+        self.pizzas = tuple(pizzas)
+        self.drinks = tuple(drinks)
+        self.desserts = tuple(desserts)
+        self.pizzas_by_id = {pizza.pizza_id: pizza for pizza in self.pizzas}
+        self.drinks_by_id = {drink.drink_id: drink for drink in self.drinks}
+        self.desserts_by_id = {dessert.dessert_id: dessert for dessert in self.desserts}
+        # for HTTP caching of the menu pages: the same menu always gets the
+        # same etag (in every process), loaded_at stands in for when it changed
+        self.etag = hashlib.sha1(repr((self.pizzas, self.drinks, self.desserts)).encode()).hexdigest()[:16]
+        self.loaded_at = datetime.now(timezone.utc)
+
+    @classmethod
+    def load(cls, version):
+        """Build a catalog from the database (one query per menu table)"""
+        # pizzas with their ingredients in a single joined query
+        rows = db.session.query(Pizza.pizza_id, Pizza.name, Pizza.description,
+                                Ingredient.ingredient_id, Ingredient.name,
+                                Ingredient.category, Ingredient.cost_per_unit)\
+            .outerjoin(PizzaIngredient, PizzaIngredient.pizza_id == Pizza.pizza_id)\
+            .outerjoin(Ingredient, Ingredient.ingredient_id == PizzaIngredient.ingredient_id)\
+            .order_by(Pizza.pizza_id, Ingredient.ingredient_id).all()
+
+        pizza_rows = {}
+        pizza_ingredients = {}
+        pizza_costs = {}
+        for pizza_id, name, description, ingredient_id, ingredient_name, category, cost in rows:
+            if pizza_id not in pizza_rows:
+                pizza_rows[pizza_id] = (name, description)
+                pizza_ingredients[pizza_id] = []
+                pizza_costs[pizza_id] = 0
+            if ingredient_id is not None:
+                pizza_ingredients[pizza_id].append(CatalogIngredient(ingredient_id, ingredient_name, category))
+                pizza_costs[pizza_id] += float(cost)
+
+        pizzas = []
+        for pizza_id, (name, description) in pizza_rows.items():
+            ingredients = tuple(pizza_ingredients[pizza_id])
+            base_cost = pizza_costs[pizza_id]
+            pizzas.append(CatalogPizza(
+                pizza_id=pizza_id,
+                name=name,
+                description=description,
+                ingredients=ingredients,
+                base_cost=base_cost,
+                final_price=price_from_cost(base_cost),
+                is_vegetarian=all(i.category in VEGETARIAN_CATEGORIES for i in ingredients),
+                is_vegan=all(i.category in VEGAN_CATEGORIES for i in ingredients)
+            ))
+
+        drinks = [CatalogDrink(drink_id, name, float(price)) for drink_id, name, price in
+                  db.session.query(Drink.drink_id, Drink.name, Drink.price).order_by(Drink.drink_id)]
+        desserts = [CatalogDessert(dessert_id, name, float(price)) for dessert_id, name, price in
+                    db.session.query(Dessert.dessert_id, Dessert.name, Dessert.price).order_by(Dessert.dessert_id)]
+
+        return cls(version, pizzas, drinks, desserts, db.engine.url)
+
+    def __repr__(self):
+        return f'<MenuCatalog v{self.version} {len(self.pizzas)} pizzas>'
+
+def get_menu_version():
+    return data_version(MENU_VERSION)
+
+def bump_menu_version():
+    """Count a menu change made outside the ORM (raw SQL etc.). The caller commits."""
+    bump_data_version(MENU_VERSION)
+    db.session.info['menu_bumped'] = True
+
+def _recheck_menu():
+    # look at the menu version on the next get_menu_catalog()
+    global _menu_checked_at
+    _menu_checked_at = 0.0
+
+def get_menu_catalog():
+    """Return the current menu snapshot, rebuilding it if the menu changed.
+
+    With 'menu_catalog' in RESULT_CACHE_DISABLED every call loads a fresh
+    one (and keeps none).
+    """
+    global _menu_catalog, _menu_checked_at
+    if 'menu_catalog' in current_app.config.get('RESULT_CACHE_DISABLED', ()):
+        return MenuCatalog.load(data_version(MENU_VERSION))
+    catalog = _menu_catalog
+    if catalog is not None and time.monotonic() - _menu_checked_at < MENU_CHECK_INTERVAL \
+            and catalog.database == db.engine.url:
+        return catalog
+
+    with _menu_catalog_lock:
+        catalog = _menu_catalog
+        if catalog is not None and time.monotonic() - _menu_checked_at < MENU_CHECK_INTERVAL \
+                and catalog.database == db.engine.url:
+            return catalog  # another thread just looked
+        version = data_version(MENU_VERSION)
+        if catalog is None or catalog.version != version or catalog.database != db.engine.url:
+            catalog = MenuCatalog.load(version)
+            _menu_catalog = catalog
+        _menu_checked_at = time.monotonic()
+        return catalog
+
+@event.listens_for(Session, 'after_flush')
+def _remember_menu_changes(session, flush_context):
+    # note menu edits now, count them once with the commit
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, MENU_MODELS):
+            session.info['menu_changed'] = True
+            return
+
+@event.listens_for(Session, 'before_commit')
+def _count_menu_changes(session):
+    session.flush()  # edits that are still pending set menu_changed too
+    if session.info.pop('menu_changed', False):
+        bump_data_version(MENU_VERSION, session)
+        session.info['menu_bumped'] = True
+
+@event.listens_for(Session, 'after_commit')
+def _recheck_menu_on_commit(session):
+    if session.info.pop('menu_bumped', False):
+        _recheck_menu()
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_menu_changes(session):
+    session.info.pop('menu_changed', None)
+    session.info.pop('menu_bumped', None)
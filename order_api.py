@@ -0,0 +1,180 @@
+# JSON order intake: a batch of orders in one request
+#
+# For the phone and partner channels, which place orders in bursts. The body
+# looks like
+#
+#   {"orders": [
+#       {"customer_id": 12, "discount_code": "SPRING5",
+#        "items": [{"type": "pizza", "id": 3, "quantity": 2},
+#                  {"type": "drink", "id": 1, "quantity": 1}]},
+#       ...
+#   ]}
+#
+# All orders are checked against the menu in one pass, and their customers
+# are loaded with one query. Then every valid order
+# goes through place_order (the same rules as the order form) inside its own
+# savepoint, so one order that fails only rolls back itself, and the batch is
+# committed once at the end. The answer has one result per order, in the
+# order they were sent:
+#   created  - order_id, total, discount, driver and the customer messages
+#   rejected - did not pass validation, nothing was saved
+#   failed   - passed validation but saving it failed (rolled back)
+from collections import namedtuple
+
+from sqlalchemy import select
+
+from models import db, Customer, User, get_menu_catalog
+from order_service import ORDER_ITEM_FIELDS, price_line, sort_lines, place_order
+import metrics
+
+# most orders accepted in one request
+DEFAULT_MAX_BATCH = 100
+
+# what the view needs after the commit (the ORM objects are expired by then)
+CreatedOrder = namedtuple('CreatedOrder', 'order_id created_at staff_id new_driver')
+
+class BatchError(Exception):
+    """The request as a whole can't be used (bad JSON, too many orders)"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def _positive_int(value):
+    # ints only (JSON true/false are ints in Python too)
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+def validate_order(data, catalog):
+    """(customer_id, priced lines, discount code, errors) for one order of the batch"""
+    if not isinstance(data, dict):
+        return None, [], '', ['order must be an object']
+    errors = []
+    customer_id = data.get('customer_id')
+    if not _positive_int(customer_id):
+        errors.append('customer_id must be a positive integer')
+        customer_id = None
+    discount_code = data.get('discount_code') or ''
+    if not isinstance(discount_code, str):
+        errors.append('discount_code must be a string')
+        discount_code = ''
+
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return customer_id, [], discount_code.strip(), errors + ['items must be a non-empty list']
+
+    # the same item twice becomes one line, like a form field would
+    quantities = {}
+    for n, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append(f'item {n}: must be an object')
+            continue
+        item_type = ORDER_ITEM_FIELDS.get(str(item.get('type', '')).lower())
+        item_id, quantity = item.get('id'), item.get('quantity', 1)
+        if item_type is None:
+            errors.append(f'item {n}: type must be one of {", ".join(ORDER_ITEM_FIELDS)}')
+        elif not _positive_int(item_id):
+            errors.append(f'item {n}: id must be a positive integer')
+        elif not _positive_int(quantity):
+            errors.append(f'item {n}: quantity must be a positive integer')
+        else:
+            quantities[item_type, item_id] = quantities.get((item_type, item_id), 0) + quantity
+
+    lines = []
+    for (item_type, item_id), quantity in quantities.items():
+        line = price_line(catalog, item_type, item_id, quantity)
+        if line is None:
+            errors.append(f'{item_type.lower()} {item_id} is not on the menu')
+        else:
+            lines.append(line)
+    return customer_id, sort_lines(lines), discount_code.strip(), errors
+
+def _load_customers(customer_ids):
+    # customer_id -> (Customer, User), one query for the whole batch
+    if not customer_ids:
+        return {}
+    rows = db.session.execute(
+        select(Customer, User)
+        .join(User, User.user_id == Customer.user_id)
+        .where(Customer.customer_id.in_(customer_ids))
+    ).all()
+    return {customer.customer_id: (customer, user) for customer, user in rows}
+
+def _created(index, placed):
+    order = placed.order
+    return {
+        'index': index,
+        'status': 'created',
+        'order_id': order.order_id,
+        'customer_id': order.customer_id,
+        'total': round(float(order.final_total), 2),
+        'discount': round(float(placed.total_discount), 2),
+        'created_at': order.created_at.isoformat(),
+        'delivery_status': order.delivery_status,
+        'driver_id': order.staff_id,
+        'messages': placed.messages,
+    }
+
+def place_batch(payload, max_orders=DEFAULT_MAX_BATCH):
+    """Validate and place a batch of orders, committing once.
+
+    Returns (results, created): a result dict per order in the order they
+    were sent, and a CreatedOrder for each order that was committed. Raises
+    BatchError when the payload itself is unusable.
+    """
+    orders = payload.get('orders') if isinstance(payload, dict) else payload
+    if not isinstance(orders, list) or not orders:
+        raise BatchError('expected {"orders": [...]} with at least one order')
+    if len(orders) > max_orders:
+        raise BatchError(f'at most {max_orders} orders per batch, got {len(orders)}', status=413)
+
+    # one pass over the batch against the menu, then one query for the
+    # customers (discount codes are claimed one by one, see discounts.py).
+    # These stages are the whole batch's, so they get their own histogram
+    batch_timer = metrics.StageTimer(metrics.batch_stage_seconds)
+    catalog = get_menu_catalog()
+    checked = [validate_order(data, catalog) for data in orders]
+    customers = _load_customers({customer_id for customer_id, _, _, errors in checked if not errors})
+    batch_timer.lap('lookup')
+
+    results = [None] * len(orders)
+    created = []
+    for index, (customer_id, lines, discount_code, errors) in enumerate(checked):
+        if not errors and customer_id not in customers:
+            errors = [f'customer {customer_id} does not exist']
+        if errors:
+            metrics.orders_rejected.inc('invalid')
+            results[index] = {'index': index, 'status': 'rejected', 'errors': errors}
+            continue
+
+        customer, user = customers[customer_id]
+        timer = metrics.StageTimer()
+        try:
+            with db.session.begin_nested():
+                placed = place_order(customer, user, lines, discount_code, timer=timer)
+        except Exception as e:
+            metrics.order_rollbacks.inc(metrics.rollback_cause(e))
+            timer.done('failed')
+            results[index] = {'index': index, 'status': 'failed', 'errors': [str(e)]}
+            continue
+        # read everything we answer with now, before the commit expires it
+        order = placed.order
+        created.append((index, timer, _created(index, placed),
+                        CreatedOrder(order.order_id, order.created_at, order.staff_id, placed.new_driver is not None)))
+
+    batch_timer.skip()
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        metrics.order_rollbacks.inc(metrics.rollback_cause(e), amount=len(created))
+        for index, timer, _, _ in created:
+            timer.done('failed')
+            results[index] = {'index': index, 'status': 'failed', 'errors': [str(e)]}
+        return results, []
+    batch_timer.lap('commit')
+
+    metrics.orders_created.inc(amount=len(created))
+    for index, timer, result, _ in created:
+        timer.done('created')
+        results[index] = result
+    return results, [order for _, _, _, order in created]
@@ -0,0 +1,113 @@
+# one page of the /orders list
+#
+# The list is sorted newest first on (created_at, order_id). Instead of
+# OFFSET (which reads and throws away every row before the page) each page
+# starts right after the last row of the previous one, so page 100 costs the
+# same as page 1. The position is passed around as an opaque cursor string.
+import base64
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, and_
+
+from models import db, Order, Customer, User
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+ORDER_STATUSES = ('Pending', 'In Progress', 'Out for Delivery', 'Delivered', 'Cancelled')
+
+OrderPage = namedtuple('OrderPage', ['orders', 'next_cursor', 'prev_cursor'])
+
+def encode_cursor(created_at, order_id):
+    # position of one row in the list as a url-safe string
+    raw = f"{created_at.isoformat()}|{order_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (created_at, order_id), or raise ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, order_id = base64.urlsafe_b64decode(padded).decode().split('|')
+        return datetime.fromisoformat(created_at), int(order_id)
+    except Exception:
+        raise ValueError(f'Invalid cursor: {cursor}')
+
+def parse_filters(args):
+    """Read the list filters from the query string, ignoring empty fields"""
+    filters = {}
+    status = args.get('status', '').strip()
+    if status in ORDER_STATUSES:
+        filters['status'] = status
+    for key in ('customer_id', 'staff_id'):
+        value = args.get(key, '').strip()
+        if value.isdigit():
+            filters[key] = int(value)
+    for key in ('date_from', 'date_to'):
+        value = args.get(key, '').strip()
+        if value:
+            try:
+                filters[key] = datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                pass
+    return filters
+
+def load_order_page(filters=None, cursor=None, direction='next', page_size=DEFAULT_PAGE_SIZE):
+    """One page of (Order, Customer, User) rows, newest first.
+
+    cursor/direction 'next' gives the rows older than the cursor, 'prev'
+    the rows newer than it. Bad cursors raise ValueError.
+    """
+    filters = filters or {}
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+
+    query = db.session.query(Order, Customer, User)\
+        .join(Customer, Order.customer_id == Customer.customer_id)\
+        .join(User, Customer.user_id == User.user_id)
+
+    if 'status' in filters:
+        query = query.filter(Order.delivery_status == filters['status'])
+    if 'customer_id' in filters:
+        query = query.filter(Order.customer_id == filters['customer_id'])
+    if 'staff_id' in filters:
+        query = query.filter(Order.staff_id == filters['staff_id'])
+    if 'date_from' in filters:
+        query = query.filter(Order.created_at >= filters['date_from'])
+    if 'date_to' in filters:
+        # the whole "to" day is included
+        query = query.filter(Order.created_at < filters['date_to'] + timedelta(days=1))
+
+    going_back = cursor is not None and direction == 'prev'
+    if cursor is not None:
+        created_at, order_id = decode_cursor(cursor)
+        if going_back:
+            query = query.filter(or_(Order.created_at > created_at,
+                                     and_(Order.created_at == created_at, Order.order_id > order_id)))
+        else:
+            query = query.filter(or_(Order.created_at < created_at,
+                                     and_(Order.created_at == created_at, Order.order_id < order_id)))
+
+    if going_back:
+        query = query.order_by(Order.created_at.asc(), Order.order_id.asc())
+    else:
+        query = query.order_by(Order.created_at.desc(), Order.order_id.desc())
+
+    # one extra row tells us if there is another page after this one
+    rows = query.limit(page_size + 1).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if going_back:
+        rows.reverse()
+
+    if not rows:
+        return OrderPage([], None, None)
+
+    first, last = rows[0][0], rows[-1][0]
+    if going_back:
+        next_cursor = encode_cursor(last.created_at, last.order_id)
+        prev_cursor = encode_cursor(first.created_at, first.order_id) if has_more else None
+    else:
+        next_cursor = encode_cursor(last.created_at, last.order_id) if has_more else None
+        prev_cursor = encode_cursor(first.created_at, first.order_id) if cursor is not None else None
+
+    return OrderPage(rows, next_cursor, prev_cursor)
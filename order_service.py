@@ -0,0 +1,227 @@
+# the order pipeline: price an order, apply the discounts, find a driver
+#
+# Used by the order form (controllers.create_order) and the JSON order API
+# (order_api.py), so both follow the same business rules:
+#   - 10% loyalty discount once a customer has 10+ pizzas, then the counter
+#     starts over (see loyalty.py)
+#   - on their birthday the cheapest pizza and one drink are free
+#   - a discount code takes a fixed amount off and can only be used once
+#   - the longest idle driver in the postal code delivers, or one from the
+#     emergency driver pool when nobody is free (see driver_pool.py); with
+#     DELIVERY_BATCHING the order waits for a delivery run (delivery_runs.py)
+#   - the discount never makes the order cost less than nothing
+# place_order does all of it in the current transaction; the caller commits.
+from collections import namedtuple
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import insert
+
+from models import db, Order, OrderItem, OrderDiscount, LOYALTY_THRESHOLD
+from dispatch import claim_driver, driver_name
+from driver_pool import emergency_driver
+from rollups import record_order_sales, rollup_slot
+from discounts import redeem_code
+from loyalty import count_order, LOYALTY_RATE
+import metrics
+
+# form field prefix -> Order_Item.item_type
+ORDER_ITEM_FIELDS = {'pizza': 'Pizza', 'drink': 'Drink', 'dessert': 'Dessert'}
+
+def price_line(catalog, item_type, item_id, quantity):
+    # one priced order line, or None if the item is not on the menu (anymore)
+    if item_type == 'Pizza':
+        item = catalog.pizzas_by_id.get(item_id)
+        unit_price = item.final_price if item else None
+    elif item_type == 'Drink':
+        item = catalog.drinks_by_id.get(item_id)
+        unit_price = item.price if item else None
+    else:
+        item = catalog.desserts_by_id.get(item_id)
+        unit_price = item.price if item else None
+    if item is None:
+        return None
+    return {
+        'item_type': item_type,
+        'pizza_id': item_id if item_type == 'Pizza' else None,
+        'drink_id': item_id if item_type == 'Drink' else None,
+        'dessert_id': item_id if item_type == 'Dessert' else None,
+        'quantity': quantity,
+        'unit_price': float(unit_price),
+        'total_price': float(unit_price) * quantity
+    }
+
+def sort_lines(lines):
+    # pizzas first, then drinks, then desserts, like the menu
+    type_order = list(ORDER_ITEM_FIELDS.values())
+    lines.sort(key=lambda line: (type_order.index(line['item_type']),
+                                 line['pizza_id'] or line['drink_id'] or line['dessert_id']))
+    return lines
+
+def parse_order_lines(form, catalog):
+    # turn submitted pizza_<id>/drink_<id>/dessert_<id> fields into priced lines
+    # (only the fields in the form are looked at, not the whole menu)
+    lines = []
+    for key, quantity in form.items():
+        prefix, _, item_id = key.partition('_')
+        if prefix not in ORDER_ITEM_FIELDS or not item_id.isdigit():
+            continue
+        if not quantity or int(quantity) <= 0:
+            continue
+        
+        # skip things that are not on the menu (anymore)
+        line = price_line(catalog, ORDER_ITEM_FIELDS[prefix], int(item_id), int(quantity))
+        if line is not None:
+            lines.append(line)
+    return sort_lines(lines)
+
+# what place_order did: the new order, the discount it got, messages for the
+# customer and the driver_pool.EmergencyDriver it brought in (if any)
+PlacedOrder = namedtuple('PlacedOrder', 'order total_discount messages new_driver')
+
+def place_order(customer, user, lines, discount_code='', now=None, timer=None):
+    """Create the order for these priced lines with all discounts and a driver.
+
+    Everything happens in the current transaction; nothing is committed.
+    timer is the metrics.StageTimer of the request.
+    """
+    timer = timer or metrics.StageTimer()
+    now = now or datetime.now()
+    total_price = sum(line['total_price'] for line in lines)
+    pizza_count = sum(line['quantity'] for line in lines if line['item_type'] == 'Pizza')
+    
+    # Create a new order
+    new_order = Order()
+    new_order.customer_id = customer.customer_id
+    new_order.delivery_status = 'Pending'
+    new_order.created_at = now
+    new_order.discount_amount = 0.00
+    
+    db.session.add(new_order)
+    db.session.flush()  # Save to get order ID
+    
+    # Add all items to the order in one insert
+    db.session.execute(insert(OrderItem), [
+        {
+            'order_id': new_order.order_id,
+            'item_type': line['item_type'],
+            'pizza_id': line['pizza_id'],
+            'drink_id': line['drink_id'],
+            'dessert_id': line['dessert_id'],
+            'quantity': line['quantity'],
+            'total_price': line['total_price']
+        }
+        for line in lines
+    ])
+    timer.lap('order_lines')
+    
+    # Calculate discounts
+    total_discount = 0.00
+    messages = []
+    
+    # Birthday discount (free cheapest pizza + free drink if ordered)
+    if user.is_birthday_today():
+        birthday_discount = 0.00
+        birthday_items = []
+        
+        # Find cheapest pizza in order and give it for free
+        pizza_prices = [line['unit_price'] for line in lines if line['item_type'] == 'Pizza']
+        if pizza_prices:
+            cheapest_pizza_price = min(pizza_prices)
+            birthday_discount += cheapest_pizza_price
+            birthday_items.append(f'Free cheapest pizza: €{cheapest_pizza_price:.2f}')
+        
+        # Give one free drink if drinks are ordered
+        drink_prices = [line['unit_price'] for line in lines if line['item_type'] == 'Drink']
+        if drink_prices:
+            # Find cheapest drink and give one for free
+            cheapest_drink_price = min(drink_prices)
+            birthday_discount += cheapest_drink_price
+            birthday_items.append(f'Free drink: €{cheapest_drink_price:.2f}')
+        
+        if birthday_items:
+            messages.append(f'Happy Birthday {user.first_name}! {", ".join(birthday_items)}')
+        
+        total_discount += birthday_discount
+    
+    # Discount code (claimed right away, so two orders can't both use it;
+    # see discounts.py)
+    if discount_code:
+        code = redeem_code(discount_code, now.date())
+        if code:
+            code_id, code_value = code
+            code_discount = float(code_value)
+            total_discount += code_discount
+            messages.append(f'Discount code "{discount_code}": €{code_discount:.2f} off')
+            
+            # Remember which order used it
+            db.session.add(OrderDiscount(order_id=new_order.order_id, code_id=code_id,
+                                         discount_type='FixedAmount', discount_amount=code_discount))
+        else:
+            messages.append(f'Invalid or expired discount code: {discount_code}')
+    timer.lap('discounts')
+    
+    # Assign delivery driver
+    new_driver_created = None
+    if current_app.config.get('DELIVERY_BATCHING', False):
+        # No driver yet: the delivery scheduler sends the order out together
+        # with other orders for the same area (see delivery_runs.py)
+        messages.append(f'Your order goes out with the next delivery run to area {user.postal_code}')
+        timer.lap('driver')
+    else:
+        try:
+            # Reserve the longest idle driver for this postal code area
+            # (skips drivers still on their 30 minute break)
+            driver_id = claim_driver(user.postal_code, now)
+            timer.lap('driver')
+        
+            if driver_id:
+                # Assign existing available driver
+                new_order.staff_id = driver_id
+                new_order.delivery_status = 'In Progress'
+                new_order.dispatched_at = now
+                messages.append(f'Driver assigned: {driver_name(driver_id)}')
+            else:
+                # Nobody is free in this area - get one from the emergency pool
+                # (an idle one from elsewhere, a retired one or a new one)
+                new_driver_created = emergency_driver(user.postal_code, now)
+                timer.lap('emergency_driver')
+            
+                if new_driver_created:
+                    new_order.staff_id = new_driver_created.staff_id
+                    new_order.delivery_status = 'In Progress'
+                    new_order.dispatched_at = now
+                    name = driver_name(new_driver_created.staff_id)
+                    if new_driver_created.how == 'created':
+                        messages.append(f'NEW driver created and assigned: {name} for area {user.postal_code}')
+                    else:
+                        messages.append(f'Emergency driver assigned: {name} for area {user.postal_code}')
+                else:
+                    messages.append(f'All drivers for area {user.postal_code} are busy, your order will wait for the next one')
+        except Exception as e:
+            messages.append(f'Driver assignment error: {str(e)}')
+            timer.skip()
+    
+    # Loyalty discount (10% off for customers with 10+ pizzas, then reset counter).
+    # Decided by the database on the locked counter row, as late as possible so
+    # the lock is only held until the commit (see loyalty.py)
+    if count_order(customer.customer_id, new_order.order_id, pizza_count, now):
+        loyalty_discount = total_price * LOYALTY_RATE
+        total_discount += loyalty_discount
+        messages.insert(0, f'Loyalty discount: €{loyalty_discount:.2f} (10% off for {LOYALTY_THRESHOLD}+ pizzas ordered!)')
+    
+    # Finalize the order
+    # Make sure discount doesn't exceed total
+    if total_discount > total_price:
+        total_discount = total_price
+    
+    final_total = total_price - total_discount
+    new_order.discount_amount = total_discount
+    new_order.final_total = final_total
+    
+    # Add the order to the daily report rollups (same transaction)
+    record_order_sales(new_order.created_at, user, lines, final_total, slot=rollup_slot(new_order.order_id))
+    timer.lap('totals')
+    
+    db.session.add(new_order)
+    return PlacedOrder(new_order, total_discount, messages, new_driver_created)
@@ -0,0 +1,205 @@
+# per-request SQL profile: which queries a page ran and what they cost
+#
+# Every request gets a RequestProfile that the engine events fill in: how
+# many statements ran, the time spent in the database, the slowest
+# statements with their parameters, and statements that ran over and over
+# with only the parameters changing (an N+1 loop, e.g. one User query per
+# customer). Statements from the report sections' worker threads count for
+# the request that started them (see ReportRunner).
+#
+# Requests slower than PROFILE_SLOW_REQUEST_MS are written to the
+# `profiling` logger as one JSON object per line. The logger has its own
+# handler and doesn't pass records on to the root logger, so they go to
+# PROFILE_LOG_FILE (stderr when it isn't set) and not into the app's console
+# output. The last PROFILE_KEEP requests are kept for /admin/profile.
+import heapq
+import itertools
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+
+from flask import request
+from sqlalchemy import event
+
+from models import db
+
+logger = logging.getLogger('profiling')
+
+# defaults, can be changed in the app config
+DEFAULT_SLOW_REQUEST_MS = 500
+DEFAULT_N_PLUS_ONE = 10    # same statement more than this many times in one request
+DEFAULT_SLOWEST = 5        # slowest statements kept per request
+DEFAULT_KEEP = 500         # recent requests kept for /admin/profile
+
+# the profile of the request this code runs for (also seen by report threads)
+_current = ContextVar('request_profile', default=None)
+
+def statement_shape(statement):
+    # the statement without what changes between calls of the same query
+    shape = re.sub(r'\s+', ' ', statement).strip()
+    shape = re.sub(r'\((?:\s*(?:\?|%s|:\w+)\s*,)+\s*(?:\?|%s|:\w+)\s*\)', '(?, ...)', shape)  # IN lists
+    return re.sub(r'\b\d+\b', 'N', shape)
+
+def _short(parameters, limit=200):
+    text = repr(parameters)
+    return text if len(text) <= limit else text[:limit] + '...'
+
+class RequestProfile:
+    """What one request did in the database"""
+
+    def __init__(self, endpoint, path, slowest):
+        self.endpoint = endpoint
+        self.path = path
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_time = 0.0
+        self.shapes = Counter()
+        self._slowest = []       # heap of (seconds, seq, statement, parameters)
+        self._keep = slowest
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self, statement, parameters, took):
+        with self._lock:
+            self.statements += 1
+            self.db_time += took
+            self.shapes[statement_shape(statement)] += 1
+            entry = (took, next(self._seq), statement, parameters)
+            if len(self._slowest) < self._keep:
+                heapq.heappush(self._slowest, entry)
+            elif took > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def finish(self, status, n_plus_one):
+        """Summary of the request as a plain dict (what gets logged and kept)"""
+        with self._lock:
+            return {
+                'endpoint': self.endpoint,
+                'path': self.path,
+                'status': status,
+                'at': time.time(),
+                'duration_ms': round((time.perf_counter() - self.started) * 1000, 2),
+                'statements': self.statements,
+                'db_ms': round(self.db_time * 1000, 2),
+                'slowest': [
+                    {'ms': round(took * 1000, 2), 'sql': ' '.join(statement.split()),
+                     'parameters': _short(parameters)}
+                    for took, _, statement, parameters in sorted(self._slowest, reverse=True)
+                ],
+                'n_plus_one': [
+                    {'count': count, 'sql': shape}
+                    for shape, count in self.shapes.most_common() if count > n_plus_one
+                ],
+            }
+
+def setup_logger(path=None):
+    """Send the profiling logger's records to path (stderr without one), only there"""
+    # the handler from an earlier app (scripts create several) is replaced
+    for handler in [h for h in logger.handlers if getattr(h, 'profiling', False)]:
+        logger.removeHandler(handler)
+        handler.close()
+    handler = logging.FileHandler(path) if path else logging.StreamHandler()
+    handler.profiling = True
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.propagate = False
+
+class Profiler:
+    """Hooks the engine and the request cycle of an app"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.recent = deque(maxlen=DEFAULT_KEEP)
+        self.slow_request_ms = DEFAULT_SLOW_REQUEST_MS
+        self.n_plus_one = DEFAULT_N_PLUS_ONE
+        self.slowest = DEFAULT_SLOWEST
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['profiler'] = self
+        if not app.config.get('PROFILING_ENABLED', True):
+            return
+        self.slow_request_ms = app.config.get('PROFILE_SLOW_REQUEST_MS', DEFAULT_SLOW_REQUEST_MS)
+        self.n_plus_one = app.config.get('PROFILE_N_PLUS_ONE', DEFAULT_N_PLUS_ONE)
+        self.slowest = app.config.get('PROFILE_SLOWEST', DEFAULT_SLOWEST)
+        self.recent = deque(maxlen=app.config.get('PROFILE_KEEP', DEFAULT_KEEP))
+        setup_logger(app.config.get('PROFILE_LOG_FILE'))
+
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', self._before_execute)
+            event.listen(db.engine, 'after_cursor_execute', self._after_execute)
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        app.teardown_request(self._teardown_request)
+
+    # --- engine events --------------------------------------------------------
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if _current.get() is not None:
+            context._profile_started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = _current.get()
+        started = getattr(context, '_profile_started', None)
+        if profile is not None and started is not None:
+            profile.add(statement, parameters, time.perf_counter() - started)
+
+    # --- request hooks --------------------------------------------------------
+
+    def _start_request(self):
+        profile = RequestProfile(request.endpoint or request.path, request.full_path.rstrip('?'), self.slowest)
+        request.environ['profiling.token'] = _current.set(profile)
+
+    def _end_request(self, response):
+        self._finish(response.status_code)
+        return response
+
+    def _teardown_request(self, exc):
+        # requests that failed before after_request ran
+        self._finish(500)
+
+    def _finish(self, status):
+        token = request.environ.pop('profiling.token', None)
+        if token is None:
+            return
+        profile = _current.get()
+        _current.reset(token)
+        summary = profile.finish(status, self.n_plus_one)
+        with self._lock:
+            self.recent.append(summary)
+        if summary['duration_ms'] >= self.slow_request_ms:
+            logger.warning(json.dumps(dict(summary, event='slow_request')))
+
+    # --- reading --------------------------------------------------------------
+
+    def by_endpoint(self):
+        """Recent requests per endpoint, slowest average first"""
+        with self._lock:
+            recent = list(self.recent)
+        groups = {}
+        for summary in recent:
+            groups.setdefault(summary['endpoint'], []).append(summary)
+        rows = []
+        for endpoint, requests in groups.items():
+            durations = sorted(r['duration_ms'] for r in requests)
+            rows.append({
+                'endpoint': endpoint,
+                'requests': len(requests),
+                'avg_ms': round(sum(durations) / len(durations), 2),
+                'max_ms': durations[-1],
+                'avg_statements': round(sum(r['statements'] for r in requests) / len(requests), 1),
+                'avg_db_ms': round(sum(r['db_ms'] for r in requests) / len(requests), 2),
+                'slow': sum(1 for d in durations if d >= self.slow_request_ms),
+                'n_plus_one': sum(1 for r in requests if r['n_plus_one']),
+                'latest': requests[-1],
+            })
+        return sorted(rows, key=lambda row: row['avg_ms'], reverse=True)
+
+profiler = Profiler()
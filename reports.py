@@ -0,0 +1,187 @@
+# the business reports page, one independent section per panel
+#
+# The sections don't depend on each other, so ReportRunner runs them at the
+# same time on a small shared thread pool, each on its own pooled connection.
+# The page then takes as long as the slowest section instead of all of them
+# added up. A section that fails or runs past its timeout only empties its own
+# panel; the others still show.
+#
+# The timeout is enforced by the database on the section's connection
+# (db_pool.statement_timeout), counted from when the section starts running:
+# a section that runs too long is stopped and gives its thread and
+# connection back, and time spent queued behind other pages doesn't count.
+import contextvars
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import select, func
+from sqlalchemy.exc import DBAPIError
+
+from models import (Order, Customer, User, Pizza, DailyPizzaSales, DailyGenderSales,
+                    DailyAgeGroupSales, DailyPostalCodeSales, LOYALTY_THRESHOLD)
+from rollups import report_start_date
+from db_pool import statement_timeout
+
+# defaults, can be changed with REPORT_WORKERS / REPORT_SECTION_TIMEOUT
+DEFAULT_WORKERS = 8
+DEFAULT_SECTION_TIMEOUT = 5.0  # seconds
+
+ReportResult = namedtuple('ReportResult', ['data', 'errors', 'timings'])
+
+# --- sections -------------------------------------------------------------
+# each one gets its own connection and returns what the template shows
+
+UndeliveredOrder = namedtuple('UndeliveredOrder', ['order_id', 'customer_name', 'delivery_status', 'waiting_time'])
+
+def undelivered_orders(conn):
+    # orders still on their way, oldest first. Names and waiting times are put
+    # together here so the query runs the same on MySQL and SQLite (the
+    # undelivered_orders view uses MySQL's CONCAT and TIMESTAMPDIFF)
+    now = datetime.now()
+    rows = conn.execute(
+        select(Order.order_id, User.first_name, User.last_name, Order.delivery_status, Order.created_at)
+        .join(Customer, Customer.customer_id == Order.customer_id)
+        .join(User, User.user_id == Customer.user_id)
+        .where(Order.delivery_status.in_(['Pending', 'In Progress', 'Out for Delivery']))
+        .order_by(Order.created_at)
+    )
+    return [
+        UndeliveredOrder(order_id, f"{first_name} {last_name}", delivery_status,
+                         f"{int((now - created_at).total_seconds() // 60)} mins")
+        for order_id, first_name, last_name, delivery_status, created_at in rows
+    ]
+
+def top_pizzas(conn):
+    # top 3 pizzas sold in the last 30 days
+    return conn.execute(
+        select(
+            Pizza.name.label('name'),
+            func.sum(DailyPizzaSales.quantity).label('orders'),
+            func.sum(DailyPizzaSales.revenue).label('revenue')
+        )
+        .join(DailyPizzaSales, DailyPizzaSales.pizza_id == Pizza.pizza_id)
+        .where(DailyPizzaSales.sales_date >= report_start_date())
+        .group_by(Pizza.pizza_id, Pizza.name)
+        .having(func.sum(DailyPizzaSales.quantity) > 0)
+        .order_by(func.sum(DailyPizzaSales.quantity).desc())
+        .limit(3)
+    ).fetchall()
+
+def _earnings_by(conn, model, column, label, top=None):
+    # orders and revenue per value of one rollup dimension
+    query = select(
+        column.label(label),
+        func.sum(model.orders).label('orders'),
+        func.sum(model.revenue).label('revenue')
+    ).where(model.sales_date >= report_start_date())\
+     .group_by(column)\
+     .having(func.sum(model.orders) > 0)
+    if top:
+        query = query.order_by(func.sum(model.revenue).desc()).limit(top)
+    return conn.execute(query).fetchall()
+
+def gender_earnings(conn):
+    return _earnings_by(conn, DailyGenderSales, DailyGenderSales.gender, 'gender')
+
+def age_group_earnings(conn):
+    return _earnings_by(conn, DailyAgeGroupSales, DailyAgeGroupSales.age_range, 'age_range')
+
+def postal_code_earnings(conn):
+    # top 10 postal codes
+    return _earnings_by(conn, DailyPostalCodeSales, DailyPostalCodeSales.postal_code, 'postal_code', top=10)
+
+def customer_counts(conn):
+    # all customers and the ones with a loyalty discount waiting; the second
+    # count is a range of ix_customer_loyalty, not a scan of the table
+    total, loyal = conn.execute(
+        select(select(func.count(Customer.customer_id)).scalar_subquery(),
+               select(func.count(Customer.customer_id))
+               .where(Customer.total_pizzas_ordered >= LOYALTY_THRESHOLD).scalar_subquery())
+    ).one()
+    return {'total_customers': total, 'loyalty_customers': loyal}
+
+def monthly_revenue(conn):
+    # every order is in exactly one gender row, so this is the 30 day revenue
+    revenue = conn.execute(
+        select(func.sum(DailyGenderSales.revenue))
+        .where(DailyGenderSales.sales_date >= report_start_date())
+    ).scalar()
+    return float(revenue or 0)
+
+# name -> (section, value shown when it fails)
+REPORT_SECTIONS = {
+    'undelivered_orders': (undelivered_orders, []),
+    'top_pizzas': (top_pizzas, []),
+    'gender_earnings': (gender_earnings, []),
+    'age_group_earnings': (age_group_earnings, []),
+    'postal_code_earnings': (postal_code_earnings, []),
+    'customer_counts': (customer_counts, {'total_customers': 0, 'loyalty_customers': 0}),
+    'monthly_revenue': (monthly_revenue, 0.0),
+}
+
+# --- runner ---------------------------------------------------------------
+
+_pools = {}  # workers -> pool
+_pool_lock = threading.Lock()
+
+class SectionTimeout(Exception):
+    """The database stopped a section that ran past its timeout"""
+
+def _get_pool(workers):
+    # one pool per size for the whole process so busy pages can't start
+    # endless threads (normally there is just the one REPORT_WORKERS pool)
+    with _pool_lock:
+        if workers not in _pools:
+            _pools[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='report')
+        return _pools[workers]
+
+class ReportRunner:
+    """Runs report sections in parallel, each with its own connection"""
+
+    def __init__(self, engine, workers=DEFAULT_WORKERS, timeout=DEFAULT_SECTION_TIMEOUT):
+        self.engine = engine
+        self.workers = workers
+        self.timeout = timeout
+
+    def _run_section(self, section):
+        started = time.perf_counter()
+        with self.engine.connect() as conn, statement_timeout(conn, self.timeout):
+            try:
+                result = section(conn)
+            except DBAPIError as e:
+                if time.perf_counter() - started >= self.timeout:
+                    raise SectionTimeout(f'Timed out after {self.timeout:g}s') from e
+                raise
+        return result, time.perf_counter() - started
+
+    def run(self, sections=None):
+        """Run every section and return ReportResult(data, errors, timings).
+
+        timings are in milliseconds. A failed or timed out section gets its
+        fallback value in data and a message in errors.
+        """
+        sections = sections or REPORT_SECTIONS
+        pool = _get_pool(self.workers)
+        started = time.perf_counter()
+        # each section runs in a copy of our context, so the request profile
+        # (profiling.py) sees its statements too
+        futures = {name: pool.submit(contextvars.copy_context().run, self._run_section, section)
+                   for name, (section, _) in sections.items()}
+
+        data, errors, timings = {}, {}, {}
+        for name, future in futures.items():
+            fallback = sections[name][1]
+            # no wait limit here: the database stops every section `timeout`
+            # seconds after it started
+            try:
+                data[name], took = future.result()
+                timings[name] = round(took * 1000, 1)
+            except Exception as e:
+                data[name] = fallback
+                errors[name] = str(e)
+                timings[name] = None
+        timings['total'] = round((time.perf_counter() - started) * 1000, 1)
+        return ReportResult(data, errors, timings)
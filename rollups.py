@@ -0,0 +1,227 @@
+# keeps the daily reporting rollups (Daily_*_Sales tables) in step with orders
+#
+# create_order adds each new order to the rollups in the same transaction,
+# cancel_order takes it out again, and `flask rebuild-rollups` recomputes them
+# from the order tables (for existing data or if they ever drift).
+#
+# The rows an order adds to stay locked until its transaction commits, and
+# every order of the day adds to the same gender/age/postal code rows. So
+# each order goes into one of ROLLUP_SLOTS copies of them (by order id), and
+# concurrent orders mostly lock different rows. A rebuild writes slot 0 only.
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+import click
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects import mysql, sqlite
+
+from models import (db, Order, OrderItem, Customer, User, DailyPizzaSales, DailyGenderSales,
+                    DailyAgeGroupSales, DailyPostalCodeSales)
+
+# how many days the reports page looks back
+REPORT_DAYS = 30
+
+# rows per INSERT when rebuilding
+REBUILD_CHUNK = 1000
+
+# copies of each rollup row that orders are spread over
+ROLLUP_SLOTS = 16
+
+ROLLUP_MODELS = (DailyPizzaSales, DailyGenderSales, DailyAgeGroupSales, DailyPostalCodeSales)
+
+def report_start_date(today=None):
+    # first day included in the 30 day reports (today counts as day 30)
+    today = today or date.today()
+    return today - timedelta(days=REPORT_DAYS - 1)
+
+def age_range(date_of_birth, on_day):
+    # same buckets as the old TIMESTAMPDIFF(YEAR, ...) report
+    if date_of_birth is None:
+        return 'Unknown'
+    age = on_day.year - date_of_birth.year - \
+        ((on_day.month, on_day.day) < (date_of_birth.month, date_of_birth.day))
+    if age < 20:
+        return 'Under 20'
+    if age <= 29:
+        return '20-29'
+    if age <= 39:
+        return '30-39'
+    if age <= 49:
+        return '40-49'
+    return '50+'
+
+def rollup_slot(order_id):
+    return order_id % ROLLUP_SLOTS
+
+def _gender_key(gender):
+    return gender or 'Other'
+
+def _postal_key(postal_code):
+    # part of the primary key, so unknown postal codes are stored as ''
+    return postal_code or ''
+
+def _as_date(value):
+    # DATE(created_at) comes back as a string on SQLite
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value))
+
+def _add(model, key_columns, rows):
+    """Add amounts onto rollup rows, creating the rows that don't exist yet.
+
+    rows are dicts with the key columns and the amounts to add (negative
+    amounts take an order back out). One upsert statement for all rows.
+    """
+    if not rows:
+        return
+    amount_columns = [column for column in rows[0] if column not in key_columns]
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'mysql':
+        stmt = mysql.insert(model).values(rows)
+        stmt = stmt.on_duplicate_key_update(
+            {column: getattr(model, column) + stmt.inserted[column] for column in amount_columns})
+        db.session.execute(stmt)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(model).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={column: getattr(model, column) + stmt.excluded[column] for column in amount_columns})
+        db.session.execute(stmt)
+    else:
+        # no upsert we know of - update, and insert where nothing was there
+        for row in rows:
+            keys = [getattr(model, column) == row[column] for column in key_columns]
+            updated = db.session.execute(
+                model.__table__.update().where(*keys).values(
+                    {column: getattr(model, column) + row[column] for column in amount_columns})
+            ).rowcount
+            if not updated:
+                db.session.execute(model.__table__.insert().values(row))
+
+def record_order_sales(created_at, user, lines, final_total, sign=1, slot=0):
+    """Add one order to the rollups (sign=-1 takes it out again).
+
+    lines are the order lines from parse_order_lines (only pizzas are used),
+    slot is rollup_slot(order_id). The caller commits together with the order.
+    """
+    day = created_at.date()
+    revenue = float(final_total or 0) * sign
+
+    pizzas = defaultdict(lambda: [0, 0.0])
+    for line in lines:
+        if line['item_type'] == 'Pizza':
+            pizzas[line['pizza_id']][0] += line['quantity'] * sign
+            pizzas[line['pizza_id']][1] += float(line['total_price']) * sign
+
+    _add(DailyPizzaSales, ['sales_date', 'pizza_id', 'slot'], [
+        {'sales_date': day, 'pizza_id': pizza_id, 'slot': slot, 'quantity': quantity, 'revenue': pizza_revenue}
+        for pizza_id, (quantity, pizza_revenue) in pizzas.items()
+    ])
+    _add(DailyGenderSales, ['sales_date', 'gender', 'slot'], [
+        {'sales_date': day, 'gender': _gender_key(user.gender), 'slot': slot, 'orders': sign, 'revenue': revenue}
+    ])
+    _add(DailyAgeGroupSales, ['sales_date', 'age_range', 'slot'], [
+        {'sales_date': day, 'age_range': age_range(user.date_of_birth, day), 'slot': slot,
+         'orders': sign, 'revenue': revenue}
+    ])
+    _add(DailyPostalCodeSales, ['sales_date', 'postal_code', 'slot'], [
+        {'sales_date': day, 'postal_code': _postal_key(user.postal_code), 'slot': slot,
+         'orders': sign, 'revenue': revenue}
+    ])
+
+def record_order_cancelled(order):
+    # take a cancelled order back out of the rollups
+    user = db.session.execute(
+        select(User).join(Customer, Customer.user_id == User.user_id)
+        .where(Customer.customer_id == order.customer_id)
+    ).scalar_one()
+    lines = [
+        {'item_type': 'Pizza', 'pizza_id': pizza_id, 'quantity': quantity, 'total_price': total_price}
+        for pizza_id, quantity, total_price in db.session.execute(
+            select(OrderItem.pizza_id, func.sum(OrderItem.quantity), func.sum(OrderItem.total_price))
+            .where(OrderItem.order_id == order.order_id, OrderItem.item_type == 'Pizza')
+            .group_by(OrderItem.pizza_id)
+        )
+    ]
+    record_order_sales(order.created_at, user, lines, order.final_total,
+                       sign=-1, slot=rollup_slot(order.order_id))
+
+def rebuild_rollups(since=None):
+    """Recompute the rollups from the order tables.
+
+    Only days from `since` on are rebuilt (all days if None). Cancelled orders
+    are left out. Returns the number of rollup rows written per table.
+    """
+    for model in ROLLUP_MODELS:
+        query = delete(model)
+        if since is not None:
+            query = query.where(model.sales_date >= since)
+        db.session.execute(query)
+
+    order_filter = [Order.delivery_status != 'Cancelled']
+    if since is not None:
+        order_filter.append(Order.created_at >= datetime.combine(since, datetime.min.time()))
+
+    # pizzas: the database can add these up by day directly
+    sales_day = func.date(Order.created_at)
+    pizza_rows = [
+        {'sales_date': _as_date(day), 'pizza_id': pizza_id, 'slot': 0, 'quantity': quantity, 'revenue': revenue}
+        for day, pizza_id, quantity, revenue in db.session.execute(
+            select(sales_day, OrderItem.pizza_id, func.sum(OrderItem.quantity), func.sum(OrderItem.total_price))
+            .join(Order, Order.order_id == OrderItem.order_id)
+            .where(OrderItem.item_type == 'Pizza', *order_filter)
+            .group_by(sales_day, OrderItem.pizza_id)
+        )
+    ]
+
+    # customer dimensions: age depends on the order day, so add up in Python
+    genders = defaultdict(lambda: [0, 0.0])
+    age_ranges = defaultdict(lambda: [0, 0.0])
+    postal_codes = defaultdict(lambda: [0, 0.0])
+    orders = db.session.execute(
+        select(Order.created_at, Order.final_total, User.gender, User.date_of_birth, User.postal_code)
+        .join(Customer, Customer.customer_id == Order.customer_id)
+        .join(User, User.user_id == Customer.user_id)
+        .where(*order_filter)
+        .execution_options(yield_per=REBUILD_CHUNK)
+    )
+    for created_at, final_total, gender, date_of_birth, postal_code in orders:
+        day = created_at.date()
+        revenue = float(final_total or 0)
+        for totals, key in ((genders, _gender_key(gender)),
+                            (age_ranges, age_range(date_of_birth, day)),
+                            (postal_codes, _postal_key(postal_code))):
+            totals[(day, key)][0] += 1
+            totals[(day, key)][1] += revenue
+
+    written = {}
+    for model, key_columns, rows in (
+        (DailyPizzaSales, ['sales_date', 'pizza_id', 'slot'], pizza_rows),
+        (DailyGenderSales, ['sales_date', 'gender', 'slot'],
+         [{'sales_date': day, 'gender': key, 'slot': 0, 'orders': n, 'revenue': r}
+          for (day, key), (n, r) in genders.items()]),
+        (DailyAgeGroupSales, ['sales_date', 'age_range', 'slot'],
+         [{'sales_date': day, 'age_range': key, 'slot': 0, 'orders': n, 'revenue': r}
+          for (day, key), (n, r) in age_ranges.items()]),
+        (DailyPostalCodeSales, ['sales_date', 'postal_code', 'slot'],
+         [{'sales_date': day, 'postal_code': key, 'slot': 0, 'orders': n, 'revenue': r}
+          for (day, key), (n, r) in postal_codes.items()]),
+    ):
+        for start in range(0, len(rows), REBUILD_CHUNK):
+            _add(model, key_columns, rows[start:start + REBUILD_CHUNK])
+        written[model.__tablename__] = len(rows)
+    return written
+
+@click.command('rebuild-rollups')
+@click.option('--days', type=int, default=None, help='Only rebuild the last N days (default: everything).')
+def rebuild_rollups_command(days):
+    """Rebuild the daily reporting rollups from the order tables."""
+    db.create_all()  # makes the rollup tables if they are new
+    since = date.today() - timedelta(days=days - 1) if days else None
+    written = rebuild_rollups(since)
+    db.session.commit()
+    for table, count in written.items():
+        click.echo(f'{table}: {count} rows')
@@ -0,0 +1,213 @@
+# EXPLAINs every query the pages and background jobs run, and fails on full
+# table scans of the big tables
+#
+# `flask check-scans` opens each page with the test client, sends the order
+# forms and APIs, and runs the delivery/dispatch and intake worker statements,
+# records the SQL that reaches the database and
+# asks the database for its plan (EXPLAIN on MySQL, EXPLAIN QUERY PLAN on
+# SQLite). Any plan that reads a whole table - apart from the small menu
+# tables and the scans a page asks for on purpose, like listing every user -
+# is reported and the command exits with an error.
+#
+# Run it against a database seeded with a realistic amount of data: on a
+# nearly empty table MySQL happily picks a full scan even when there is an
+# index it would use later. Everything that writes runs inside one
+# transaction that is rolled back at the end (the pages' own commits only
+# release savepoints in it), so nothing is changed - not even the menu
+# version: the menu catalog cache is switched off for the run instead.
+import re
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+import click
+from flask import current_app
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from models import db, Order, Customer, Staff, Pizza
+from delivery_scheduler import advance_deliveries
+from dispatch import claim_driver
+import intake
+
+# tables a full scan is fine on, they only ever hold a few hundred rows
+SMALL_TABLES = {'pizzas', 'ingredients', 'pizza_ingredients', 'drinks', 'desserts', 'schema_migrations'}
+
+# page -> tables it reads completely on purpose ({...} become real ids)
+ROUTES = [
+    ('/users', {'User'}),                  # lists every user
+    ('/users/{user_id}', set()),
+    ('/products', {'Customer'}),           # customer picker lists every customer
+    ('/pizzas', set()),
+    ('/orders', set()),
+    ('/orders?status=Pending', set()),
+    ('/orders?customer_id={customer_id}', set()),
+    ('/orders?staff_id={staff_id}', set()),
+    ('/orders/{order_id}', set()),
+    ('/reports', {'Customer'}),            # customer counts go over all customers
+    ('/delivery-status', {'Staff'}),       # the board shows every driver
+    ('/drivers', {'Staff'}),
+    # writes, sent with _post_data() inside the rolled back transaction
+    # ({new_order_id} is the order the form just placed)
+    ('POST /orders/create', set()),
+    ('POST /api/orders/intake', set()),
+    ('POST /api/orders/batch', set()),
+    ('POST /orders/{new_order_id}/cancel', set()),
+]
+
+Scan = namedtuple('Scan', ['source', 'table', 'plan', 'statement'])
+
+def _sample_ids():
+    # some real ids for the detail pages
+    order_id, customer_id, staff_id = db.session.execute(
+        select(Order.order_id, Order.customer_id, Order.staff_id).order_by(Order.order_id.desc()).limit(1)
+    ).one_or_none() or (0, 0, 0)
+    user_id = db.session.execute(select(Customer.user_id).limit(1)).scalar() or 0
+    postal_code = db.session.execute(select(Staff.assigned_postal_code).limit(1)).scalar() or ''
+    pizza_id = db.session.execute(select(Pizza.pizza_id).limit(1)).scalar() or 0
+    return {'order_id': order_id, 'customer_id': customer_id, 'staff_id': staff_id or 0, 'user_id': user_id,
+            'postal_code': postal_code, 'pizza_id': pizza_id, 'new_order_id': 0}
+
+def _post_data(path, ids):
+    # test client arguments for a POST route: an order of two pizzas
+    order = {'customer_id': ids['customer_id'], 'items': [{'type': 'pizza', 'id': ids['pizza_id'], 'quantity': 2}]}
+    if path == '/orders/create':
+        return {'data': {'customer_id': ids['customer_id'], f"pizza_{ids['pizza_id']}": 2}}
+    if path == '/api/orders/intake':
+        return {'json': order}
+    if path == '/api/orders/batch':
+        return {'json': {'orders': [order, dict(order, items=[])]}}  # one placed, one rejected
+    return {}
+
+@contextmanager
+def _rolled_back():
+    # db.session on one connection whose transaction is rolled back at the
+    # end; commits in there only release a savepoint. (Flask-SQLAlchemy's own
+    # session always picks the engine, so a plain Session stands in for it.)
+    db.session.remove()
+    with db.engine.connect() as conn:
+        transaction = conn.begin()
+        if conn.dialect.name == 'sqlite':
+            # pysqlite only begins before a write, and a savepoint outside a
+            # transaction commits when it is released
+            conn.exec_driver_sql('BEGIN')
+        db.session.registry.set(Session(bind=conn, join_transaction_mode='create_savepoint'))
+        try:
+            yield
+        finally:
+            db.session.remove()
+            transaction.rollback()
+
+class StatementRecorder:
+    """Collects the statements the database ran, one copy of each"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.source = None
+        self.statements = {}  # sql -> (source, parameters)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        verb = statement.lstrip().split(None, 1)[0].upper()
+        if verb in ('SELECT', 'UPDATE', 'DELETE', 'WITH') and not executemany:
+            self.statements.setdefault(statement, (self.source, parameters))
+
+    def __enter__(self):
+        event.listen(self.engine, 'after_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'after_cursor_execute', self._record)
+
+def _full_scans(conn, statement, parameters):
+    # tables this statement reads completely, with the plan line that says so.
+    # Walking an index in order is fine when a LIMIT stops it early (the
+    # keyset pages), and so is reading a whole index without the table rows.
+    dialect = conn.dialect.name
+    limited = re.search(r'\bLIMIT\b', statement, re.IGNORECASE) is not None
+    if dialect == 'mysql':
+        for row in conn.exec_driver_sql('EXPLAIN ' + statement, parameters).mappings():
+            table = row['table'] or ''
+            if table.startswith('<'):  # <derived2> etc. are temp results
+                continue
+            covering = 'Using index' in (row['Extra'] or '')
+            if row['type'] == 'ALL' or (row['type'] == 'index' and not covering and not limited):
+                yield table, f"type={row['type']} rows={row['rows']}"
+    elif dialect == 'sqlite':
+        for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters):
+            detail = row[-1]
+            match = re.match(r'SCAN (\S+)', detail)
+            if not match or match.group(1) in ('CONSTANT', 'TABLE') or match.group(1).startswith(('anon_', '(')):
+                continue  # not a table, or a subquery result
+            if 'USING' not in detail or ('COVERING' not in detail and not limited):
+                yield match.group(1), detail
+    else:
+        raise click.ClickException(f'No EXPLAIN support for {dialect}')
+
+def find_full_scans(app):
+    """Run the pages and jobs and EXPLAIN what they sent to the database.
+
+    Returns (full scans as Scan rows, number of statements checked,
+    {page: status or error} for the pages that didn't load).
+    """
+    engine = db.engine
+    ids = _sample_ids()
+    allowed = {}
+    failed = {}
+    # every page has to really run its queries
+    app.config['RESULT_CACHE_DISABLED'] = ('reports', 'driver_board', 'delivery_overview', 'menu_catalog')
+
+    with StatementRecorder(engine) as recorder, _rolled_back():
+        client = app.test_client()
+        for route, tables in ROUTES:
+            method, _, path = route.rpartition(' ')
+            path = path.format(**ids)
+            recorder.source = f'{method} {path}' if method else path
+            allowed[recorder.source] = tables
+            # a broken page is reported, the queries it got to still count
+            try:
+                response = client.open(path, method=method or 'GET', **_post_data(path, ids))
+                status = response.status_code
+                placed = re.search(r'/orders/(\d+)$', response.headers.get('Location', ''))
+                if placed:
+                    ids['new_order_id'] = int(placed.group(1))
+            except Exception as e:
+                status = f'{type(e).__name__}: {e}'
+            # like the end of a request: whatever the view didn't commit goes
+            db.session.close()
+            if not isinstance(status, int) or status >= 400:
+                failed[recorder.source] = status
+
+        # background work that doesn't belong to a page
+        recorder.source = 'intake worker'
+        allowed[recorder.source] = set()
+        intake.run_once()
+        recorder.source = 'advance_deliveries'
+        allowed[recorder.source] = set()
+        advance_deliveries(datetime.now())
+        db.session.close()
+        recorder.source = 'claim_driver'
+        allowed[recorder.source] = set()
+        claim_driver(ids['postal_code'], datetime.now())
+        db.session.close()
+
+    scans = []
+    with engine.connect() as conn:
+        for statement, (source, parameters) in recorder.statements.items():
+            for table, plan in _full_scans(conn, statement, parameters):
+                ok = SMALL_TABLES | allowed[source]
+                if table.lower() not in {name.lower() for name in ok}:
+                    scans.append(Scan(source, table, plan, statement))
+    return scans, len(recorder.statements), failed
+
+@click.command('check-scans')
+def check_scans_command():
+    """EXPLAIN the queries of every page and fail on full table scans."""
+    scans, checked, failed = find_full_scans(current_app._get_current_object())
+    for path, status in failed.items():
+        click.echo(f'warning: {path} did not load ({status})')
+    for scan in scans:
+        click.echo(f'{scan.source}: full scan of {scan.table} ({scan.plan})')
+        click.echo('    ' + ' '.join(scan.statement.split())[:300])
+    if scans:
+        raise click.ClickException(f'{len(scans)} of {checked} queries scan a whole table')
+    click.echo(f'{checked} queries checked, no full table scans')
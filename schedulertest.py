@@ -0,0 +1,124 @@
+# delivery scheduler test: orders placed in one process, moved by another
+#
+# Two app instances on the same database stand in for two processes, e.g. a
+# web worker and `flask process-intake`. Orders are placed through app B and
+# handed to B's scheduler, which never runs (like a process whose scheduler
+# never started). A's scheduler runs on a ManualClock, so minutes pass in
+# no time, and has to move B's orders along through its sweep. Afterwards it
+# checks that:
+#   - every order is 'Out for Delivery' once OUT_FOR_DELIVERY_AFTER has passed
+#   - every order is 'Delivered' and its driver free once DELIVERED_AFTER has
+#   - orders placed after A's first sweep are picked up by a later one
+#
+#   python schedulertest.py --orders 20
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import select, update
+
+from models import db, Customer, User, Order, Staff, get_menu_catalog
+from datagen import SCALES
+from bench import bench_app
+from delivery_scheduler import DeliveryScheduler, ManualClock, OUT_FOR_DELIVERY_AFTER, DELIVERED_AFTER
+from dispatch import DRIVER_COOLDOWN
+from order_service import place_order, price_line
+
+START = datetime(2026, 1, 9, 19, 0)
+
+class TwoProcesses:
+    def __init__(self, app_a, app_b):
+        self.clock = ManualClock(START)
+        self.mover = DeliveryScheduler(clock=self.clock)  # runs, in "process" A
+        self.mover.init_app(app_a)
+        self.placer = DeliveryScheduler(clock=self.clock)  # never runs, in "process" B
+        self.placer.init_app(app_b)
+        self.app_b = app_b
+        self.order_ids = []
+        with app_b.app_context():
+            # every driver free and rested, so the orders get one right away
+            db.session.execute(
+                update(Staff).values(is_available=True, is_retired=False, last_delivery_time=START - DRIVER_COOLDOWN)
+                .execution_options(synchronize_session=False))
+            db.session.commit()
+            self.customers = db.session.execute(
+                select(Customer.customer_id, Customer.user_id).order_by(Customer.customer_id).limit(50)).all()
+            catalog = get_menu_catalog()
+            self.lines = [price_line(catalog, 'Pizza', catalog.pizzas[0].pizza_id, 1)]
+            db.session.remove()
+
+    def place(self, orders):
+        # in process B, at the current (manual) time
+        with self.app_b.app_context():
+            for _ in range(orders):
+                customer_id, user_id = self.customers[len(self.order_ids) % len(self.customers)]
+                placed = place_order(db.session.get(Customer, customer_id), db.session.get(User, user_id),
+                                     self.lines, now=self.clock.now())
+                db.session.commit()
+                order = placed.order
+                self.order_ids.append(order.order_id)
+                self.placer.order_placed(order.order_id, order.created_at, order.staff_id)
+            db.session.remove()
+
+    def advance(self, seconds):
+        # only A's scheduler runs, at every step the way its thread would
+        end = self.clock.current + timedelta(seconds=seconds)
+        while self.mover.next_wake() <= end:
+            self.clock.current = max(self.clock.current, self.mover.next_wake())
+            self.mover.run_due()
+        self.clock.current = end
+
+    def statuses(self, order_ids):
+        with self.app_b.app_context():
+            rows = db.session.execute(
+                select(Order.order_id, Order.delivery_status, Order.staff_id, Staff.is_available)
+                .outerjoin(Staff, Staff.staff_id == Order.staff_id)
+                .where(Order.order_id.in_(order_ids))
+            ).all()
+            db.session.remove()
+        return rows
+
+def check(rows, status, drivers_free=False):
+    """Problems found, as readable lines"""
+    problems = []
+    for order_id, delivery_status, staff_id, is_available in rows:
+        if staff_id is None:
+            problems.append(f'order {order_id} never got a driver')
+        elif delivery_status != status:
+            problems.append(f"order {order_id} is '{delivery_status}', expected '{status}'")
+        elif drivers_free and not is_available:
+            problems.append(f'driver {staff_id} of order {order_id} was not freed')
+    return problems
+
+@click.command()
+@click.option('--scale', type=click.Choice(list(SCALES)), default='tiny', help='How much data to generate.')
+@click.option('--orders', type=int, default=20, help='Orders placed in the other process, per round.')
+@click.option('--seed', type=int, default=42)
+def main(scale, orders, seed):
+    """Check that one running scheduler moves the orders of every process."""
+    problems = []
+    with bench_app(scale, seed=seed) as app_a:
+        with bench_app(scale, database_url=app_a.config['SQLALCHEMY_DATABASE_URI']) as app_b:
+            test = TwoProcesses(app_a, app_b)
+            test.place(orders)
+            first = list(test.order_ids)
+            test.advance(OUT_FOR_DELIVERY_AFTER + 1)
+            problems += check(test.statuses(first), 'Out for Delivery')
+
+            # a second round, placed after A has swept once already
+            test.place(orders)
+            second = test.order_ids[len(first):]
+            test.advance(DELIVERED_AFTER - OUT_FOR_DELIVERY_AFTER)
+            problems += check(test.statuses(first), 'Delivered', drivers_free=True)
+            test.advance(DELIVERED_AFTER + test.mover.sweep_interval)
+            problems += check(test.statuses(second), 'Delivered', drivers_free=True)
+            click.echo(f'{len(test.order_ids)} orders placed in B, '
+                       f'{len(test.placer)} steps left in B\'s scheduler, {len(test.mover)} in A\'s')
+
+    for problem in problems:
+        click.echo(f'PROBLEM {problem}')
+    if problems:
+        raise click.ClickException(f'{len(problems)} scheduler problems')
+    click.echo('scheduler holds')
+
+if __name__ == '__main__':
+    main()
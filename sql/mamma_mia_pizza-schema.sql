@@ -24,7 +24,9 @@ CREATE TABLE Customer (
     customer_id INT AUTO_INCREMENT PRIMARY KEY,
     total_pizzas_ordered INT DEFAULT 0,
     user_id INT NOT NULL,
-    FOREIGN KEY (user_id) REFERENCES `User`(user_id)
+    FOREIGN KEY (user_id) REFERENCES `User`(user_id),
+    -- Customers with a loyalty discount waiting (used by the reports)
+    INDEX ix_customer_loyalty (total_pizzas_ordered)
 );
 
 -- 3. Staff table
@@ -34,7 +36,13 @@ CREATE TABLE Staff (
     is_available BOOLEAN DEFAULT TRUE,
     assigned_postal_code VARCHAR(20),  -- Primary delivery area
     user_id INT NOT NULL,
-    FOREIGN KEY (user_id) REFERENCES `User`(user_id)
+    is_emergency BOOLEAN NOT NULL DEFAULT FALSE,  -- Made by the emergency driver pool
+    is_retired BOOLEAN NOT NULL DEFAULT FALSE,    -- Emergency driver idle too long
+    FOREIGN KEY (user_id) REFERENCES `User`(user_id),
+    -- Free drivers per area, longest idle first (used by dispatch)
+    INDEX ix_staff_dispatch (assigned_postal_code, is_available, last_delivery_time),
+    -- Idle and retired emergency drivers in any area (used by driver_pool.py)
+    INDEX ix_staff_pool (is_emergency, is_retired, is_available, last_delivery_time)
 );
 
 -- 4. Ingredients table
@@ -88,10 +96,18 @@ CREATE TABLE Orders (
     staff_id INT,
     delivery_status ENUM('Pending','In Progress','Out for Delivery','Delivered','Cancelled') DEFAULT 'Pending',
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    dispatched_at DATETIME,                       -- Got its driver; delivery steps count from here
     discount_amount DECIMAL(6,2) DEFAULT 0.00 CHECK (discount_amount >= 0),
     final_total DECIMAL(8,2) CHECK (final_total >= 0),
     FOREIGN KEY (customer_id) REFERENCES Customer(customer_id),
-    FOREIGN KEY (staff_id) REFERENCES Staff(staff_id)
+    FOREIGN KEY (staff_id) REFERENCES Staff(staff_id),
+    -- Order list pages, newest first (keyset on created_at, order_id)
+    INDEX ix_orders_created (created_at, order_id),
+    INDEX ix_orders_customer_created (customer_id, created_at, order_id),
+    INDEX ix_orders_staff_created (staff_id, created_at, order_id),
+    -- Delivery steps, driver board and undelivered orders
+    INDEX ix_orders_status_created (delivery_status, created_at),
+    INDEX ix_orders_staff_status (staff_id, delivery_status)
 );
 
 -- 10. Order_Item table
@@ -107,7 +123,9 @@ CREATE TABLE Order_Item (
     FOREIGN KEY (order_id) REFERENCES Orders(order_id),
     FOREIGN KEY (pizza_id) REFERENCES pizzas(pizza_id),
     FOREIGN KEY (drink_id) REFERENCES drinks(drink_id),
-    FOREIGN KEY (dessert_id) REFERENCES desserts(dessert_id)
+    FOREIGN KEY (dessert_id) REFERENCES desserts(dessert_id),
+    INDEX ix_order_item_order_type (order_id, item_type),
+    INDEX ix_order_item_pizza (pizza_id)
 );
 
 -- 11. Discount_Code table
@@ -141,6 +159,109 @@ CREATE TABLE Transaction (
     FOREIGN KEY (order_id) REFERENCES Orders(order_id)
 );
 
+-- 14. Daily reporting rollups (kept up to date by the app, see rollups.py;
+--     fill them for existing orders with `flask --app app rebuild-rollups`;
+--     slot spreads concurrent orders over several rows, reports sum them)
+CREATE TABLE Daily_Pizza_Sales (
+    sales_date DATE NOT NULL,
+    pizza_id INT NOT NULL,
+    slot SMALLINT NOT NULL DEFAULT 0,
+    quantity INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(10,2) NOT NULL DEFAULT 0.00,
+    PRIMARY KEY (sales_date, pizza_id, slot),
+    FOREIGN KEY (pizza_id) REFERENCES pizzas(pizza_id)
+);
+
+CREATE TABLE Daily_Gender_Sales (
+    sales_date DATE NOT NULL,
+    gender VARCHAR(10) NOT NULL,
+    slot SMALLINT NOT NULL DEFAULT 0,
+    orders INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(10,2) NOT NULL DEFAULT 0.00,
+    PRIMARY KEY (sales_date, gender, slot)
+);
+
+CREATE TABLE Daily_Age_Group_Sales (
+    sales_date DATE NOT NULL,
+    age_range VARCHAR(10) NOT NULL,
+    slot SMALLINT NOT NULL DEFAULT 0,
+    orders INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(10,2) NOT NULL DEFAULT 0.00,
+    PRIMARY KEY (sales_date, age_range, slot)
+);
+
+CREATE TABLE Daily_Postal_Code_Sales (
+    sales_date DATE NOT NULL,
+    postal_code VARCHAR(20) NOT NULL,
+    slot SMALLINT NOT NULL DEFAULT 0,
+    orders INT NOT NULL DEFAULT 0,
+    revenue DECIMAL(10,2) NOT NULL DEFAULT 0.00,
+    PRIMARY KEY (sales_date, postal_code, slot)
+);
+
+-- 15. Applied schema migrations (see migrations.py; `flask --app app migrate`
+--     records them for a database created from this file)
+CREATE TABLE schema_migrations (
+    version INT PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 16. Order intake queue (orders accepted now and placed by a worker, see intake.py)
+CREATE TABLE Order_Intake (
+    intake_id INT AUTO_INCREMENT PRIMARY KEY,
+    customer_id INT NOT NULL,
+    payload TEXT NOT NULL,
+    status ENUM('Queued', 'Processing', 'Done', 'Failed') NOT NULL DEFAULT 'Queued',
+    attempts INT NOT NULL DEFAULT 0,
+    order_id INT NULL,
+    messages TEXT NULL,
+    error VARCHAR(255) NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    started_at DATETIME NULL,
+    finished_at DATETIME NULL,
+    FOREIGN KEY (customer_id) REFERENCES Customer(customer_id),
+    FOREIGN KEY (order_id) REFERENCES Orders(order_id),
+    INDEX ix_intake_status (status, intake_id),
+    INDEX ix_intake_customer (customer_id, status, intake_id)
+);
+
+-- 17. Discount code campaigns (codes issued in bulk, see campaigns.py)
+CREATE TABLE Discount_Campaign (
+    campaign_id INT AUTO_INCREMENT PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    prefix VARCHAR(20) NOT NULL UNIQUE,
+    discount_value DECIMAL(5,2) NOT NULL,
+    expiry_date DATE NOT NULL,
+    code_count INT NOT NULL,
+    issued INT NOT NULL DEFAULT 0,
+    code_key VARCHAR(64) NULL,
+    code_multiplier BIGINT NOT NULL,
+    code_offset BIGINT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 18. Loyalty ledger (what each order did to the loyalty counter, see loyalty.py)
+CREATE TABLE Loyalty_Ledger (
+    entry_id INT AUTO_INCREMENT PRIMARY KEY,
+    customer_id INT NOT NULL,
+    order_id INT NULL,
+    pizzas INT NOT NULL DEFAULT 0,
+    redeemed BOOLEAN NOT NULL DEFAULT FALSE,
+    folded BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (customer_id) REFERENCES Customer(customer_id),
+    FOREIGN KEY (order_id) REFERENCES Orders(order_id),
+    INDEX ix_loyalty_customer (customer_id, entry_id)
+);
+
+-- 19. Change counters for data every app process keeps a copy of
+--     (live discount codes, see discounts.py)
+CREATE TABLE Data_Version (
+    name VARCHAR(50) PRIMARY KEY,
+    version INT NOT NULL DEFAULT 0
+);
+
 
 
 -- Simple view for pizza menu with pricing (calculated in application)